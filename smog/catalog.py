@@ -0,0 +1,261 @@
+"""
+A cache of the image, flavor and network catalogs, indexed by name and id.
+
+BaseStack.get_image_name, get_flavor and the like used to list a whole
+catalog, and filter it, on every call.  A Catalog loads each resource type the
+first time it is needed and keeps it in dicts keyed by id and by name, so a
+lookup is a dictionary hit.
+
+Once ttl seconds have passed the next lookup refreshes the resource type.
+With glance v1, images are refreshed incrementally with its changes-since
+filter; glance v2 (which would take changes-since for an image property), nova
+flavors and neutron networks have no such filter, so they are reloaded.  A
+lookup by name or id that misses also forces a refresh (at most once per
+min_refresh seconds), so resources created behind the Catalog's back are
+still found.
+
+smog.glance.create_image, smog.nova.create_flavor and BaseStack's flavor
+helpers call Catalog.invalidate_all, so every Catalog sees their changes.
+
+Usage::
+
+    from smog.catalog import Catalog
+
+    catalog = Catalog(base)          # anything with .nova, .glance, .neutron
+    img = catalog.images.get("cirros")
+    flv = catalog.flavors.find("1")  # by name, or else by id
+    net_id = catalog.networks.get("private")["id"]
+"""
+
+__author__ = 'stoner'
+
+import datetime
+import threading
+import time
+import weakref
+
+from smog.core.exceptions import AmbiguityException
+from smog.core.logger import glob_logger
+
+
+def _attr(name):
+    return lambda res: getattr(res, name, None)
+
+
+def _item(name):
+    return lambda res: res.get(name)
+
+
+class ResourceIndex(object):
+    """
+    One resource type of a catalog, indexed by id and by name
+    """
+    def __init__(self, kind, loader, changes=None, ttl=300, min_refresh=5,
+                 id_fn=None, name_fn=None, deleted_fn=None,
+                 logger=glob_logger):
+        """
+        :param kind: (str) eg "images", used in log messages
+        :param loader: fn() returning every resource
+        :param changes: optional fn(since) returning the resources changed
+                        since a datetime (including deleted ones)
+        :param ttl: (int) seconds after which the next lookup refreshes
+        :param min_refresh: (int) least seconds between refreshes caused by
+                            misses
+        :param id_fn: fn(resource) -> id (default: resource.id)
+        :param name_fn: fn(resource) -> name (default: resource.name)
+        :param deleted_fn: fn(resource) -> True if a changed resource was
+                           deleted
+        """
+        self.kind = kind
+        self.loader = loader
+        self.changes = changes
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.id_fn = _attr("id") if id_fn is None else id_fn
+        self.name_fn = _attr("name") if name_fn is None else name_fn
+        self.deleted_fn = deleted_fn or (lambda res: False)
+        self.logger = logger
+        self.loads = 0
+        self._by_id = None
+        self._by_name = {}
+        self._loaded_at = 0
+        self._since = None
+        self._lock = threading.RLock()
+
+    def _index(self, resource):
+        res_id = self.id_fn(resource)
+        old = self._by_id.get(res_id)
+        if old is not None:
+            self._unindex(old)
+        self._by_id[res_id] = resource
+        self._by_name.setdefault(self.name_fn(resource), []).append(resource)
+
+    def _unindex(self, resource):
+        res_id = self.id_fn(resource)
+        self._by_id.pop(res_id, None)
+        name = self.name_fn(resource)
+        same = [r for r in self._by_name.get(name, [])
+                if self.id_fn(r) != res_id]
+        if same:
+            self._by_name[name] = same
+        else:
+            self._by_name.pop(name, None)
+
+    def refresh(self, full=False):
+        """
+        Reloads the resources, incrementally if possible (ie there is a
+        changes fn), and in full otherwise
+        """
+        with self._lock:
+            now = datetime.datetime.utcnow()
+            if full or self._by_id is None or self.changes is None:
+                self._by_id = {}
+                self._by_name = {}
+                for resource in self.loader():
+                    self._index(resource)
+                self.logger.debug("Loaded {} {}".format(len(self._by_id),
+                                                        self.kind))
+            else:
+                changed = list(self.changes(self._since))
+                for resource in changed:
+                    if self.deleted_fn(resource):
+                        self._unindex(resource)
+                    else:
+                        self._index(resource)
+                self.logger.debug("{} {} changed".format(len(changed),
+                                                         self.kind))
+            self.loads += 1
+            self._loaded_at = time.time()
+            # a little slack, in case the server clock is behind
+            self._since = now - datetime.timedelta(seconds=60)
+
+    def invalidate(self):
+        """
+        Forces a full reload on the next lookup
+        """
+        with self._lock:
+            self._by_id = None
+            self._by_name = {}
+
+    def _ensure(self):
+        with self._lock:
+            if self._by_id is None:
+                self.refresh(full=True)
+            elif time.time() - self._loaded_at > self.ttl:
+                self.refresh()
+
+    def _lookup(self, fn):
+        self._ensure()
+        with self._lock:
+            found = fn()
+            if not found and time.time() - self._loaded_at > self.min_refresh:
+                # full, unless changes can tell us what was added
+                self.refresh(full=self.changes is None)
+                found = fn()
+            return found
+
+    def by_id(self, res_id):
+        """
+        :return: the resource with this id, or None
+        """
+        return self._lookup(lambda: self._by_id.get(res_id))
+
+    def by_name(self, name):
+        """
+        :return: list of the resources with this name
+        """
+        return list(self._lookup(lambda: self._by_name.get(name, [])))
+
+    def find(self, key):
+        """
+        :return: the first resource named key, or else the one whose id is
+                 key, or None
+        """
+        def fn():
+            named = self._by_name.get(key)
+            if named:
+                return named[0]
+            return self._by_id.get(key)
+        return self._lookup(fn)
+
+    def get(self, name, no_ambiguity=False):
+        """
+        :param name: the name of the resource
+        :param no_ambiguity: raise AmbiguityException if more than one
+                             resource has this name
+        :return: the first resource with this name, or None
+        """
+        found = self.by_name(name)
+        if len(found) > 1 and no_ambiguity:
+            raise AmbiguityException("Found more than one of {} in {}".format(
+                name, self.kind))
+        return found[0] if found else None
+
+    def all(self):
+        self._ensure()
+        with self._lock:
+            return list(self._by_id.values())
+
+
+class Catalog(object):
+    """
+    The images, flavors and networks of a deployment
+    """
+    _catalogs = weakref.WeakSet()
+
+    def __init__(self, clients, ttl=300, logger=glob_logger):
+        """
+        :param clients: an object with nova, glance and neutron attributes
+                        (eg a BaseStack or a smog.clients.ClientSet).  They
+                        are looked up on every load, so refreshed clients are
+                        used.  Its glance_version (default "1") decides if
+                        images can be refreshed incrementally
+        :param ttl: (int) seconds before a resource type is refreshed
+        """
+        self.clients = clients
+        glance_v1 = str(getattr(clients, "glance_version", "1")) == "1"
+        changes = self._image_changes if glance_v1 else None
+        self.images = ResourceIndex("images", self._load_images,
+                                    changes=changes, ttl=ttl,
+                                    deleted_fn=self._image_deleted,
+                                    logger=logger)
+        self.flavors = ResourceIndex("flavors", self._load_flavors, ttl=ttl,
+                                     logger=logger)
+        self.networks = ResourceIndex("networks", self._load_networks,
+                                      ttl=ttl, id_fn=_item("id"),
+                                      name_fn=_item("name"), logger=logger)
+        self._catalogs.add(self)
+
+    def _load_images(self):
+        return self.clients.glance.images.list()
+
+    def _image_changes(self, since):
+        filters = {"changes-since": since.strftime("%Y-%m-%dT%H:%M:%S")}
+        return self.clients.glance.images.list(filters=filters)
+
+    @staticmethod
+    def _image_deleted(image):
+        return getattr(image, "deleted", False) or \
+            getattr(image, "status", None) in ("deleted", "killed")
+
+    def _load_flavors(self):
+        return self.clients.nova.flavors.list()
+
+    def _load_networks(self):
+        return self.clients.neutron.list_networks()["networks"]
+
+    def invalidate(self, kind=None):
+        """
+        :param kind: "images", "flavors" or "networks", or None for all
+        """
+        kinds = ("images", "flavors", "networks") if kind is None else (kind,)
+        for name in kinds:
+            getattr(self, name).invalidate()
+
+    @classmethod
+    def invalidate_all(cls, kind=None):
+        """
+        Invalidates kind in every Catalog
+        """
+        for catalog in list(cls._catalogs):
+            catalog.invalidate(kind)
@@ -0,0 +1,224 @@
+"""
+A registry of OpenStack clients which share one authenticated session.
+
+create_keystone, create_nova_client and friends each authenticate from
+scratch, and so does BaseStack.refresh.  get_clients instead hands out a
+ClientSet per set of credentials (the same credentials always get the same
+ClientSet), whose keystone, nova, glance and neutron clients:
+
+- share one keystone Session, so there is a single token for all of them, and
+  one pool of HTTP connections
+- are built lazily, once, even when many threads ask for them at once
+- get a new token shortly before the current one expires (refresh_margin),
+  rather than on the first request that fails
+
+Usage::
+
+    from smog.clients import get_clients
+
+    clients = get_clients(username="admin", password="secret",
+                          tenant_name="admin",
+                          auth_url="http://10.8.0.2:5000/v2.0/")
+    clients.nova.servers.list()
+    clients.neutron.list_networks()
+    get_clients(**same_creds) is clients    # True
+"""
+
+__author__ = 'stoner'
+
+import hashlib
+import threading
+
+from smog import add_client_to_path
+from smog.catalog import Catalog
+from smog.core.logger import glob_logger
+from smog.core.metrics import instrument
+from smog.keystone import get_keystone_init
+
+add_client_to_path()
+
+import keystoneclient.v2_0.client as ksclient
+from keystoneclient import session as ks_session
+from keystoneclient.auth.identity import v2 as ks_v2
+import novaclient.v2.client as nvclient
+from glanceclient import Client as GlanceFactory
+from neutronclient.v2_0.client import Client as NeutronClient
+
+
+class ClientSet(object):
+    """
+    The keystone, nova, glance and neutron clients for one set of credentials
+    """
+    def __init__(self, creds, glance_version="1", refresh_margin=300,
+                 auth=None, session=None, logger=glob_logger):
+        """
+        :param creds: dict with username, password, tenant_name and auth_url
+        :param glance_version: (str) "1" or "2"
+        :param refresh_margin: (int) get a new token when the current one
+                               expires in fewer than this many seconds
+        :param auth: keystone auth plugin.  A v2 Password plugin for creds if
+                     None
+        :param session: keystone Session.  A new one using auth if None
+        """
+        self.creds = dict(creds)
+        self.glance_version = glance_version
+        self.refresh_margin = refresh_margin
+        self.logger = logger
+        self._lock = threading.RLock()
+        if auth is None:
+            auth = ks_v2.Password(auth_url=creds["auth_url"],
+                                  username=creds["username"],
+                                  password=creds["password"],
+                                  tenant_name=creds["tenant_name"])
+        self._auth = auth
+        if session is None:
+            session = ks_session.Session(auth=self._auth)
+        self.session = session
+        self._access = None
+        self._clients = {}
+        self._catalog = None
+
+    def _fresh_access(self):
+        """
+        :return: the AccessInfo of a token with at least refresh_margin
+                 seconds left, re-authenticating if need be
+        """
+        with self._lock:
+            access = self._access
+            if access is None or \
+                    access.will_expire_soon(stale_duration=self.refresh_margin):
+                if access is not None:
+                    self.logger.info("Token for {} is about to expire, "
+                                     "refreshing".format(self.creds["username"]))
+                    self._auth.invalidate()
+                self._access = self._auth.get_access(self.session)
+                self._on_new_token()
+            return self._access
+
+    def _on_new_token(self):
+        keystone = self._clients.get("keystone")
+        if keystone is not None:
+            keystone.auth_ref = self._access
+        # glance is handed the token itself, so it must be rebuilt
+        self._clients.pop("glance", None)
+
+    @property
+    def token(self):
+        return self._fresh_access().auth_token
+
+    def _get(self, name, factory):
+        self._fresh_access()
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = self._clients[name] = instrument(factory(), name)
+            return client
+
+    def _make_keystone(self):
+        keystone = ksclient.Client(session=self.session, **self.creds)
+        keystone.auth_ref = self._access
+        return keystone
+
+    def _make_nova(self):
+        creds = self.creds
+        return nvclient.Client(creds["username"], creds["password"],
+                               creds["tenant_name"], creds["auth_url"],
+                               session=self.session)
+
+    def _make_glance(self):
+        endpoint = self.session.get_endpoint(service_type="image",
+                                             interface="public")
+        return GlanceFactory(self.glance_version,
+                             endpoint="{}/v{}".format(endpoint.rstrip("/"),
+                                                      self.glance_version),
+                             token=self._access.auth_token)
+
+    def _make_neutron(self):
+        return NeutronClient(session=self.session)
+
+    @property
+    def keystone(self):
+        return self._get("keystone", self._make_keystone)
+
+    @property
+    def nova(self):
+        return self._get("nova", self._make_nova)
+
+    @property
+    def glance(self):
+        return self._get("glance", self._make_glance)
+
+    @property
+    def neutron(self):
+        return self._get("neutron", self._make_neutron)
+
+    @property
+    def catalog(self):
+        """
+        The (lazily created) Catalog of images, flavors and networks, shared
+        by everyone using these credentials
+        """
+        with self._lock:
+            if self._catalog is None:
+                self._catalog = Catalog(self, logger=self.logger)
+            return self._catalog
+
+    def refresh(self):
+        """
+        Gets a new token now, whether or not the old one was expiring
+        """
+        with self._lock:
+            self._auth.invalidate()
+            self._access = None
+        return self._fresh_access()
+
+
+class ClientRegistry(object):
+    """
+    Maps credentials to their ClientSet
+    """
+    def __init__(self, factory=None):
+        """
+        :param factory: fn(creds, glance_version) -> ClientSet.  ClientSet if
+                        None
+        """
+        self.factory = ClientSet if factory is None else factory
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(creds, glance_version="1"):
+        pw = (creds.get("password") or "").encode()
+        return (creds.get("auth_url"), creds.get("username"),
+                creds.get("tenant_name"), hashlib.sha256(pw).hexdigest(),
+                glance_version)
+
+    def get(self, glance_version="1", **kwargs):
+        """
+        :param kwargs: username, password, tenant_name and auth_url.  Any
+                       which are missing come from the environment or the
+                       smog config, as for create_keystone
+        :return: the ClientSet for those credentials
+        """
+        creds = get_keystone_init(**kwargs)
+        key = self.key(creds, glance_version)
+        with self._lock:
+            clients = self._sets.get(key)
+            if clients is None:
+                clients = self.factory(creds, glance_version=glance_version)
+                self._sets[key] = clients
+        return clients
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+
+
+default_registry = ClientRegistry()
+
+
+def get_clients(glance_version="1", **kwargs):
+    """
+    :return: the shared ClientSet for the credentials in kwargs
+    """
+    return default_registry.get(glance_version=glance_version, **kwargs)
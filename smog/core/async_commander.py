@@ -0,0 +1,366 @@
+"""
+An asyncio counterpart to smog.core.commander.Command.
+
+Command ties up a thread for every blocking subprocess, and ProcessResult
+starts another thread to read the output of a non-blocking one.  That is fine
+for a handful of commands, but when tailing hundreds of logs or probing many
+hosts at once, it means hundreds of threads.  AsyncCommand runs the
+subprocesses from a single event loop instead.
+
+Remote commands use the same ssh multiplexing pool as Command, and blocking
+ones take one of its sessions to the host (see SSHControlPool.acquire), so
+that no more than max_sessions commands to a host are in flight whether they
+come from Command threads or from the event loop.  Note that on python
+versions before 3.12 the default asyncio child watcher still uses one
+(short lived) thread per child process to reap it.
+
+Usage::
+
+    import asyncio
+    from smog.core.async_commander import AsyncCommand, run_on_hosts
+
+    async def main():
+        res = await AsyncCommand("uptime", host="10.8.0.58")(timeout=10)
+        print(res.output)
+
+        tail = await AsyncCommand("journalctl -f", host="10.8.0.58")(block=False)
+        async for line in tail.stdout:
+            if "ERROR" in line:
+                break
+        await tail.terminate()
+
+        results = await run_on_hosts("cat /proc/meminfo", computes, limit=50)
+
+    asyncio.run(main())
+"""
+
+__author__ = 'stoner'
+
+import asyncio
+import codecs
+import shlex
+import weakref
+from collections import OrderedDict
+from asyncio.subprocess import PIPE, DEVNULL
+
+from smog.core.commander import CommandException, CommandTimeout
+from smog.core.logger import glob_logger as LOGGER
+from smog.core.sshpool import default_pool
+
+
+# event loop -> {(pool id, user, host): asyncio.Semaphore}
+_host_sessions = weakref.WeakKeyDictionary()
+
+
+def _host_semaphore(pool, user, host):
+    """
+    :return: the asyncio.Semaphore bounding the commands of the running event
+             loop to user@host to the pool's max_sessions
+    """
+    sems = _host_sessions.setdefault(asyncio.get_running_loop(), {})
+    key = (id(pool), user, host)
+    if key not in sems:
+        sems[key] = asyncio.Semaphore(pool.max_sessions)
+    return sems[key]
+
+
+class _LineIterator(object):
+    """
+    Async iterator over the decoded lines of an asyncio StreamReader.  A line
+    longer than the stream's limit is handed out in limit sized pieces rather
+    than raising
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._stream is None:
+            raise StopAsyncIteration
+        try:
+            line = await self._stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as ire:
+            line = ire.partial
+        except asyncio.LimitOverrunError as loe:
+            line = await self._stream.read(loe.consumed)
+        if not line:
+            raise StopAsyncIteration
+        return self._decoder.decode(line)
+
+
+class AsyncProcessResult(object):
+    """
+    Represents a subprocess started by AsyncCommand.
+
+    Like ProcessResult it can be compared against an int return code.  For a
+    non-blocking command, self.stdout and self.stderr are async iterators
+    yielding lines as they are produced.
+    """
+    def __init__(self, command, proc, outp=None, error=None, meta=None,
+                 logger=LOGGER):
+        self.cmd = command
+        self.proc = proc
+        self._output = outp
+        self._error = error
+        self.meta = meta
+        self.logger = logger
+
+    @property
+    def stdout(self):
+        return _LineIterator(self.proc.stdout)
+
+    @property
+    def stderr(self):
+        return _LineIterator(self.proc.stderr)
+
+    @property
+    def output(self):
+        if self._output is None:
+            return ""
+        return self._output.decode(errors="replace")
+
+    @property
+    def error(self):
+        if self._error is None:
+            return ""
+        return self._error.decode(errors="replace")
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def __bool__(self):
+        return self.returncode is not None
+
+    def __eq__(self, other):
+        return self.returncode == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    async def wait(self, timeout=None):
+        """
+        Waits for the process to finish, killing it if timeout seconds pass
+        or if the awaiting task is cancelled
+
+        :param timeout: seconds to wait, or None to wait forever
+        :return: the return code
+        """
+        try:
+            return await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.terminate()
+            msg = "{} did not finish in {} seconds".format(self.cmd.cmd,
+                                                           timeout)
+            raise CommandTimeout(msg)
+        except asyncio.CancelledError:
+            await self.terminate()
+            raise
+
+    async def communicate(self, timeout=None):
+        """
+        Reads all of stdout and stderr and waits for the process to finish,
+        killing it on timeout or cancellation
+
+        :return: tuple of (stdout, stderr) as bytes (or None if not a PIPE)
+        """
+        try:
+            out, err = await asyncio.wait_for(self.proc.communicate(),
+                                              timeout)
+        except asyncio.TimeoutError:
+            await self.terminate()
+            msg = "{} did not finish in {} seconds".format(self.cmd.cmd,
+                                                           timeout)
+            raise CommandTimeout(msg)
+        except asyncio.CancelledError:
+            await self.terminate()
+            raise
+        self._output, self._error = out, err
+        return out, err
+
+    async def terminate(self, grace=2):
+        """
+        Sends SIGTERM, and if the process has not exited after grace seconds,
+        SIGKILL
+
+        :return: the return code
+        """
+        if self.proc.returncode is not None:
+            return self.proc.returncode
+        try:
+            self.proc.terminate()
+            return await asyncio.wait_for(self.proc.wait(), grace)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            self.proc.kill()
+        return await self.proc.wait()
+
+
+class AsyncCommand(object):
+    """
+    The asyncio version of Command.  Calling an AsyncCommand object returns a
+    coroutine which must be awaited, and which yields an AsyncProcessResult
+    """
+    def __init__(self, cmd=None, user="root", logr=None, stdin=DEVNULL,
+                 stdout=PIPE, stderr=PIPE, host=None, pool=None):
+        """
+        *Args:*
+            - cmd(str|list): The command to be executed
+            - user(str): The user to run command as (if remote execution)
+            - logr(Logger): a logging.Logger instance. if None, use LOGGER
+            - stdin: defaults to DEVNULL
+            - stdout: defaults to PIPE
+            - stderr: defaults to PIPE (use STDOUT to merge into stdout)
+            - host(str): The ip or hostname to issue command to
+            - pool(SSHControlPool): if None, use the shared default_pool
+        """
+        self.cmd = cmd
+        self.user = user
+        self.host = host
+        self.inp = stdin
+        self.out = stdout
+        self.err = stderr
+        self.pool = default_pool if pool is None else pool
+        self.logger = logr if logr else LOGGER
+
+    async def _acquire(self):
+        """
+        Takes one of the pool's sessions to self.host.  The pool's semaphore
+        is acquired from an executor thread, behind a per host asyncio
+        semaphore so that waiting for a busy host ties up at most
+        max_sessions threads
+
+        :return: fn() which gives the session back
+        """
+        sem = _host_semaphore(self.pool, self.user, self.host)
+        await sem.acquire()
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(None, self.pool.acquire, self.user,
+                                   self.host)
+        try:
+            await asyncio.shield(fut)
+        except BaseException:
+            def late_release(f):
+                if not f.cancelled() and f.exception() is None:
+                    self.pool.release(self.user, self.host)
+            # the executor thread may still get the session after we gave up
+            fut.add_done_callback(late_release)
+            sem.release()
+            raise
+
+        def release():
+            self.pool.release(self.user, self.host)
+            sem.release()
+        return release
+
+    def _tokens(self, remote):
+        if isinstance(self.cmd, str):
+            toks = shlex.split(self.cmd)
+        else:
+            toks = list(self.cmd)
+        if self.host and remote:
+            toks = self.pool.ssh_args(self.user, self.host) + toks
+        return toks
+
+    async def _start(self, toks, limit):
+        return await asyncio.create_subprocess_exec(*toks, stdin=self.inp,
+                                                    stdout=self.out,
+                                                    stderr=self.err,
+                                                    limit=limit)
+
+    async def __call__(self, cmd=None, showout=True, showerr=True, block=True,
+                       checkresult=(True, 0), throws=True, remote=True,
+                       timeout=None, limit=2 ** 20):
+        """
+        Starts the subprocess
+
+        *Args:*
+            - cmd(str|list): the command and arguments to run
+            - showout(bool): log stdout (blocking only)
+            - showerr(bool): log stderr (blocking only)
+            - block(bool): if True, wait for the process and collect its
+                           output, otherwise return as soon as it started
+            - checkresult((bool,int)): whether to check the return code, and
+                                       the return code for success
+            - throws(bool): raise CommandException if the check fails
+            - remote(bool): if False, run locally even if self.host is set
+            - timeout: seconds to wait (blocking only).  The process is
+                       killed if it takes longer, and CommandTimeout raised
+            - limit(int): buffer limit of the line iterators.  Longer lines
+                          are yielded in pieces of at most this size
+
+        *Return*
+            An AsyncProcessResult object
+        """
+        if not cmd and not self.cmd:
+            raise CommandException("Must have a command to execute")
+        if cmd:
+            self.cmd = cmd
+
+        toks = self._tokens(remote)
+        self.logger.debug("cmd_toks = {}".format(toks))
+        meta = {"cmd": toks, "block": block, "checkresult": checkresult}
+        if not block:
+            proc = await self._start(toks, limit)
+            if self.host and remote:
+                self.pool.pin(self.user, self.host, proc)
+            return AsyncProcessResult(self, proc, meta=meta,
+                                      logger=self.logger)
+
+        # like Command, only blocking commands count against the per host
+        # session limit
+        release = None
+        if self.host and remote:
+            release = await self._acquire()
+        try:
+            proc = await self._start(toks, limit)
+            result = AsyncProcessResult(self, proc, meta=meta,
+                                        logger=self.logger)
+            out, err = await result.communicate(timeout=timeout)
+        finally:
+            if release is not None:
+                release()
+        if showout and out:
+            self.logger.info(result.output)
+        if showerr and err:
+            self.logger.error(result.error)
+
+        if checkresult[0] and proc.returncode != checkresult[1]:
+            self.logger.debug("ReturnCode: {}".format(proc.returncode))
+            self.logger.debug("stderr: {}".format(result.error))
+            if throws:
+                msg = "Command failed with return code {}"
+                raise CommandException(msg.format(proc.returncode))
+        return result
+
+
+async def run_on_hosts(cmd, hosts, user="root", limit=100, pool=None,
+                       **kwds):
+    """
+    Runs cmd on every host from one event loop, with at most limit commands
+    in flight at a time (and at most the pool's max_sessions per host).
+    Exceptions are returned in place of a result rather than raised, so one
+    bad host does not stop the others
+
+    :param cmd: (str) the command to run
+    :param hosts: sequence of hosts
+    :param limit: (int) max concurrent commands
+    :param pool: (SSHControlPool) if None, use the shared default_pool
+    :param kwds: passed through to AsyncCommand.__call__
+    :return: OrderedDict of host -> AsyncProcessResult or Exception
+    """
+    sem = asyncio.Semaphore(limit)
+
+    async def run(host):
+        async with sem:
+            acmd = AsyncCommand(cmd, user=user, host=host, pool=pool)
+            return await acmd(**kwds)
+
+    hosts = list(hosts)
+    results = await asyncio.gather(*[run(h) for h in hosts],
+                                   return_exceptions=True)
+    return OrderedDict(zip(hosts, results))
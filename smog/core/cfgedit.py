@@ -0,0 +1,345 @@
+"""
+Edits INI-like config files (nova.conf, libvirtd.conf, sysconfig files...) in
+a single pass, keeping every comment and blank line.
+
+set_cfg rewrites the whole file (and its backup) for every key it changes.
+ConfigFile instead parses the file once into a list of lines, with an index of
+where each (section, key) is, applies any number of edits to that, and
+edit_file writes the result back once, atomically.
+
+An edit is a dict, so that a batch of them can be sent as JSON::
+
+    {"op": "set", "key": "vncserver_listen", "value": "0.0.0.0",
+     "section": "DEFAULT", "not_found": "append", "delim": None}
+
+- set: the first occurrence of key (even a commented out one, which is
+  uncommented) gets the value, and any other active occurrences are removed.
+  not_found is what to do when the key is missing: "append" (the default)
+  adds it at the end of its section (creating the section if need be),
+  "ignore" does nothing and "fail" raises ConfigEditError.  delim replaces
+  the delimiter found in the file ("strip" removes the spaces around it)
+- append: adds another key = value line, even if key is already set
+- delete: removes the active occurrences of key (or comments them out, if
+  "comment" is True)
+
+This module only uses the standard library and runs on python 2.6+ and 3, so
+that it can also be run on a remote host: smog.core.remote_edit sends its
+source, followed by a call to run_request, to "python -" over ssh.
+
+Usage::
+
+    from smog.core.cfgedit import edit_file
+
+    edit_file("/etc/nova/nova.conf",
+              [{"op": "set", "key": "live_migration_flag",
+                "value": "VIR_MIGRATE_UNDEFINE_SOURCE,VIR_MIGRATE_PEER2PEER",
+                "section": "libvirt"},
+               {"op": "delete", "key": "vnc_enabled"}],
+              backup="/etc/nova/nova.conf.bak")
+"""
+
+__author__ = 'stoner'
+
+import difflib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+# Marks the line of output holding the JSON reply of run_request
+REPLY_MARKER = "@@cfgedit-reply@@"
+
+SECTION_PATTERN = re.compile(r"^\s*\[([^\]]+)\]")
+KEY_PATTERN = re.compile(r"^(\s*#\s*)?\s*([^\s=:#\[;][^=:]*?)(\s*[=:]\s*)(.*?)"
+                         r"(\r?\n)?$")
+
+
+class ConfigEditError(Exception):
+    pass
+
+
+class Line(object):
+    """
+    One physical line of a config file.  kind is "section", "key",
+    "commented" (a commented out key), or "other" (comments, blank lines...)
+    """
+    __slots__ = ("text", "kind", "section", "key", "delim", "value")
+
+    def __init__(self, text, section=None):
+        self.text = text
+        self.section = section
+        self.key = self.delim = self.value = None
+        m = SECTION_PATTERN.match(text)
+        if m:
+            self.kind = "section"
+            self.section = m.group(1).strip()
+            return
+        m = KEY_PATTERN.match(text)
+        if m:
+            comment, self.key, self.delim, self.value, _ = m.groups()
+            self.kind = "key" if comment is None else "commented"
+        else:
+            self.kind = "other"
+
+    @classmethod
+    def make(cls, key, value, delim="=", section=None):
+        return cls("{0}{1}{2}\n".format(key, delim, value), section=section)
+
+
+class ConfigFile(object):
+    """
+    A parsed config file, which can be edited and turned back into text
+    """
+    def __init__(self, text=""):
+        self.lines = []
+        section = None
+        for raw in text.splitlines(True):
+            line = Line(raw, section)
+            section = line.section
+            self.lines.append(line)
+        self.changes = 0
+        self._index = None
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "r") as cfg:
+            return cls(cfg.read())
+
+    def text(self):
+        return "".join(line.text for line in self.lines)
+
+    def _build_index(self):
+        """
+        :return: dict of (section, key) -> list of line numbers, for both
+                 active and commented out keys
+        """
+        if self._index is None:
+            index = {}
+            for i, line in enumerate(self.lines):
+                if line.key is not None:
+                    index.setdefault((line.section, line.key), []).append(i)
+                    index.setdefault((None, line.key), []).append(i)
+            self._index = index
+        return self._index
+
+    def _positions(self, key, section=None):
+        positions = self._build_index().get((section, key), [])
+        if section is None:
+            # (None, key) also holds keys which are in a section; keep each
+            # line once
+            positions = sorted(set(positions))
+        return positions
+
+    def get(self, key, section=None):
+        """
+        :return: list of the values of the active occurrences of key
+        """
+        return [self.lines[i].value for i in self._positions(key, section)
+                if self.lines[i].kind == "key"]
+
+    def _section_end(self, section):
+        """
+        :return: the index just past the last key (or commented out key) of
+                 section, or None if there is no such section.  Comments
+                 after that usually introduce the next section
+        """
+        end = None
+        for i, line in enumerate(self.lines):
+            if line.section != section:
+                continue
+            if line.kind in ("section", "key", "commented"):
+                end = i + 1
+        return end
+
+    def _insert(self, key, value, delim, section):
+        new = Line.make(key, value, delim, section)
+        if self.lines and not self.lines[-1].text.endswith("\n"):
+            self.lines[-1].text += "\n"
+        if section is None:
+            self.lines.append(new)
+        else:
+            end = self._section_end(section)
+            if end is None:
+                self.lines.append(Line("[{0}]\n".format(section), section))
+                self.lines.append(new)
+            else:
+                self.lines.insert(end, new)
+        self._index = None
+        self.changes += 1
+
+    def set(self, key, value, section=None, not_found="append", delim=None):
+        """
+        Sets key to value.  See the module docstring
+
+        :return: True if the file changed
+        """
+        value = "" if value is None else str(value)
+        positions = self._positions(key, section)
+        active = [i for i in positions if self.lines[i].kind == "key"]
+        # prefer an active line, and otherwise uncomment the first commented
+        # out one
+        target = active[0] if active else (positions[0] if positions else None)
+        if target is None:
+            if not_found == "fail":
+                raise ConfigEditError("Could not find {0}".format(key))
+            if not_found == "append":
+                self._insert(key, value, "=" if delim in (None, "strip")
+                             else delim, section)
+                return True
+            return False
+
+        line = self.lines[target]
+        if delim == "strip":
+            new_delim = line.delim.strip()
+        else:
+            new_delim = line.delim if delim is None else delim
+        new = Line.make(key, value, new_delim, line.section)
+        changed = new.text != line.text
+        if changed:
+            self.lines[target] = new
+        dupes = [i for i in active if i != target]
+        for i in reversed(dupes):
+            del self.lines[i]
+        if changed or dupes:
+            self._index = None
+            self.changes += 1
+        return changed or bool(dupes)
+
+    def append(self, key, value, section=None, delim=None):
+        """
+        Adds a key = value line, whether or not key is already set
+        """
+        value = "" if value is None else str(value)
+        self._insert(key, value, "=" if delim is None else delim, section)
+        return True
+
+    def delete(self, key, section=None, comment=False):
+        """
+        Removes (or comments out) every active occurrence of key
+
+        :return: True if the file changed
+        """
+        active = [i for i in self._positions(key, section)
+                  if self.lines[i].kind == "key"]
+        for i in reversed(active):
+            if comment:
+                self.lines[i] = Line("#" + self.lines[i].text,
+                                     self.lines[i].section)
+            else:
+                del self.lines[i]
+        if active:
+            self._index = None
+            self.changes += 1
+        return bool(active)
+
+    def apply(self, edits):
+        """
+        Applies a batch of edits (see the module docstring)
+
+        :return: number of edits which changed something
+        """
+        changed = 0
+        for edit in edits:
+            edit = dict(edit)
+            op = edit.pop("op", "set")
+            if op not in ("set", "append", "delete"):
+                raise ConfigEditError("Unknown edit {0}".format(op))
+            if getattr(self, op)(**edit):
+                changed += 1
+        return changed
+
+
+def write_atomic(path, text):
+    """
+    Writes text to a temporary file next to path, and renames it over path,
+    keeping the mode of path
+    """
+    dirname = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".cfgedit")
+    try:
+        with os.fdopen(fd, "w") as tmp_f:
+            tmp_f.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def edit_file(path, edits, backup=None, keep_original=False):
+    """
+    Reads path once, applies edits, and (if anything changed) writes it back
+    once, atomically
+
+    :param path: (str) the config file
+    :param edits: list of edit dicts (see the module docstring)
+    :param backup: (str) if given, the original contents are copied here
+    :param keep_original: (bool) also keep the very first version of the file
+                          in path + ".orig", if that does not exist yet
+    :return: the edited ConfigFile
+    """
+    with open(path, "r") as cfg:
+        text = cfg.read()
+    config = ConfigFile(text)
+    config.apply(edits)
+
+    if keep_original and not os.path.exists(path + ".orig"):
+        write_atomic(path + ".orig", text)
+    if backup is not None:
+        write_atomic(backup, text)
+    if config.changes:
+        write_atomic(path, config.text())
+    return config
+
+
+def diff(before, after, path="config"):
+    """
+    :return: (str) unified diff between two versions of a file
+    """
+    return "".join(difflib.unified_diff(before.splitlines(True),
+                                        after.splitlines(True),
+                                        "a/" + path.lstrip("/"),
+                                        "b/" + path.lstrip("/")))
+
+
+def run_request(request, out=None):
+    """
+    Applies the edits described by a JSON request to a local file, and writes
+    the JSON reply (after REPLY_MARKER) to out.  This is what runs on the
+    remote host
+
+    The request is a dict with path and edits, and optionally backup,
+    keep_original, dry_run (only compute the diff), and get (list of
+    [key, section] whose values to return, after the edits).  The reply has
+    changes, diff and values (the list of values of each of get), or error
+    """
+    out = sys.stdout if out is None else out
+    if not isinstance(request, dict):
+        request = json.loads(request)
+    path = request["path"]
+    try:
+        with open(path, "r") as cfg:
+            text = cfg.read()
+        config = ConfigFile(text)
+        config.apply(request.get("edits", []))
+        new_text = config.text()
+        if config.changes and not request.get("dry_run"):
+            if request.get("keep_original") and \
+                    not os.path.exists(path + ".orig"):
+                write_atomic(path + ".orig", text)
+            if request.get("backup"):
+                write_atomic(request["backup"], text)
+            write_atomic(path, new_text)
+        values = [config.get(key, section)
+                  for key, section in request.get("get", [])]
+        reply = {"changes": config.changes, "values": values,
+                 "diff": diff(text, new_text, path)}
+    except (IOError, OSError, ConfigEditError) as ex:
+        reply = {"error": "{0}: {1}".format(type(ex).__name__, ex)}
+    out.write(REPLY_MARKER + json.dumps(reply) + "\n")
+    out.flush()
+    return reply
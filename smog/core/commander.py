@@ -1,16 +1,24 @@
 __author__ = "Sean Toner"
 
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
 import threading
 import os
+import signal
 import shlex
+import time
+import re
+import uuid
+import weakref
 from functools import wraps
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 try:
     import queue
 except ImportError:
     import Queue as queue
 
 from smog.core.logger import glob_logger as LOGGER
+from smog.core.sshpool import default_pool
 
 LOG_DIR = "logs"
 if not os.path.exists("logs"):
@@ -44,7 +52,8 @@ def write_sysinfo(path, val):
         return sysinfo.read()
 
 
-def freader(fobj, monitor=None, save=None, showout=True, proc=None):
+def freader(fobj, monitor=None, save=None, showout=True, proc=None,
+            chunk_size=None):
     """
     Small function which can be thrown into a thread to read a long running
     subprocess
@@ -53,7 +62,16 @@ def freader(fobj, monitor=None, save=None, showout=True, proc=None):
     :param monitor: A Queue object
     :param interval: polling interval between reads
     :param save: (list) by default dont save, otherwise append output to this
+    :param chunk_size: (int) if given, read chunks of up to chunk_size bytes
+                       as soon as they are available rather than whole lines.
+                       If save is a bounded Queue, a full queue blocks the
+                       reader (and so throttles the process)
     """
+    if chunk_size is None:
+        read = fobj.readline
+    else:
+        read1 = getattr(fobj, "read1", fobj.read)
+        read = lambda: read1(chunk_size)
     while not fobj.closed:
         if proc is not None:
             if proc.poll() is not None:
@@ -66,7 +84,7 @@ def freader(fobj, monitor=None, save=None, showout=True, proc=None):
             pass
         except AttributeError:
             pass
-        line = fobj.readline()  # blocks when nothing in fobj buffer
+        line = read()  # blocks when nothing in fobj buffer
         if line and showout:
             LOGGER.info(line.strip())
         if save is not None:
@@ -77,6 +95,189 @@ def creader(cobj, interval=0.2, save=None):
     freader(cobj.proc.stdout, save=save)
 
 
+class OutputBuffer(object):
+    """
+    A file-like sink for process output which acts as a ring buffer: if
+    max_bytes or max_lines is given, only the tail of what was written is kept
+    in memory.  If spill is given, everything written is also appended to that
+    file, so the full output is still available on disk.
+    """
+    def __init__(self, max_bytes=None, max_lines=None, spill=None):
+        """
+        :param max_bytes: (int) keep at most the last max_bytes bytes
+        :param max_lines: (int) keep at most the last max_lines complete lines
+                          (plus any trailing partial line)
+        :param spill: (str) path of a file to append all output to
+        """
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.spill = spill
+        self.dropped = 0
+        self._chunks = []
+        self._size = 0
+        self._newlines = 0
+        self._spill_fh = None
+        self._lock = threading.Lock()
+
+    def _drop_head(self, nbytes):
+        head = self._chunks[0]
+        self._newlines -= head.count(b"\n", 0, nbytes)
+        if nbytes >= len(head):
+            self._chunks.pop(0)
+        else:
+            self._chunks[0] = head[nbytes:]
+        self._size -= nbytes
+        self.dropped += nbytes
+
+    def write(self, data):
+        with self._lock:
+            if self.spill is not None:
+                if self._spill_fh is None:
+                    self._spill_fh = open(self.spill, "ab")
+                self._spill_fh.write(data)
+            self._chunks.append(data)
+            self._size += len(data)
+            self._newlines += data.count(b"\n")
+            if self.max_bytes is not None:
+                while self._size > self.max_bytes:
+                    extra = self._size - self.max_bytes
+                    self._drop_head(min(extra, len(self._chunks[0])))
+            if self.max_lines is not None:
+                while self._newlines > self.max_lines:
+                    idx = self._chunks[0].find(b"\n")
+                    if idx < 0:
+                        self._drop_head(len(self._chunks[0]))
+                    else:
+                        self._drop_head(idx + 1)
+
+    @property
+    def truncated(self):
+        return self.dropped > 0
+
+    def getvalue(self):
+        with self._lock:
+            return b"".join(self._chunks)
+
+    def lines(self):
+        return self.getvalue().splitlines()
+
+    def flush(self):
+        with self._lock:
+            if self._spill_fh is not None:
+                self._spill_fh.flush()
+
+    def close(self):
+        with self._lock:
+            if self._spill_fh is not None:
+                self._spill_fh.close()
+                self._spill_fh = None
+
+
+class QueueSink(object):
+    """
+    A file-like sink which puts each chunk written to it on a bounded queue.
+
+    When the queue is full, the backpressure policy decides what happens:
+
+    - "block": write() blocks until a consumer takes something off the queue.
+      The reader then stops reading, the pipe fills up, and the process
+      itself is throttled down to the speed of the consumer
+    - "drop": the oldest chunk in the queue is thrown away to make room, so
+      the process is never slowed down but a slow consumer loses data
+    """
+    def __init__(self, que, backpressure="block"):
+        if backpressure not in ("block", "drop"):
+            raise ValueError("backpressure must be 'block' or 'drop'")
+        self.que = que
+        self.backpressure = backpressure
+        self.dropped = 0
+
+    def write(self, data):
+        if self.backpressure == "block":
+            self.que.put(data)
+            return
+        while True:
+            try:
+                self.que.put_nowait(data)
+                return
+            except queue.Full:
+                try:
+                    self.que.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class Tee(object):
+    """
+    Writes to several sinks at once
+    """
+    def __init__(self, *sinks):
+        self.sinks = [s for s in sinks if s is not None]
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+
+def spill_path(name="cmd"):
+    """
+    :return: a unique path under LOG_DIR to spill output to
+    """
+    fname = "{}-{}-{}.log".format(name, os.getpid(), int(time.time() * 1000))
+    return os.path.join(LOG_DIR, fname)
+
+
+def drain(fobj, sink, chunk_size=65536):
+    """
+    Reads from fobj in chunks of up to chunk_size bytes, writing them to sink,
+    until EOF.  Unlike readline(), this returns data as soon as it is
+    available, even when it has no newline.
+
+    :param fobj: a binary file object (eg Popen.stdout)
+    :param sink: object with a write() method
+    """
+    read = getattr(fobj, "read1", fobj.read)
+    while True:
+        try:
+            chunk = read(chunk_size)
+        except (OSError, ValueError):
+            # the pipe was closed under us
+            break
+        if not chunk:
+            break
+        sink.write(chunk)
+
+
+def kill_process(proc, grace=2, logger=LOGGER):
+    """
+    Sends SIGTERM to proc (or its process group, if it leads one), then
+    SIGKILL if it is still alive after grace seconds
+
+    :param proc: a Popen object
+    :return: the returncode
+    """
+    def signal_proc(sig):
+        try:
+            if os.getpgid(proc.pid) == proc.pid:
+                os.killpg(proc.pid, sig)
+            else:
+                os.kill(proc.pid, sig)
+        except OSError:
+            # already gone
+            pass
+
+    if proc.poll() is not None:
+        return proc.returncode
+    logger.warning("Killing pid {}".format(proc.pid))
+    signal_proc(signal.SIGTERM)
+    try:
+        return proc.wait(timeout=grace)
+    except TimeoutExpired:
+        signal_proc(signal.SIGKILL)
+        return proc.wait()
+
+
 class Result:
     """A simple way of declaring a result from an operation"""
     def __init__(self, rc, msg="", data=None):
@@ -141,11 +342,14 @@ class ProcessResult:
         self.proc = command.proc
         self._output = outp
         self._error = error
+        self.meta = {} if meta is None else meta
         self._rdr_thr = None
         self._returncode = self.proc.poll()
         self.block_read = False
         self.thread_mon = queue.Queue(maxsize=1)
         self.output_queue = queue.Queue()
+        self.queue_sink = None
+        self._capture = None
 
     def __nonzero__(self):
         """
@@ -191,9 +395,61 @@ class ProcessResult:
             # TODO: no self.proc.stdout, check if self.proc is a file handle
             raise ae
 
+    def capture(self, max_bytes=None, max_lines=None, spill=None,
+                queue_size=0, backpressure="block", chunk_size=65536):
+        """
+        Starts reading stdout of a running (non-blocking) process in chunks
+        into a bounded ring buffer, rather than line by line into the
+        unbounded output_queue.  Once called, self.output returns the contents
+        of the ring buffer.
+
+        :param max_bytes: (int) keep only the last max_bytes of output
+        :param max_lines: (int) keep only the last max_lines of output
+        :param spill: (str|bool) path to append all of the output to, or True
+                      to spill to a new file under LOG_DIR
+        :param queue_size: (int) if non-zero, chunks are also put on
+                           self.output_queue, which is replaced by a Queue of
+                           at most queue_size chunks
+        :param backpressure: "block" or "drop", what to do when output_queue
+                             is full (see QueueSink)
+        :param chunk_size: (int) max bytes per read
+        :return: the OutputBuffer
+        """
+        if self._capture is not None:
+            return self._capture
+        if spill is True:
+            spill = spill_path("capture")
+        buf = OutputBuffer(max_bytes=max_bytes, max_lines=max_lines,
+                           spill=spill)
+        sink = buf
+        if queue_size:
+            self.output_queue = queue.Queue(maxsize=queue_size)
+            self.queue_sink = QueueSink(self.output_queue, backpressure)
+            sink = Tee(buf, self.queue_sink)
+
+        fobj = self._check_filehandle()
+
+        def reader():
+            try:
+                drain(fobj, sink, chunk_size=chunk_size)
+            finally:
+                buf.close()
+
+        thr = threading.Thread(target=reader, name="capture")
+        thr.daemon = True
+        thr.start()
+        self._rdr_thr = thr
+        self._capture = buf
+        return buf
+
     @property
     @stringify
     def output(self):
+        if self._capture is not None:
+            if self.block_read or self.proc.poll() is not None:
+                self._rdr_thr.join()
+            return self._capture.getvalue()
+
         if self._output:
             return self._output
 
@@ -222,6 +478,15 @@ class ProcessResult:
     def output(self, val):
         self.logger.error("output is read-only. Not setting to {}".format(val))
 
+    @property
+    @stringify
+    def error(self):
+        """
+        The stderr of a blocking command (None if stderr was not a PIPE, eg
+        when it was merged into stdout)
+        """
+        return self._error
+
     @property
     def returncode(self):
         self._returncode = self.proc.poll()
@@ -234,6 +499,119 @@ class CommandException(Exception):
         self.msg = msg
 
 
+class CommandTimeout(CommandException):
+    """
+    Raised when a command did not finish within its timeout (the process is
+    killed before this is raised)
+    """
+    pass
+
+
+class CommandCache(object):
+    """
+    A TTL and LRU bounded cache of the results of read-only commands, keyed by
+    (host, user, cmd).  Commands opt into it with Command(cache=...).
+
+    Since the cache can not know what a command does, any call of a Command
+    which is *not* using a cache invalidates every cached entry for the same
+    host (in every CommandCache), on the assumption that it may have changed
+    something.  invalidate() can also be called explicitly.
+
+    Usage::
+
+        lsmod = Command("lsmod", host=host, cache=True)
+        lsmod()  # runs over ssh
+        lsmod()  # cached
+        Command("modprobe kvm_intel", host=host)()  # invalidates host
+        print(default_cache.stats())
+    """
+    _caches = weakref.WeakSet()
+
+    def __init__(self, ttl=30, max_entries=256):
+        """
+        :param ttl: (int) default seconds an entry is valid for
+        :param max_entries: (int) when exceeded, the least recently used
+                            entry is evicted
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        CommandCache._caches.add(self)
+
+    @staticmethod
+    def key(host, user, cmd):
+        if isinstance(cmd, (list, tuple)):
+            cmd = " ".join(cmd)
+        return host, user, cmd
+
+    def get(self, key):
+        """
+        :return: the cached ProcessResult, or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, host, user=None, cmd=None):
+        """
+        Removes the entries for host (None for local commands), optionally
+        only those for user and/or cmd
+
+        :return: number of entries removed
+        """
+        if cmd is not None:
+            cmd = self.key(host, user, cmd)[2]
+        with self._lock:
+            keys = [k for k in self._entries
+                    if k[0] == host and user in (None, k[1]) and
+                    cmd in (None, k[2])]
+            for k in keys:
+                del self._entries[k]
+        return len(keys)
+
+    @classmethod
+    def invalidate_all(cls, host):
+        """
+        Invalidates host in every CommandCache
+        """
+        for cache in list(cls._caches):
+            cache.invalidate(host)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries)}
+
+
+default_cache = CommandCache()
+
+
 class Command(object):
     """
     A class to handle executing subprocesses.  
@@ -243,7 +621,8 @@ class Command(object):
     block (waiting for the subprocess to return) or not.
     """
     def __init__(self, cmd=None, user="root", pw="", logr=None, stdin=PIPE,
-                 stdout=PIPE, stderr=STDOUT, saveout=True, host=None):
+                 stdout=PIPE, stderr=STDOUT, saveout=True, host=None,
+                 pool=None, cache=None, cache_ttl=None):
         """
         *Args:*
             - cmd(str|list): The command to be executed, either in string or
@@ -254,6 +633,15 @@ class Command(object):
             - stdout(file-like): default uses PIPE, but can be file-like object
             - stderr(file-like): same as stdout
             - hosts(str): The ip or hostname to issue command to
+            - pool(SSHControlPool): the pool of ssh sessions used for remote
+                                    execution.  If None, use the shared
+                                    smog.core.sshpool.default_pool
+            - cache(CommandCache|bool): if given, results of blocking calls
+                                        are cached.  True uses the shared
+                                        default_cache.  Only use this for
+                                        read-only commands
+            - cache_ttl(int): seconds a cached result is valid for.  If None,
+                              use the ttl of the cache
 
         PreCondition:  If using remote execution, the public key must have been
         copied to the remote machine for passwordless authentication
@@ -267,6 +655,9 @@ class Command(object):
         self.user = user
         self.host = host
         self.saveout = saveout
+        self.pool = default_pool if pool is None else pool
+        self.cache = default_cache if cache is True else cache or None
+        self.cache_ttl = cache_ttl
         if logr:
             self.logger = logr
         else:
@@ -281,6 +672,11 @@ class Command(object):
                  throws=True,
                  remote=True,
                  timeout=None,
+                 max_output=None,
+                 max_lines=None,
+                 spill=None,
+                 kill_grace=2,
+                 input=None,
                  **kwds):
         """
         This is a wrapper around subprocess.Popen constructor.  The **kwds
@@ -301,7 +697,21 @@ class Command(object):
             - remote(bool): When False, even if self.hosts is not None, don't
                             execute remotely.
             - timeout: An optional timeout in seconds to wait for result.  If
-                       None, there is no timeout.  Only valid if block is True
+                       None, there is no timeout.  Only valid if block is True.
+                       If the process takes longer it (and its process group)
+                       is killed, and CommandTimeout raised if throws is True
+            - max_output(int): if not None, only the last max_output bytes of
+                               stdout and stderr are kept (block only)
+            - max_lines(int): if not None, only the last max_lines lines of
+                              stdout and stderr are kept (block only)
+            - spill(str|bool): path to write the full stdout to (stderr goes
+                               to path + ".err"), or True to use new files
+                               under LOG_DIR.  Lets max_output/max_lines
+                               bound memory without losing output
+            - kill_grace(int): seconds between SIGTERM and SIGKILL on timeout
+            - input(str|bytes): if not None, written to the stdin of the
+                                process (which must be a PIPE), eg a script
+                                for "python -".  Only valid if block is True
             - kwds: keyword arguments which will be passed through to the 
                     Popen() constructor
 
@@ -313,18 +723,35 @@ class Command(object):
         if cmd:
             self.cmd = cmd
 
-        if self.host and remote:
-            pre = "ssh {}@{} ".format(self.user, self.host)
-            self.cmd = pre + self.cmd
         try:
             if isinstance(self.cmd, bytes):
                 self.cmd = self.cmd.decode()
         except:
             pass
-        if isinstance(self.cmd, str):
-            cmd_toks = shlex.split(self.cmd)
+
+        is_remote = bool(self.host and remote)
+        cache_key = None
+        if self.cache is not None and block and input is None:
+            cache_key = CommandCache.key(self.host if is_remote else None,
+                                         self.user, self.cmd)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.logger.debug("Using cached result of {}".format(self.cmd))
+                self.proc = cached.proc
+                return cached
+        else:
+            # Anything not known to be read-only may have changed the host
+            CommandCache.invalidate_all(self.host if is_remote else None)
+
+        # Remote commands are multiplexed over a persistent ssh session from
+        # the pool, rather than paying for a new ssh handshake on every call
+        command = self.cmd
+        if is_remote:
+            command = self.pool.prefix(self.user, self.host) + command
+        if isinstance(command, str):
+            cmd_toks = shlex.split(command)
         else:
-            cmd_toks = self.cmd
+            cmd_toks = command
 
         kwds['stdout'] = self.out
         kwds['stderr'] = self.err
@@ -336,36 +763,45 @@ class Command(object):
 
         self.logger.debug("cmd_toks = {} type {}".format(cmd_toks, type(cmd_toks)))
 
+        timed_out = False
+        spilled = []
         if block:
-            proc = Popen(cmd_toks, **kwds)
             if timeout is not None:
-                # call in a separate thread
-                thr = threading.Thread(target=proc.communicate, name="command")
-                endtime = time.time() + timeout
-                while time.time() < endtime:
-                    if proc.poll() is None:
-                        time.sleep(1)
-                    else:
-                        break
-                else:
-                    # took too long
-                    pass
-
-                output = proc.stdout.read()
-                err = proc.stderr.read()
-            else:
-                (output, err) = proc.communicate()  # FIXME: what about input?
+                # run in its own session, so that on timeout we can kill the
+                # whole process group and not leak any grandchildren
+                kwds.setdefault("start_new_session", True)
+            if is_remote:
+                self.pool.acquire(self.user, self.host)
+            try:
+                proc = Popen(cmd_toks, **kwds)
+                waited = self._wait(proc, timeout=timeout,
+                                    max_output=max_output, max_lines=max_lines,
+                                    spill=spill, kill_grace=kill_grace,
+                                    input=input)
+                output, err, timed_out, spilled = waited
+            finally:
+                if is_remote:
+                    self.pool.release(self.user, self.host)
             if showout and output:
                 self.logger.info(output)
             if showerr and err:
                 self.logger.error(err)
         else:
             proc = Popen(cmd_toks, **kwds)
+            if is_remote:
+                # eg a journalctl -f stream: its master must outlive it
+                self.pool.pin(self.user, self.host, proc)
 
-        meta = {"cmd": self.cmd, "showout": showout, "showerr": showerr,
-                "block": block, "checkresult": checkresult, "kwds": kwds}
+        meta = {"cmd": command, "showout": showout, "showerr": showerr,
+                "block": block, "checkresult": checkresult, "kwds": kwds,
+                "timed_out": timed_out, "spilled": spilled}
 
         self.proc = proc
+        if timed_out:
+            msg = "{} did not finish in {} seconds".format(command, timeout)
+            self.logger.error(msg)
+            if throws:
+                raise CommandTimeout(msg)
         result = (proc, output, err, meta)
         proc_res = {"command": self, 
                     "outp": output,
@@ -375,7 +811,93 @@ class Command(object):
 
         if checkresult[0]:
             self.check_result(result, checkresult[1], throws=throws)
-        return ProcessResult(**proc_res)
+        proc_result = ProcessResult(**proc_res)
+        if cache_key is not None and not timed_out:
+            self.cache.put(cache_key, proc_result, ttl=self.cache_ttl)
+        return proc_result
+
+    def _wait(self, proc, timeout=None, max_output=None, max_lines=None,
+              spill=None, kill_grace=2, input=None):
+        """
+        Waits for proc to finish while draining stdout and stderr from
+        separate threads, so that neither pipe can fill up and stall the
+        process.  If timeout seconds pass, the process is killed.
+
+        *Args:*
+            - proc(Popen): the process to wait on
+            - timeout: seconds to wait, or None to wait forever
+            - max_output(int): bytes to keep per stream, None for all
+            - max_lines(int): lines to keep per stream, None for all
+            - spill(str|bool): see __call__
+            - kill_grace(int): seconds between SIGTERM and SIGKILL
+            - input(str|bytes): written to the stdin of proc before it is
+                                closed
+
+        *Return*
+            tuple of (stdout, stderr, timed_out, spilled).  stdout and stderr
+            are bytes, or None if they were not a PIPE.  spilled is the list
+            of files output was spilled to
+        """
+        bufs = {}
+        drainers = []
+        for name in ("stdout", "stderr"):
+            fobj = getattr(proc, name)
+            if fobj is None:
+                bufs[name] = None
+                continue
+            if spill is True:
+                path = spill_path(name)
+            elif spill:
+                path = spill if name == "stdout" else spill + ".err"
+            else:
+                path = None
+            bufs[name] = OutputBuffer(max_bytes=max_output,
+                                      max_lines=max_lines, spill=path)
+            thr = threading.Thread(target=drain, args=(fobj, bufs[name]),
+                                   name="drain-{}".format(name))
+            thr.daemon = True
+            thr.start()
+            drainers.append(thr)
+
+        # Write any input (the drainers are already running, so the process
+        # can't block on a full stdout), then close stdin like communicate()
+        if proc.stdin:
+            try:
+                if input is not None:
+                    if not isinstance(input, bytes):
+                        input = input.encode()
+                    proc.stdin.write(input)
+                proc.stdin.close()
+            except (OSError, ValueError):
+                # BrokenPipeError: the process exited without reading it all
+                pass
+
+        timed_out = False
+        try:
+            proc.wait(timeout=timeout)
+        except TimeoutExpired:
+            timed_out = True
+            kill_process(proc, grace=kill_grace, logger=self.logger)
+
+        for thr in drainers:
+            # Something that inherited the pipe may hold it open even after
+            # proc exits, so don't wait on the drainers forever
+            thr.join(None if not timed_out else kill_grace)
+        for name in ("stdout", "stderr"):
+            fobj = getattr(proc, name)
+            if fobj is not None:
+                try:
+                    fobj.close()
+                except (OSError, ValueError):
+                    pass
+            if bufs[name] is not None:
+                bufs[name].close()
+
+        output, err = [None if bufs[n] is None else bufs[n].getvalue()
+                       for n in ("stdout", "stderr")]
+        spilled = [bufs[n].spill for n in ("stdout", "stderr")
+                   if bufs[n] is not None and bufs[n].spill]
+        return output, err, timed_out, spilled
 
     def check_result(self, result, success=0, throws=False):
         """
@@ -449,6 +971,264 @@ class Command(object):
 
         return CommandProxy(handler, *args, **kwds)
 
+class FanOutException(CommandException):
+    """
+    Raised by fan_out when throws=True and one or more hosts failed.  The
+    per host results (including the successful ones) are in self.results
+    """
+    def __init__(self, msg="", results=None):
+        super(FanOutException, self).__init__(msg)
+        self.results = results
+
+
+class HostResult(object):
+    """
+    The outcome of calling a function for one host in fan_out
+    """
+    def __init__(self, host, value=None, error=None, elapsed=0.0,
+                 skipped=False):
+        """
+        Args:
+          - host(str): the host the function was called for
+          - value(any): what the function returned
+          - error(Exception): the exception raised, if any
+          - elapsed(float): wall clock seconds the call took
+          - skipped(bool): True if the host was never run (see max_failures)
+        """
+        self.host = host
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        """
+        True if the call did not raise, was not skipped, and (if the value is
+        a ProcessResult) the return code was 0
+        """
+        if self.skipped or self.error is not None:
+            return False
+        if isinstance(self.value, ProcessResult):
+            return self.value == 0
+        return True
+
+    def __repr__(self):
+        state = "ok" if self.ok else ("skipped" if self.skipped else "failed")
+        return "<HostResult {} {} {:.3f}s>".format(self.host, state,
+                                                   self.elapsed)
+
+
+def fan_out(fn, hosts, max_workers=10, batch_size=None, max_failures=None,
+            throws=False, logger=LOGGER):
+    """
+    Calls fn(host) for every host in a bounded thread pool, and collects a
+    HostResult for each one.  An exception from one host does not stop the
+    others; it is recorded in that host's HostResult.error
+
+    If batch_size is given, the hosts are done as a rolling update: batch_size
+    hosts at a time, and each batch must finish before the next one starts.
+    If max_failures is also given, no new batch is started once that many
+    hosts have failed, and the remaining hosts are marked as skipped.
+
+    Usage::
+
+        def restart(host):
+            return Command("openstack-service restart nova", host=host)()
+
+        results = fan_out(restart, computes, batch_size=2, max_failures=1)
+        failed = [h for h, r in results.items() if not r.ok]
+
+    :param fn: a callable that takes a host as its only argument
+    :param hosts: a sequence of hosts
+    :param max_workers: (int) max number of hosts being worked on at once
+    :param batch_size: (int) if not None, do a rolling update in batches
+    :param max_failures: (int) in rolling mode, stop after this many failures
+    :param throws: if True, raise FanOutException after all hosts are done if
+                   any of them failed
+    :return: an OrderedDict of host -> HostResult in the same order as hosts
+    """
+    hosts = list(hosts)
+    results = OrderedDict((h, None) for h in hosts)
+
+    def timed(host):
+        start = time.time()
+        try:
+            value = fn(host)
+        except Exception as ex:
+            logger.error("{} failed on {}: {}".format(fn, host, ex))
+            return HostResult(host, error=ex, elapsed=time.time() - start)
+        return HostResult(host, value=value, elapsed=time.time() - start)
+
+    if batch_size is None:
+        batches = [hosts]
+    else:
+        batches = [hosts[i:i + batch_size]
+                   for i in range(0, len(hosts), batch_size)]
+
+    failures = 0
+    workers = max(1, min(max_workers, len(hosts) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batches:
+            if max_failures is not None and failures >= max_failures:
+                for host in batch:
+                    results[host] = HostResult(host, skipped=True)
+                continue
+            for res in pool.map(timed, batch):
+                results[res.host] = res
+                if not res.ok:
+                    failures += 1
+
+    if throws and failures:
+        failed = [h for h, r in results.items() if not r.ok]
+        raise FanOutException("Failed on hosts: {}".format(failed), results)
+    return results
+
+
+def run_on_hosts(cmd, hosts, user="root", max_workers=10, batch_size=None,
+                 max_failures=None, throws=False, **kwds):
+    """
+    Runs the same command on many hosts at once.  See fan_out for the meaning
+    of max_workers, batch_size, max_failures and throws
+
+    Usage::
+
+        results = run_on_hosts("openstack-service stop nova-compute", computes)
+        for host, res in results.items():
+            print(host, res.ok, res.elapsed, res.value.output)
+
+    :param cmd: (str|Command) the command to run.  If a Command object, its
+                user, stdin, stdout, stderr, pool and cache settings are
+                copied
+    :param hosts: sequence of hosts to run the command on
+    :param user: (str) user to run as, if cmd is a str
+    :param kwds: keyword args passed through to Command.__call__
+    :return: an OrderedDict of host -> HostResult, where HostResult.value is
+             the ProcessResult
+    """
+    if isinstance(cmd, Command):
+        template = cmd
+    else:
+        template = Command(cmd, user=user)
+
+    def run(host):
+        command = Command(template.cmd, user=template.user, pw=template.pw,
+                          logr=template.logger, stdin=template.inp,
+                          stdout=template.out, stderr=template.err,
+                          saveout=template.saveout, host=host,
+                          pool=template.pool, cache=template.cache,
+                          cache_ttl=template.cache_ttl)
+        return command(**kwds)
+
+    return fan_out(run, hosts, max_workers=max_workers, batch_size=batch_size,
+                   max_failures=max_failures, throws=throws)
+
+
+def shell_command(script, remote=True):
+    """
+    Wraps a shell script so that it is run by sh -c, quoting it so that it
+    survives both the local shlex.split() done by Command and, if remote, the
+    second round of word splitting done by the shell on the remote end of ssh
+
+    :param script: (str) shell script
+    :param remote: (bool) whether the command will be run over ssh
+    :return: (str) command to pass to Command
+    """
+    cmd = "sh -c {}".format(shlex.quote(script))
+    if remote:
+        cmd = shlex.quote(cmd)
+    return cmd
+
+
+FramedOutput = namedtuple("FramedOutput", ["name", "output", "returncode"])
+
+
+def frame_script(commands, marker):
+    """
+    Builds one shell script which runs every command in turn, framing the
+    (combined stdout and stderr) output of each between marker lines
+
+    :param commands: OrderedDict of name -> shell command.  names must not
+                     contain whitespace
+    :param marker: (str) a string which will not show up in the output
+    :return: (str) the script
+    """
+    lines = []
+    for name, cmd in commands.items():
+        if re.search(r"\s", name) or not name:
+            raise CommandException("Bad frame name: {!r}".format(name))
+        begin = shlex.quote("{} BEGIN {}".format(marker, name))
+        end = shlex.quote("{} END {}".format(marker, name))
+        lines.append("printf '%s\\n' {}".format(begin))
+        lines.append("( {} ) 2>&1".format(cmd))
+        lines.append("printf '\\n%s %s\\n' {} $?".format(end))
+    return "\n".join(lines) + "\n"
+
+
+def parse_frames(output, names, marker):
+    """
+    Splits the output of a script built by frame_script back up
+
+    :return: OrderedDict of name -> FramedOutput.  If a command never ran to
+             completion, its output and returncode are None
+    """
+    patt = re.compile(r"^{m} BEGIN (\S+)\n(.*?)\n{m} END \1 (\d+)$".format(
+        m=re.escape(marker)), re.S | re.M)
+    found = {m.group(1): m for m in patt.finditer(output)}
+    frames = OrderedDict()
+    for name in names:
+        m = found.get(name)
+        if m is None:
+            frames[name] = FramedOutput(name, None, None)
+        else:
+            frames[name] = FramedOutput(name, m.group(2), int(m.group(3)))
+    return frames
+
+
+def run_framed(host, commands, user="root", pool=None, **kwds):
+    """
+    Runs several commands on host in a single remote invocation (so with
+    just one ssh round trip), and returns their outputs separately.
+
+    Usage::
+
+        cmds = OrderedDict([("lsmod", "lsmod"), ("numa", "numactl -H")])
+        frames = run_framed(host, cmds)
+        if frames["numa"].returncode == 0:
+            print(frames["numa"].output)
+
+    :param host: (str) ip or hostname, or None to run locally
+    :param commands: dict of name -> shell command.  Use an OrderedDict to
+                     control the order they are run in
+    :param user: (str) user to run as
+    :param kwds: passed through to Command.__call__ (eg timeout)
+    :return: OrderedDict of name -> FramedOutput(name, output, returncode)
+    """
+    marker = "@@smog-{}@@".format(uuid.uuid4().hex)
+    script = frame_script(commands, marker)
+    cmd = Command(shell_command(script, remote=host is not None), user=user,
+                  host=host, pool=pool)
+    kwds.setdefault("showout", False)
+    kwds.setdefault("checkresult", (False, 0))
+    res = cmd(**kwds)
+    return parse_frames(res.output or "", list(commands.keys()), marker)
+
+
+def run_framed_on_hosts(hosts, commands, user="root", max_workers=10,
+                        throws=False, **kwds):
+    """
+    run_framed for many hosts in parallel, so that collecting N files from M
+    hosts costs M (concurrent) round trips rather than N * M
+
+    :return: OrderedDict of host -> HostResult, where HostResult.value is the
+             OrderedDict returned by run_framed
+    """
+    def run(host):
+        return run_framed(host, commands, user=user, **kwds)
+
+    return fan_out(run, hosts, max_workers=max_workers, throws=throws)
+
+
 # TODO: put this into a unittest
 if __name__ == "__main__":
     cmd = Command("openstack-service status keystone", host="10.35.162.37")
@@ -461,8 +1241,6 @@ if __name__ == "__main__":
     rdr_t = cmd.make_proxy(freader, res.proc.stdout, monitor=mon)
     rdr_t.daemon = True
     rdr_t.start()
-    import time
-
     time.sleep(5)
     cmd.proc.terminate()
     while res.proc.poll() is None:
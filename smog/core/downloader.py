@@ -1,16 +1,398 @@
+"""
+Downloads artifacts such as cloud images.
+
+StreamingDownloader writes the body of a download to disk a chunk at a time,
+so memory use does not depend on the size of the file.  If the server supports
+HTTP Range requests, a large file is fetched as several segments in parallel,
+and an interrupted download resumes where it stopped (the progress of each
+segment is kept next to the partial file) rather than starting over.
+
+A checksum can be given to verify the file.  It is computed while streaming
+when the file comes as a single stream, and in one pass at the end when it
+came in parallel segments.
+
+Downloads are kept in a content addressed cache: the file is stored under its
+sha256, and the url (with its size and ETag) is mapped to that digest, so an
+image which is already in the cache is never downloaded again.
+
+Usage::
+
+    from smog.core.downloader import StreamingDownloader
+
+    dl = StreamingDownloader()
+    path = dl.fetch("http://download.cirros-cloud.net/0.3.4/"
+                    "cirros-0.3.4-x86_64-disk.img",
+                    checksum="md5:ee1eca47dc88f4879d8a229cc70a07c6")
+"""
+
 try:
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request
     from urllib.parse import urlparse as urlparse
 except ImportError:
-    from urllib2 import urlopen
+    from urllib2 import urlopen, Request
     from urlparse import urlparse
 
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 
 from smog.core import commander
 from smog.core.logger import glob_logger
 from smog.core.commander import Result
 
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "smog",
+                                 "downloads")
+CHUNK_SIZE = 1 << 20
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _parse_checksum(checksum, default="sha256"):
+    """
+    :param checksum: "algo:hexdigest" or just a hexdigest
+    :return: tuple of (algo, hexdigest)
+    """
+    if checksum is None:
+        return None, None
+    algo, _, digest = checksum.rpartition(":")
+    return (algo or default).lower(), digest.lower()
+
+
+def _file_digest(path, algo, chunk_size=CHUNK_SIZE):
+    hasher = hashlib.new(algo)
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _place(src, dest):
+    """
+    Hard links src to dest (or copies it, if they are on different
+    filesystems), replacing dest
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest):
+            return dest
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+    return dest
+
+
+class StreamingDownloader(object):
+    """
+    Chunked, resumable, optionally parallel HTTP downloads with a content
+    addressed cache
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, chunk_size=CHUNK_SIZE,
+                 segments=4, min_segment=32 * CHUNK_SIZE, retries=3,
+                 timeout=60, logger=glob_logger):
+        """
+        :param cache_dir: (str) where downloads are cached, or None to not
+                          cache
+        :param chunk_size: (int) bytes read and written at a time
+        :param segments: (int) max parallel ranged requests per file
+        :param min_segment: (int) smallest segment worth its own request
+        :param retries: (int) attempts per segment before giving up
+        :param timeout: (int) socket timeout in seconds
+        """
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.min_segment = min_segment
+        self.retries = retries
+        self.timeout = timeout
+        self.logger = logger
+        self._lock = threading.Lock()
+
+    # -- HTTP ------------------------------------------------------------
+    def _head(self, url):
+        """
+        :return: tuple of (size or None, accepts ranges, etag or None)
+        """
+        try:
+            resp = urlopen(Request(url, method="HEAD"), timeout=self.timeout)
+        except Exception as ex:
+            self.logger.debug("HEAD {} failed: {}".format(url, ex))
+            return None, False, None
+        with resp:
+            size = resp.headers.get("Content-Length")
+            ranges = resp.headers.get("Accept-Ranges", "") == "bytes"
+            return (int(size) if size is not None else None, ranges,
+                    resp.headers.get("ETag"))
+
+    def _stream(self, url, fobj, start, end, state, hasher=None):
+        """
+        Writes bytes [start + state["done"], end) of url into fobj at the
+        same offsets, updating state["done"] as it goes
+
+        :param end: None to read to the end of the body
+        """
+        offset = start + state["done"]
+        headers = {}
+        if offset or end is not None:
+            rng = "bytes={}-{}".format(offset, "" if end is None else end - 1)
+            headers["Range"] = rng
+        resp = urlopen(Request(url, headers=headers), timeout=self.timeout)
+        with resp:
+            if "Range" in headers and resp.getcode() != 206:
+                if offset:
+                    raise DownloadError("{} ignored the Range header".format(
+                        url))
+            while True:
+                want = self.chunk_size
+                if end is not None:
+                    want = min(want, end - offset)
+                    if want <= 0:
+                        break
+                chunk = resp.read(want)
+                if not chunk:
+                    break
+                fobj.seek(offset)
+                fobj.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                offset += len(chunk)
+                with self._lock:
+                    state["done"] += len(chunk)
+        if end is not None and offset < end:
+            raise DownloadError("{} ended at byte {} of {}".format(url, offset,
+                                                                   end))
+
+    # -- partial download bookkeeping --------------------------------------
+    @staticmethod
+    def _load_state(state_path, size, etag):
+        try:
+            with open(state_path, "r") as state_f:
+                state = json.load(state_f)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get("size") != size or state.get("etag") != etag:
+            return None
+        return state
+
+    def _save_state(self, state_path, state):
+        with self._lock:
+            data = json.dumps(state)
+        tmp = state_path + ".tmp"
+        with open(tmp, "w") as state_f:
+            state_f.write(data)
+        os.rename(tmp, state_path)
+
+    def _plan(self, size, ranges):
+        if not size or not ranges:
+            return [[0, size, 0]]
+        count = max(1, min(self.segments, size // self.min_segment))
+        step = -(-size // count)
+        return [[s, min(s + step, size), 0] for s in range(0, size, step)]
+
+    def download(self, url, dest, checksum=None, head=None):
+        """
+        Downloads url to dest, resuming a previous partial download of it if
+        there is one (dest + ".part")
+
+        :param url: (str) http(s) url
+        :param dest: (str) path of the file to write
+        :param checksum: "algo:hexdigest" (eg "sha256:ab12..."), or None
+        :param head: the result of _head(url), if already known
+        :return: dest
+        """
+        algo, digest = _parse_checksum(checksum)
+        size, ranges, etag = self._head(url) if head is None else head
+        part = dest + ".part"
+        state_path = part + ".json"
+
+        state = self._load_state(state_path, size, etag) \
+            if os.path.exists(part) else None
+        if state is None or not ranges:
+            state = {"size": size, "etag": etag,
+                     "segments": self._plan(size, ranges)}
+            with open(part, "wb") as fobj:
+                if size:
+                    fobj.truncate(size)
+        else:
+            done = sum(seg[2] for seg in state["segments"])
+            self.logger.info("Resuming {} at {} of {} bytes".format(
+                url, done, size))
+
+        segments = [{"start": s, "end": e, "done": d}
+                    for s, e, d in state["segments"]]
+
+        def sync():
+            state["segments"] = [[seg["start"], seg["end"], seg["done"]]
+                                 for seg in segments]
+            self._save_state(state_path, state)
+
+        single = len(segments) == 1
+        hasher = hashlib.new(algo) if (algo and single) else None
+        # hashing while streaming only works if the bytes arrive in order
+        # exactly once, otherwise the file is hashed once it is complete
+        hashing = {"hasher": hasher}
+        if hasher is not None and segments[0]["done"]:
+            # hash what an earlier attempt already wrote
+            with open(part, "rb") as fobj:
+                left = segments[0]["done"]
+                while left:
+                    chunk = fobj.read(min(self.chunk_size, left))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    left -= len(chunk)
+
+        errors = []
+
+        def run(seg):
+            with open(part, "r+b") as fobj:
+                for attempt in range(self.retries):
+                    if seg["end"] is not None and \
+                            seg["start"] + seg["done"] >= seg["end"]:
+                        return
+                    try:
+                        self._stream(url, fobj, seg["start"], seg["end"], seg,
+                                     hasher=hashing["hasher"])
+                        return
+                    except Exception as ex:
+                        self.logger.error("Segment {} of {}: {}".format(
+                            seg["start"], url, ex))
+                        if not ranges:
+                            # no way to resume, so start the segment over
+                            seg["done"] = 0
+                            hashing["hasher"] = None
+                        sync()
+                        time.sleep(min(2 ** attempt, 10))
+                errors.append(seg["start"])
+
+        threads = [threading.Thread(target=run, args=(seg,))
+                   for seg in segments]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        sync()
+        if errors:
+            raise DownloadError("Could not download {} (progress saved in "
+                                "{})".format(url, part))
+
+        if algo:
+            hasher = hashing["hasher"]
+            found = hasher.hexdigest() if hasher is not None \
+                else _file_digest(part, algo, self.chunk_size)
+            if found != digest:
+                os.remove(part)
+                os.remove(state_path)
+                raise DownloadError("{} checksum of {} is {}, expected "
+                                    "{}".format(algo, url, found, digest))
+        os.rename(part, dest)
+        os.remove(state_path)
+        return dest
+
+    # -- cache ---------------------------------------------------------------
+    def _index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), "r") as index_f:
+                return json.load(index_f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _blob(self, algo, digest):
+        return os.path.join(self.cache_dir, algo, digest)
+
+    def cached(self, url, checksum=None, head=None):
+        """
+        :param head: the result of _head(url), if already known
+        :return: the path of url in the cache, or None if it isn't there
+        """
+        if self.cache_dir is None:
+            return None
+        algo, digest = _parse_checksum(checksum)
+        if digest is not None:
+            blob = self._blob(algo, digest)
+            if os.path.exists(blob):
+                return blob
+        entry = self._load_index().get(url)
+        if entry is None:
+            return None
+        blob = self._blob("sha256", entry["sha256"])
+        if not os.path.exists(blob):
+            return None
+        if digest is not None and algo == "sha256" and digest != entry["sha256"]:
+            return None
+        size, _, etag = self._head(url) if head is None else head
+        if size is not None and (size != entry.get("size") or
+                                 etag != entry.get("etag")):
+            # the file on the server has changed
+            return None
+        return blob
+
+    def fetch(self, url, checksum=None):
+        """
+        Gets url through the cache, downloading it only if it isn't there
+
+        :param checksum: optional "algo:hexdigest" to verify the download
+        :return: path of the cached file (do not modify it)
+        """
+        if self.cache_dir is None:
+            raise DownloadError("fetch needs a cache_dir")
+        head = self._head(url)
+        blob = self.cached(url, checksum, head=head)
+        if blob is not None:
+            self.logger.info("Using cached {} for {}".format(blob, url))
+            return blob
+
+        partial = os.path.join(self.cache_dir, "partial")
+        if not os.path.isdir(partial):
+            os.makedirs(partial)
+        name = hashlib.sha256(url.encode()).hexdigest()
+        path = self.download(url, os.path.join(partial, name), checksum,
+                             head=head)
+        sha = _file_digest(path, "sha256", self.chunk_size)
+
+        blob = self._blob("sha256", sha)
+        if not os.path.isdir(os.path.dirname(blob)):
+            os.makedirs(os.path.dirname(blob))
+        os.rename(path, blob)
+        algo, digest = _parse_checksum(checksum)
+        if algo is not None and algo != "sha256":
+            # also make it findable by the checksum the caller knows
+            alias = self._blob(algo, digest)
+            if not os.path.isdir(os.path.dirname(alias)):
+                os.makedirs(os.path.dirname(alias))
+            _place(blob, alias)
+
+        size, _, etag = head
+        with self._lock:
+            index = self._load_index()
+            index[url] = {"sha256": sha, "size": size, "etag": etag,
+                          "fetched": time.time()}
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".index")
+            with os.fdopen(fd, "w") as index_f:
+                json.dump(index, index_f)
+            os.rename(tmp, self._index_path())
+        return blob
+
+    def fetch_to(self, url, dest, checksum=None):
+        """
+        Gets url through the cache, and links (or copies) it to dest
+
+        :return: dest
+        """
+        return _place(self.fetch(url, checksum), dest)
+
+
+default_downloader = StreamingDownloader()
+
 
 class Downloader(object):
     """
@@ -29,29 +411,27 @@ class Downloader(object):
 
     @staticmethod
     def download_url(urlpath, output_dir=".", binary=False):
-        try:
-            thing = urlopen(urlpath)
-        except Exception as e:
-            print(str(e))
-            return
-            
+        """
+        Streams urlpath into output_dir, keeping the file name of the url.  An
+        interrupted download is resumed on the next call
+
+        :return: True if the file was downloaded, None on error
+        """
         parsed = urlparse(urlpath)
         filename = os.path.basename(parsed.path)
-        writemod = "wb" if binary else "w"
-
-        fobj = thing.read()
         if output_dir != ".":
             if not os.path.exists(output_dir):
                 glob_logger.error("{0} does not exist".format(output_dir))
                 glob_logger.error("Writing file to {0}".format(os.getcwd()))
             else:
-                filename = "/".join([output_dir,filename])
-        with open(filename, writemod) as downloaded:
-            try:
-                downloaded.write(fobj)
-            except TypeError:
-                with open(filename, "wb") as downloaded:
-                    downloaded.write(fobj)
+                filename = "/".join([output_dir, filename])
+
+        downloader = StreamingDownloader(cache_dir=None)
+        try:
+            downloader.download(urlpath, filename)
+        except Exception as e:
+            print(str(e))
+            return
         return os.path.exists(filename)
 
     def is_pip_installed(self):
@@ -0,0 +1,312 @@
+"""
+A pool of persistent libvirt connections, shared by smog.virt, NUMA and the
+Host/Instance helpers in smog.tests.base.
+
+Opening a qemu+ssh:// connection means starting an ssh tunnel and doing a
+libvirt handshake, which used to happen (and be torn down again) for every
+dumpxml or domain lookup.  The pool instead keeps one connection per
+(driver, user, host) and hands out PooledConnection proxies to it:
+
+- the proxy's close() does nothing, so existing code which closes its
+  connection keeps working without closing the shared one
+- a connection which has died (isAlive() is false, or a call fails because of
+  it) is reopened, and the call is retried once
+- libvirt keepalives are turned on, so a dead hypervisor or tunnel is noticed
+- connections are opened under a lock per (driver, user, host), so threads
+  asking for the same hypervisor at once open it only once
+- at most max_connections are kept; the least recently used one is closed
+  when another is needed, as are ones idle for longer than idle_timeout.  A
+  proxy whose connection was closed this way simply reopens it
+
+Usage::
+
+    from smog.core.libvirt_pool import default_pool
+
+    conn = default_pool.get("10.8.0.58")
+    dom = conn.lookupByUUIDString(uuid)
+    conn.close()                    # no-op, the connection stays pooled
+    default_pool.close_all()
+"""
+
+__author__ = 'stoner'
+
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+import libvirt
+
+from smog.core.logger import glob_logger
+
+_event_loop = []
+_event_lock = threading.Lock()
+
+
+def start_event_loop(logger=glob_logger):
+    """
+    Registers libvirt's default event implementation and runs it in a daemon
+    thread.  libvirt needs this to send keepalives.  Only the first call does
+    anything
+    """
+    with _event_lock:
+        if _event_loop:
+            return True
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (libvirt.libvirtError, AttributeError) as ex:
+            logger.debug("No libvirt event loop: {}".format(ex))
+            return False
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        thr = threading.Thread(target=run, name="libvirt-events")
+        thr.daemon = True
+        thr.start()
+        _event_loop.append(thr)
+        return True
+
+
+def make_uri(host, user="root", driver="qemu+ssh"):
+    """
+    :param host: (str) hypervisor, or None for the local qemu:///system
+    :return: (str) the libvirt URI
+    """
+    if host is None:
+        return "qemu:///system"
+    return "{}://{}@{}/system".format(driver, user, host)
+
+
+class _Entry(object):
+    """
+    Bookkeeping for one pooled connection
+    """
+    def __init__(self, key):
+        self.key = key
+        self.conn = None
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+        self.opens = 0
+
+
+class PooledConnection(object):
+    """
+    Stands in for a libvirt virConnect which belongs to a LibvirtPool.  Every
+    attribute comes from the pool's live connection, and close() leaves it
+    open
+    """
+    def __init__(self, pool, key):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_key", key)
+
+    @property
+    def uri(self):
+        return make_uri(self._key[2], self._key[1], self._key[0])
+
+    @property
+    def lock(self):
+        """
+        The lock of this connection, for callers which need to use it
+        exclusively for a while
+        """
+        return self._pool._entry(self._key).lock
+
+    def close(self):
+        return 0
+
+    def _call(self, name, *args, **kwargs):
+        conn = self._pool.connection(self._key)
+        try:
+            return getattr(conn, name)(*args, **kwargs)
+        except libvirt.libvirtError:
+            if self._pool.is_alive(conn):
+                raise
+            # the connection died under us: reopen it and try once more
+            conn = self._pool.reconnect(self._key)
+            return getattr(conn, name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool.connection(self._key), name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    def __setattr__(self, name, val):
+        raise AttributeError("Can't set {} on a pooled connection".format(
+            name))
+
+    def __repr__(self):
+        return "<pooled libvirt connection {}>".format(self.uri)
+
+
+class LibvirtPool(object):
+    """
+    Keeps libvirt connections open per (driver, user, host), and hands out
+    PooledConnection proxies to them
+    """
+    def __init__(self, max_connections=16, idle_timeout=600,
+                 keepalive=(5, 3), opener=None, logger=glob_logger):
+        """
+        :param max_connections: (int) connections kept open at most
+        :param idle_timeout: (int) seconds after which an unused connection
+                             is closed (see evict_idle)
+        :param keepalive: (interval, count) for virConnect.setKeepAlive, or
+                          None to not send keepalives
+        :param opener: fn(uri) -> connection.  libvirt.open if None
+        """
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.opener = libvirt.open if opener is None else opener
+        self.logger = logger
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host, user="root", driver="qemu+ssh"):
+        return driver, user, host
+
+    def get(self, host, user="root", driver="qemu+ssh"):
+        """
+        :param host: (str) ip or hostname of the hypervisor, or None for the
+                     local one
+        :return: a PooledConnection to host
+        """
+        key = self.key(host, user, driver)
+        self.connection(key)
+        return PooledConnection(self, key)
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(key)
+            self._entries.move_to_end(key)
+            entry.last_used = time.time()
+        return entry
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def _open(self, entry):
+        uri = make_uri(entry.key[2], entry.key[1], entry.key[0])
+        if self.keepalive is not None and self.opener is libvirt.open:
+            start_event_loop(self.logger)
+        self.logger.debug("Opening libvirt connection to {}".format(uri))
+        conn = self.opener(uri)
+        if conn is None:
+            raise libvirt.libvirtError("Could not connect to {}".format(uri))
+        if self.keepalive is not None:
+            try:
+                conn.setKeepAlive(*self.keepalive)
+            except libvirt.libvirtError as ex:
+                self.logger.debug("No keepalive for {}: {}".format(uri, ex))
+        entry.conn = conn
+        entry.opens += 1
+        return conn
+
+    @staticmethod
+    def _close_conn(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def connection(self, key):
+        """
+        :param key: (driver, user, host)
+        :return: the live libvirt connection for key, (re)opening it if need
+                 be
+        """
+        entry = self._entry(key)
+        with entry.lock:
+            conn = entry.conn
+            if conn is not None and not self.is_alive(conn):
+                self.logger.info("libvirt connection to {} died, "
+                                 "reconnecting".format(key[2]))
+                self._close_conn(conn)
+                conn = entry.conn = None
+            if conn is None:
+                conn = self._open(entry)
+        self._evict_lru()
+        return conn
+
+    def reconnect(self, key):
+        """
+        Closes and reopens the connection for key
+
+        :return: the new connection
+        """
+        entry = self._entry(key)
+        with entry.lock:
+            if entry.conn is not None:
+                self._close_conn(entry.conn)
+                entry.conn = None
+            return self._open(entry)
+
+    def _evict(self, keys):
+        for key in keys:
+            with self._lock:
+                entry = self._entries.pop(key, None)
+            if entry is None:
+                continue
+            with entry.lock:
+                if entry.conn is not None:
+                    self.logger.debug("Closing libvirt connection to "
+                                      "{}".format(key[2]))
+                    self._close_conn(entry.conn)
+                    entry.conn = None
+
+    def _evict_lru(self):
+        with self._lock:
+            extra = len(self._entries) - self.max_connections
+            lru = list(self._entries.keys())[:max(0, extra)]
+        self._evict(lru)
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Closes the connections which have not been used for idle_timeout
+        seconds
+
+        :return: list of the (driver, user, host) closed
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        now = time.time()
+        with self._lock:
+            idle = [key for key, entry in self._entries.items()
+                    if now - entry.last_used > idle_timeout]
+        self._evict(idle)
+        return idle
+
+    def close(self, host, user="root", driver="qemu+ssh"):
+        self._evict([self.key(host, user, driver)])
+
+    def close_all(self):
+        with self._lock:
+            keys = list(self._entries.keys())
+        self._evict(keys)
+
+    def stats(self):
+        """
+        :return: dict of uri -> {"opens": int, "idle": seconds}
+        """
+        now = time.time()
+        with self._lock:
+            return {make_uri(h, u, d): {"opens": e.opens,
+                                        "idle": now - e.last_used}
+                    for (d, u, h), e in self._entries.items()}
+
+
+default_pool = LibvirtPool()
+atexit.register(default_pool.close_all)
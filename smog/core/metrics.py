@@ -0,0 +1,421 @@
+"""
+An in-process registry of counters and latency histograms.
+
+Clients created through smog.nova, smog.glance, smog.neutron and smog.keystone
+are wrapped by instrument(), so that every call made through them (eg
+nova.servers.create or neutron.list_networks) records its latency, and any
+error or retry, in default_registry.  BaseStack adds the time it takes
+instances to boot and be deleted.
+
+Histograms keep log-linear buckets (like HdrHistogram), so percentiles are
+accurate to within 1/sub_buckets of the value no matter how spread out the
+samples are.
+
+The registry can be dumped as JSON or in the Prometheus text format.  If the
+SMOG_METRICS environment variable is set to a path, default_registry is
+written there when the process exits (as Prometheus text if the path ends with
+.prom, otherwise as JSON).
+
+Usage::
+
+    from smog.core.metrics import default_registry
+
+    with default_registry.timer("smog_migrate_seconds", host="compute1"):
+        vm.live_migrate(host="compute1")
+    print(default_registry.histogram("smog_api_seconds", service="nova",
+                                     op="servers.create").percentile(99))
+    default_registry.dump("metrics.prom")
+"""
+
+__author__ = 'stoner'
+
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from smog.core.logger import glob_logger
+
+# Upper bounds (in seconds) of the cumulative buckets in the Prometheus output
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+                   300, 600)
+
+# How many times instrument() retries a read which could not reach the service
+DEFAULT_RETRIES = 2
+
+# Calls which are safe to make again, whatever state the failed one left
+# behind (eg nova.servers.get, but not nova.servers.create)
+READ_OPS = ("list", "get", "find", "show")
+
+
+def connect_errors():
+    """
+    :return: tuple of the exceptions the OpenStack clients raise when they
+             could not connect to a service
+    """
+    errors = []
+    try:
+        from requests.exceptions import ConnectionError as RequestsError
+        errors.append(RequestsError)
+    except ImportError:
+        pass
+    try:
+        from keystoneauth1.exceptions import ConnectFailure
+        errors.append(ConnectFailure)
+    except ImportError:
+        pass
+    try:
+        from keystoneclient.exceptions import ConnectionRefused
+        errors.append(ConnectionRefused)
+    except ImportError:
+        pass
+    try:
+        from novaclient.exceptions import ConnectionRefused as NovaRefused
+        errors.append(NovaRefused)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Records values into log-linear buckets: each power of 2 above lowest is
+    split into sub_buckets equal parts
+    """
+    def __init__(self, lowest=1e-4, sub_buckets=16, buckets=DEFAULT_BUCKETS):
+        """
+        :param lowest: (float) values at or below this share the first bucket
+        :param sub_buckets: (int) buckets per power of 2
+        :param buckets: upper bounds of the cumulative (Prometheus) buckets
+        """
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._counts = {}
+        self._cumulative = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        if value <= self.lowest:
+            return 0
+        ratio = value / self.lowest
+        exp = int(math.floor(math.log(ratio, 2)))
+        sub = int((ratio / 2 ** exp - 1) * self.sub_buckets)
+        return 1 + exp * self.sub_buckets + min(sub, self.sub_buckets - 1)
+
+    def _upper(self, index):
+        if index == 0:
+            return self.lowest
+        exp, sub = divmod(index - 1, self.sub_buckets)
+        return self.lowest * 2 ** exp * (1 + (sub + 1) / float(self.sub_buckets))
+
+    def observe(self, value):
+        idx = self._index(value)
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            self._counts[idx] = self._counts.get(idx, 0) + 1
+            self._cumulative[bisect.bisect_left(self.buckets, value)] += 1
+
+    def percentile(self, pct):
+        """
+        :param pct: (float) 0 - 100
+        :return: the value at or below which pct percent of the values fall
+                 (to the precision of the bucket), or None if empty
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            target = max(1, int(math.ceil(self.count * pct / 100.0)))
+            seen = 0
+            for idx in sorted(self._counts):
+                seen += self._counts[idx]
+                if seen >= target:
+                    return min(self._upper(idx), self.max)
+        return self.max
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, count of values <= bound), ending with
+                 ("+Inf", count)
+        """
+        with self._lock:
+            counts = list(self._cumulative)
+        result = []
+        total = 0
+        for bound, num in zip(self.buckets + ("+Inf",), counts):
+            total += num
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        snap = OrderedDict([("count", self.count), ("sum", self.sum),
+                            ("min", self.min), ("max", self.max)])
+        for pct in (50, 90, 99):
+            snap["p{}".format(pct)] = self.percentile(pct)
+        return snap
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    pairs = ['{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                              .replace('"', '\\"')) for k, v in labels]
+    return "{" + ",".join(pairs) + "}"
+
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms, each identified by a name and a set of labels
+    """
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+        self.enabled = True
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls()
+        if not isinstance(metric, cls):
+            raise TypeError("{} is a {}".format(name, type(metric).__name__))
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Records how many seconds the with block took into a histogram
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histogram(name, **labels).observe(time.time() - start)
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def to_dict(self):
+        """
+        :return: dict of name -> list of {"labels": dict, "value": snapshot}
+        """
+        with self._lock:
+            items = list(self._metrics.items())
+        data = OrderedDict()
+        for (name, labels), metric in items:
+            data.setdefault(name, []).append({"labels": dict(labels),
+                                              "value": metric.snapshot()})
+        return data
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def to_prometheus(self):
+        """
+        :return: (str) the metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            items = list(self._metrics.items())
+        lines = []
+        typed = set()
+        for (name, labels), metric in items:
+            kind = "counter" if isinstance(metric, Counter) else "histogram"
+            if name not in typed:
+                lines.append("# TYPE {} {}".format(name, kind))
+                typed.add(name)
+            if kind == "counter":
+                lines.append("{}{} {}".format(name, _labels_text(labels),
+                                              metric.value))
+                continue
+            for bound, num in metric.cumulative():
+                le = labels + (("le", bound),)
+                lines.append("{}_bucket{} {}".format(name, _labels_text(le),
+                                                     num))
+            lines.append("{}_sum{} {}".format(name, _labels_text(labels),
+                                              metric.sum))
+            lines.append("{}_count{} {}".format(name, _labels_text(labels),
+                                                metric.count))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Writes the metrics to path, as Prometheus text if it ends with .prom
+        and as JSON otherwise
+        """
+        text = self.to_prometheus() if path.endswith(".prom") \
+            else self.to_json()
+        with open(path, "w") as out:
+            out.write(text)
+        glob_logger.info("Wrote metrics to {}".format(path))
+
+
+default_registry = MetricsRegistry()
+
+
+class InstrumentedClient(object):
+    """
+    A proxy around an OpenStack client which times every call made through it.
+
+    Methods of the client itself (eg neutron.list_networks) and of its
+    managers (eg nova.servers.list) are recorded as operations, under the
+    metrics:
+
+    - smog_api_seconds{service, op}: histogram of the latency of each call
+    - smog_api_errors_total{service, op, error}: calls that raised
+    - smog_api_retries_total{service, op}: reads (see READ_OPS) retried
+      after raising one of retry_on
+
+    Every attempt of a retried call is a separate smog_api_seconds sample,
+    which does not include the retry_delay.
+
+    Everything else (attributes, and the objects the calls return) is passed
+    through untouched.
+    """
+    _plain = (str, bytes, int, float, bool, list, tuple, dict, set,
+              type(None))
+
+    def __init__(self, target, service, registry=None, retries=0,
+                 retry_on=(), retry_delay=1, _prefix="", _depth=0):
+        """
+        :param target: the client (or manager) to wrap
+        :param service: (str) eg "nova"
+        :param registry: (MetricsRegistry) default_registry if None
+        :param retries: (int) how many times to retry a read which raised
+                        one of retry_on
+        :param retry_on: tuple of exception classes worth retrying
+        :param retry_delay: (float) seconds between retries
+        """
+        registry = default_registry if registry is None else registry
+        attrs = {"_target": target, "_service": service,
+                 "_registry": registry, "_retries": retries,
+                 "_retry_on": tuple(retry_on), "_retry_delay": retry_delay,
+                 "_prefix": _prefix, "_depth": _depth}
+        for key, val in attrs.items():
+            object.__setattr__(self, key, val)
+
+    def _wrap(self, op, fn):
+        registry = self._registry
+        labels = {"service": self._service, "op": op}
+
+        retries = self._retries if op.split(".")[-1].startswith(READ_OPS) \
+            else 0
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                start = time.time()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as ex:
+                    registry.histogram("smog_api_seconds", **labels).observe(
+                        time.time() - start)
+                    registry.counter("smog_api_errors_total",
+                                     error=type(ex).__name__,
+                                     **labels).inc()
+                    if attempt >= retries or \
+                            not isinstance(ex, self._retry_on):
+                        raise
+                    attempt += 1
+                    registry.counter("smog_api_retries_total", **labels).inc()
+                    glob_logger.info("Retrying {}.{} after {}".format(
+                        self._service, op, ex))
+                    time.sleep(self._retry_delay)
+                    continue
+                registry.histogram("smog_api_seconds", **labels).observe(
+                    time.time() - start)
+                return result
+        return call
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not self._registry.enabled:
+            return attr
+        op = self._prefix + name
+        if inspect.isroutine(attr):
+            return self._wrap(op, attr)
+        if self._depth == 0 and not isinstance(attr, self._plain) and \
+                not inspect.isclass(attr) and not inspect.ismodule(attr):
+            # a manager, eg nova.servers
+            return InstrumentedClient(attr, self._service, self._registry,
+                                      self._retries, self._retry_on,
+                                      self._retry_delay, _prefix=op + ".",
+                                      _depth=1)
+        return attr
+
+    def __setattr__(self, name, val):
+        setattr(self._target, name, val)
+
+    def __repr__(self):
+        return "<instrumented {!r}>".format(self._target)
+
+
+def instrument(client, service, registry=None, **kwargs):
+    """
+    :param client: an OpenStack client object
+    :param service: (str) the label to record its calls under, eg "nova"
+    :param kwargs: passed to InstrumentedClient.  Unless given, reads are
+                   retried DEFAULT_RETRIES times on connect_errors()
+    :return: an InstrumentedClient wrapping client
+    """
+    if isinstance(client, InstrumentedClient):
+        return client
+    kwargs.setdefault("retries", DEFAULT_RETRIES)
+    kwargs.setdefault("retry_on", connect_errors())
+    return InstrumentedClient(client, service, registry=registry, **kwargs)
+
+
+def unwrap(client):
+    """
+    :return: the client an InstrumentedClient wraps (or client itself)
+    """
+    if isinstance(client, InstrumentedClient):
+        return client._target
+    return client
+
+
+def _dump_at_exit():
+    path = os.environ.get("SMOG_METRICS")
+    if path:
+        try:
+            default_registry.dump(path)
+        except (IOError, OSError) as ex:
+            glob_logger.error("Could not write metrics: {}".format(ex))
+
+
+atexit.register(_dump_at_exit)
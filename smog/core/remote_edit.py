@@ -0,0 +1,148 @@
+"""
+Edits config files on remote hosts in place, without copying them back and
+forth.
+
+Configuring a remote file used to take three ssh connections: scp it here,
+edit it with set_cfg, and scp it back.  remote_edit instead sends the source
+of smog.core.cfgedit, together with the batch of edits, to "python -" on the
+host, so the file is read, edited, backed up and written there, in a single
+remote invocation.  What comes back is the number of changes, a unified diff,
+and the values of any keys asked for.
+
+With dry_run=True nothing is written, which shows what an edit would do.
+remote_edit_hosts applies the same batch to many hosts in parallel.
+
+The host only needs python (2.6+ or 3).
+
+Usage::
+
+    from smog.core.remote_edit import remote_edit, remote_edit_hosts
+
+    edits = [{"op": "set", "key": "listen_tcp", "value": "1"},
+             {"op": "set", "key": "auth_tcp", "value": '"none"'}]
+    res = remote_edit(host, "/etc/libvirt/libvirtd.conf", edits,
+                      dry_run=True)
+    print(res.diff)
+    results = remote_edit_hosts(computes, "/etc/libvirt/libvirtd.conf", edits,
+                                backup="/etc/libvirt/libvirtd.conf.bak")
+"""
+
+__author__ = 'stoner'
+
+import inspect
+import json
+from collections import namedtuple, OrderedDict
+
+import smog.core.cfgedit as cfgedit
+from smog.core.commander import Command, CommandException, fan_out
+from smog.core.commander import shell_command
+from smog.core.logger import glob_logger
+
+# Prefer python3, but fall back to whatever python the host has
+REMOTE_PYTHON = "command -v python3 >/dev/null 2>&1 && exec python3 - || " \
+                "exec python -"
+
+EditResult = namedtuple("EditResult", ["host", "path", "changes", "diff",
+                                       "values"])
+
+_source = []
+
+
+def cfgedit_source():
+    """
+    :return: (str) the source of smog.core.cfgedit, which is what runs on the
+             remote host
+    """
+    if not _source:
+        _source.append(inspect.getsource(cfgedit))
+    return _source[0]
+
+
+def _normalize_keys(keys):
+    """
+    :param keys: list of keys, or of (key, section) pairs
+    :return: list of [key, section]
+    """
+    return [[k, None] if isinstance(k, str) else [k[0], k[1]] for k in keys]
+
+
+def remote_edit(host, path, edits=(), get=(), backup=None, keep_original=False,
+                dry_run=False, user="root", pool=None, logger=glob_logger,
+                **kwds):
+    """
+    Applies a batch of edits (see smog.core.cfgedit) to path on host
+
+    :param host: (str) ip or hostname, or None to edit a local file
+    :param path: (str) path of the config file on host
+    :param edits: list of edit dicts
+    :param get: list of keys (or (key, section) pairs) whose values, after
+                the edits, are returned in EditResult.values
+    :param backup: (str) path on host to copy the original file to
+    :param keep_original: (bool) keep the very first version of the file in
+                          path + ".orig"
+    :param dry_run: (bool) don't write anything, just work out the diff
+    :param kwds: passed through to Command.__call__ (eg timeout)
+    :return: EditResult, where values is an OrderedDict of each of get to the
+             list of its values
+    """
+    keys = _normalize_keys(get)
+    request = {"path": path, "edits": list(edits), "get": keys,
+               "backup": backup, "keep_original": keep_original,
+               "dry_run": dry_run}
+    script = "{0}\nrun_request({1!r})\n".format(cfgedit_source(),
+                                                 json.dumps(request))
+
+    cmd = Command(shell_command(REMOTE_PYTHON, remote=host is not None),
+                  user=user, host=host, pool=pool)
+    kwds.setdefault("showout", False)
+    kwds.setdefault("checkresult", (False, 0))
+    res = cmd(input=script, **kwds)
+
+    where = "{0}:{1}".format(host, path) if host else path
+    output = res.output or ""
+    replies = [line[len(cfgedit.REPLY_MARKER):]
+               for line in output.splitlines()
+               if line.startswith(cfgedit.REPLY_MARKER)]
+    if not replies:
+        raise CommandException("Could not edit {0}: {1}".format(where,
+                                                                output))
+    reply = json.loads(replies[-1])
+    if "error" in reply:
+        raise CommandException("Could not edit {0}: {1}".format(
+            where, reply["error"]))
+
+    if reply["diff"]:
+        verb = "Would change" if dry_run else "Changed"
+        logger.info("{0} {1}:\n{2}".format(verb, where, reply["diff"]))
+    values = OrderedDict()
+    for key, vals in zip(get, reply["values"]):
+        values[key if isinstance(key, str) else tuple(key)] = vals
+    return EditResult(host, path, reply["changes"], reply["diff"], values)
+
+
+def remote_get(host, path, keys, user="root", **kwds):
+    """
+    Reads the values of keys from path on host, without copying the file
+
+    :param keys: list of keys, or of (key, section) pairs
+    :return: OrderedDict of each of keys to the list of its (uncommented)
+             values
+    """
+    return remote_edit(host, path, get=keys, user=user, **kwds).values
+
+
+def remote_edit_hosts(hosts, path, edits=(), max_workers=10, throws=False,
+                      **kwargs):
+    """
+    Applies the same edits to path on many hosts at once
+
+    :param hosts: sequence of hosts
+    :param max_workers: (int) max number of hosts being edited at once
+    :param throws: if True, raise FanOutException if any host failed
+    :param kwargs: passed to remote_edit
+    :return: OrderedDict of host -> HostResult, whose value is the EditResult
+    """
+    def edit(host):
+        return remote_edit(host, path, edits, **kwargs)
+
+    return fan_out(edit, hosts, max_workers=max_workers, throws=throws)
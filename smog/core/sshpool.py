@@ -0,0 +1,341 @@
+"""
+A pool of persistent ssh sessions which Command uses for remote execution.
+
+Rather than paying for a full TCP connection, key exchange and authentication
+for every remote command, the first command to a user@host starts an OpenSSH
+ControlMaster in the background.  Every following command to the same
+user@host is multiplexed over that master's socket, which brings the cost of a
+remote command down to a local fork plus one round trip.
+
+The pool keeps track of each master so that it can:
+
+- limit how many commands are concurrently multiplexed over one master (sshd
+  refuses more than MaxSessions channels per connection, which is 10 by
+  default)
+- check that a master is still healthy before using it (ssh -O check), and
+  clean up a stale control socket if it is not
+- shut down masters that have been idle for too long (ssh -O exit), but
+  never one with a command in flight or a non-blocking process (eg a
+  journalctl -f stream) still running over it
+
+Usage::
+
+    from smog.core.commander import Command
+    from smog.core.sshpool import default_pool
+
+    res = Command("cat /proc/meminfo", host="10.8.0.58")()  # starts a master
+    res = Command("numactl -H", host="10.8.0.58")()         # reuses it
+    default_pool.close_all()
+"""
+
+__author__ = 'stoner'
+
+import os
+import threading
+import time
+import tempfile
+import atexit
+from subprocess import Popen, PIPE
+
+from smog.core.logger import glob_logger
+
+
+class _Master(object):
+    """
+    Bookkeeping for a single user@host control master
+    """
+    def __init__(self, user, host, max_sessions):
+        self.user = user
+        self.host = host
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.last_used = time.time()
+        self.last_checked = 0
+        self.in_use = 0
+        # close() was called while commands were in flight
+        self.closing = False
+        # non-blocking processes using the master (see pin())
+        self.procs = []
+
+    def streaming(self):
+        """
+        :return: True if a pinned process is still running
+        """
+        self.procs = [p for p in self.procs if _running(p)]
+        return bool(self.procs)
+
+
+def _running(proc):
+    """
+    :param proc: a subprocess.Popen or an asyncio Process
+    """
+    if hasattr(proc, "poll"):
+        return proc.poll() is None
+    return proc.returncode is None
+
+
+class SSHControlPool(object):
+    """
+    Hands out ssh command prefixes which multiplex over a per user@host
+    ControlMaster, and manages the lifetime of those masters.
+    """
+    def __init__(self, control_dir=None, persist=600, max_sessions=8,
+                 idle_timeout=300, check_interval=30, ssh="ssh",
+                 ssh_options=None, logger=glob_logger):
+        """
+        :param control_dir: (str) directory to hold the control sockets.  It
+                            should be short, since unix socket paths are
+                            limited to ~108 characters
+        :param persist: (int) seconds ssh keeps an unused master alive on its
+                        own (ControlPersist)
+        :param max_sessions: (int) max concurrent commands per user@host
+        :param idle_timeout: (int) seconds after which evict_idle() will shut
+                             down a master that has not been used
+        :param check_interval: (int) seconds between health checks of a master
+        :param ssh: (str) the ssh executable
+        :param ssh_options: (list) extra -o options (eg ["BatchMode=yes"])
+        """
+        if control_dir is None:
+            name = "smog-cm-{}".format(os.getuid())
+            control_dir = os.path.join(tempfile.gettempdir(), name)
+        self.control_dir = control_dir
+        self.persist = persist
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.ssh = ssh
+        self.ssh_options = [] if ssh_options is None else list(ssh_options)
+        self.logger = logger
+        self.enabled = True
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def _ensure_dir(self):
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, mode=0o700)
+
+    def control_path(self, user, host):
+        return os.path.join(self.control_dir, "{}@{}".format(user, host))
+
+    def _master_opts(self, user, host):
+        opts = ["-o", "ControlMaster=auto",
+                "-o", "ControlPath={}".format(self.control_path(user, host)),
+                "-o", "ControlPersist={}".format(self.persist)]
+        for opt in self.ssh_options:
+            opts.extend(["-o", opt])
+        return opts
+
+    def ssh_args(self, user, host):
+        """
+        Returns the ssh invocation (as a list of tokens) that will multiplex
+        over the user@host master, starting the master if needed
+
+        :param user: (str) remote user
+        :param host: (str) ip or hostname
+        :return: list of str
+        """
+        if not self.enabled:
+            return [self.ssh, "{}@{}".format(user, host)]
+        self._ensure_dir()
+        return [self.ssh] + self._master_opts(user, host) + \
+               ["{}@{}".format(user, host)]
+
+    def prefix(self, user, host):
+        """
+        The same as ssh_args, but as a string that can be prepended to a
+        command string
+        """
+        return " ".join(self.ssh_args(user, host)) + " "
+
+    def _get_master(self, user, host):
+        with self._lock:
+            return self._find_master(user, host)
+
+    def _find_master(self, user, host):
+        """
+        Looks up (or creates) the master for user@host.  self._lock must be
+        held
+        """
+        key = (user, host)
+        master = self._masters.get(key)
+        if master is None:
+            master = _Master(user, host, self.max_sessions)
+            self._masters[key] = master
+        return master
+
+    def _control(self, user, host, op):
+        """
+        Runs ssh -O op against the master for user@host
+
+        :return: the returncode of ssh -O
+        """
+        args = [self.ssh, "-O", op] + self._master_opts(user, host) + \
+               ["{}@{}".format(user, host)]
+        proc = Popen(args, stdout=PIPE, stderr=PIPE)
+        proc.communicate()
+        return proc.returncode
+
+    def check(self, user, host):
+        """
+        Checks that the master for user@host is alive.  If the master is gone
+        but its control socket is still around, the stale socket is removed so
+        that the next command can start a fresh master.
+
+        :return: True if a master is running
+        """
+        path = self.control_path(user, host)
+        if not os.path.exists(path):
+            return False
+        if self._control(user, host, "check") == 0:
+            return True
+        self.logger.warning("Removing stale ssh control socket {}".format(path))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return False
+
+    def acquire(self, user, host):
+        """
+        Reserves one session on the user@host master, blocking if the per host
+        limit has been reached.  Every acquire() must be paired with release()
+        """
+        self.evict_idle()
+        with self._lock:
+            # the slot is reserved in the same critical section that finds the
+            # master, so that evict_idle can't pop it in between
+            master = self._find_master(user, host)
+            master.closing = False
+            master.in_use += 1
+            master.last_used = time.time()
+            do_check = master.last_used - master.last_checked > \
+                self.check_interval
+            if do_check:
+                master.last_checked = master.last_used
+        master.sessions.acquire()
+        if do_check and self.enabled:
+            self.check(user, host)
+        return master
+
+    def pin(self, user, host, proc):
+        """
+        Keeps the user@host master from being evicted while proc (a
+        non-blocking command running over it) is still running.  Unlike
+        acquire(), this does not count against max_sessions
+        """
+        with self._lock:
+            master = self._find_master(user, host)
+            master.procs.append(proc)
+            master.last_used = time.time()
+        return master
+
+    def release(self, user, host):
+        """
+        Gives back a session reserved by acquire().  If close() was called
+        while it was in flight, the master is shut down once its last session
+        is released
+        """
+        key = (user, host)
+        with self._lock:
+            master = self._masters.get(key)
+            if master is None:
+                return
+            master.in_use -= 1
+            master.last_used = time.time()
+            done = master.closing and master.in_use == 0
+            if done:
+                self._masters.pop(key)
+        master.sessions.release()
+        if done:
+            self._exit(user, host)
+
+    def session(self, user, host):
+        """
+        Context manager around acquire()/release()
+
+        Usage::
+
+            with pool.session("root", "10.8.0.58"):
+                proc = Popen(pool.ssh_args("root", "10.8.0.58") + ["uptime"])
+                proc.communicate()
+        """
+        pool = self
+
+        class _Session(object):
+            def __enter__(self):
+                pool.acquire(user, host)
+                return pool
+
+            def __exit__(self, *exc):
+                pool.release(user, host)
+                return False
+
+        return _Session()
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Shuts down any master which has no commands in flight, no pinned
+        process still running, and has not been used for idle_timeout seconds
+
+        :return: list of (user, host) that were evicted
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        now = time.time()
+        with self._lock:
+            idle = [key for key, m in self._masters.items()
+                    if m.in_use == 0 and now - m.last_used > idle_timeout and
+                    not m.streaming()]
+            for key in idle:
+                self._masters.pop(key)
+        for user, host in idle:
+            self.logger.debug("Closing idle ssh master {}@{}".format(user, host))
+            self._control(user, host, "exit")
+        return idle
+
+    def _exit(self, user, host):
+        if os.path.exists(self.control_path(user, host)):
+            self._control(user, host, "exit")
+
+    def _pop_idle(self, keys):
+        """
+        Forgets the masters of keys which have nothing in flight, and marks
+        the others to be closed by their last release()
+
+        :return: list of the keys that can be shut down now
+        """
+        closed = []
+        with self._lock:
+            for key in keys:
+                master = self._masters.get(key)
+                if master is not None and master.in_use > 0:
+                    master.closing = True
+                    continue
+                self._masters.pop(key, None)
+                closed.append(key)
+        return closed
+
+    def close(self, user, host):
+        for user, host in self._pop_idle([(user, host)]):
+            self._exit(user, host)
+
+    def close_all(self):
+        with self._lock:
+            keys = list(self._masters.keys())
+        for user, host in self._pop_idle(keys):
+            self._exit(user, host)
+
+    def stats(self):
+        """
+        :return: dict of "user@host" -> {"in_use": int, "streams": int,
+                 "idle": seconds}
+        """
+        now = time.time()
+        with self._lock:
+            return {"{}@{}".format(u, h): {"in_use": m.in_use,
+                                           "streams": len(m.procs),
+                                           "idle": now - m.last_used}
+                    for (u, h), m in self._masters.items()}
+
+
+default_pool = SSHControlPool()
+atexit.register(default_pool.close_all)
@@ -9,11 +9,25 @@ from abc import abstractmethod
 __author__ = 'stoner'
 
 import sys
+import os
+import json
+import tempfile
+import fcntl
+import stat
+import time
+import selectors
 import threading
 import multiprocessing
 from abc import ABCMeta
+import heapq
+import shlex
+from collections import deque
 import re
 from functools import wraps
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from smog.core.exceptions import ArgumentError
 from smog.core.commander import Command, ProcessResult
@@ -28,18 +42,232 @@ else:
 magic = "==magic-fail=="
 
 
-def freader(watched, que, seek_end=True, log=sys.stdout, fail=magic):
+class Tailer(object):
+    """
+    Follows a file like tail -F, reading it in large blocks.
+
+    The inode and size of the file are tracked, so that both kinds of log
+    rotation are followed:
+
+    - rename (logrotate's default): the rest of the old file is read, and
+      then the new file at path is read from its start
+    - copytruncate: the file shrinks, and is read again from its start.
+      Anything written between the copy and the truncate is lost, which is
+      unavoidable with copytruncate
+
+    If checkpoint is given, the offset of the last complete line handed out is
+    saved to that JSON file (at most every checkpoint_interval seconds, and on
+    close), and a new Tailer of the same path resumes from there as long as
+    the file was not rotated in the meantime.
+
+    Usage::
+
+        tailer = Tailer("/var/log/nova/nova-compute.log",
+                        checkpoint="logs/offsets.json")
+        while True:
+            for line in tailer.readlines():
+                print(line)
+            time.sleep(1)
+    """
+    _ckpt_lock = threading.Lock()
+
+    def __init__(self, path, seek_end=True, checkpoint=None,
+                 checkpoint_interval=10, block_size=65536, logger=glob_logger):
+        """
+        :param path: (str) the file to follow
+        :param seek_end: if there is no checkpoint, start at the end of the
+                         file rather than at the start
+        :param checkpoint: (str) path of a JSON file to save offsets in
+        :param checkpoint_interval: min seconds between checkpoint saves
+        :param block_size: (int) bytes per read
+        """
+        self.path = path
+        self.seek_end = seek_end
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.block_size = block_size
+        self.logger = logger
+        self.inode = None
+        self.dev = None
+        self.offset = 0
+        self.rotations = 0
+        self._fobj = None
+        self._partial = b""
+        self._saved = 0
+        self.open()
+
+    def _load_checkpoint(self):
+        if not self.checkpoint:
+            return None
+        try:
+            with open(self.checkpoint, "r") as ckpt:
+                return json.load(ckpt).get(self.path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_checkpoint(self):
+        """
+        Saves the offset of the last complete line read
+        """
+        if not self.checkpoint or self.inode is None:
+            return
+        entry = {"inode": self.inode, "dev": self.dev,
+                 "offset": self.offset - len(self._partial)}
+        with Tailer._ckpt_lock:
+            try:
+                with open(self.checkpoint, "r") as ckpt:
+                    data = json.load(ckpt)
+            except (IOError, OSError, ValueError):
+                data = {}
+            data[self.path] = entry
+            dirname = os.path.dirname(self.checkpoint) or "."
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".offsets")
+            with os.fdopen(fd, "w") as tmp_f:
+                json.dump(data, tmp_f)
+            os.rename(tmp, self.checkpoint)
+        self._saved = time.time()
+
+    def open(self, seek_end=None):
+        """
+        Opens path, positioned at the checkpoint, the end or the start
+
+        :param seek_end: if None, use self.seek_end
+        :return: True if the file could be opened
+        """
+        if seek_end is None:
+            seek_end = self.seek_end
+        try:
+            self._fobj = open(self.path, "rb")
+        except (IOError, OSError):
+            return False
+        st = os.fstat(self._fobj.fileno())
+        self.inode, self.dev = st.st_ino, st.st_dev
+        ckpt = self._load_checkpoint()
+        if ckpt and ckpt["inode"] == self.inode and \
+                ckpt["dev"] == self.dev and ckpt["offset"] <= st.st_size:
+            self._fobj.seek(ckpt["offset"])
+        elif seek_end:
+            self._fobj.seek(0, os.SEEK_END)
+        self.offset = self._fobj.tell()
+        return True
+
+    def _rotated(self):
+        """
+        Checks if path was rotated, and if so switches to the new file
+
+        :return: True if there may be more to read
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # in the middle of a rename rotation
+            return False
+        if st.st_ino != self.inode or st.st_dev != self.dev:
+            self.logger.info("{} was rotated, reopening".format(self.path))
+            self._fobj.close()
+            self._fobj = open(self.path, "rb")
+            st = os.fstat(self._fobj.fileno())
+            self.inode, self.dev = st.st_ino, st.st_dev
+        elif st.st_size < self._fobj.tell():
+            self.logger.info("{} was truncated, rewinding".format(self.path))
+            self._fobj.seek(0)
+        else:
+            return False
+        self.rotations += 1
+        self.offset = 0
+        return True
+
+    def read(self, max_bytes=1 << 20):
+        """
+        Reads whatever has been appended since the last read (following any
+        rotation), up to about max_bytes
+
+        :return: bytes, which may end in a partial line
+        """
+        # a file which did not exist when we started is read from its start
+        if self._fobj is None and not self.open(seek_end=False):
+            return b""
+        chunks = []
+        total = 0
+        while total < max_bytes:
+            data = self._fobj.read(self.block_size)
+            if not data:
+                if self._rotated():
+                    # don't join the last line of the old file to the first
+                    # line of the new one
+                    if (chunks and not chunks[-1].endswith(b"\n")) or \
+                            (not chunks and self._partial):
+                        chunks.append(b"\n")
+                    continue
+                break
+            chunks.append(data)
+            total += len(data)
+            self.offset = self._fobj.tell()
+        return b"".join(chunks)
+
+    def readlines(self, max_bytes=1 << 20):
+        """
+        Like read(), but only returns complete lines (with their newlines).
+        A trailing partial line is held back until it is completed
+
+        :return: list of bytes
+        """
+        data = self.read(max_bytes)
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        if self.checkpoint and \
+                time.time() - self._saved > self.checkpoint_interval:
+            self.save_checkpoint()
+        return [line + b"\n" for line in lines]
+
+    def close(self):
+        self.save_checkpoint()
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+
+def freader(watched, que, seek_end=True, log=sys.stdout, fail=magic,
+            interval=0.5, checkpoint=None):
     """
     Opens up the watched object for reading.  This object must have an open,
     close, and readline method. This function will be run in a separate process
 
-    :param watched: (str) Path to a file that will be opened read-only
+    :param watched: (str) Path to a file that will be opened read-only, and
+                    followed across log rotations (see Tailer)
     :param que: (multiprocessing.Queue) Queue that will be used to communicate
                 between freader and monitor
     :param seek_end: If true, seek to the end of the file before reading
     :param log: A file object or something with a write method
+    :param interval: seconds to sleep when a file has no new data
+    :param checkpoint: (str) for a path, JSON file to persist the offset in
     :return:
     """
+    def _emit(line):
+        """
+        :return: False if the reader should stop
+        """
+        if isinstance(line, bytes):
+            line = line.decode(errors="replace")
+
+        # Check to see if we need to break the reader thread
+        if line == fail:
+            return False
+
+        if log:
+            try:
+                log.write(line)
+            except ValueError:
+                pass
+        try:
+            que.put(line)
+        except BrokenPipeError:
+            return False
+        except Exception as ex:
+            print(ex)
+            return False
+        return True
+
     def _read(fobj):
         if seek_end:
             try:
@@ -47,56 +275,50 @@ def freader(watched, que, seek_end=True, log=sys.stdout, fail=magic):
             except:
                 pass
 
-        keep_going = True
-        while keep_going:
-            if fobj.closed:
-                try:
-                    line = fobj.read()   # get the last bit from the file
-                except ValueError:
-                    break
-            else:
-                try:
-                    line = fobj.readline()
-                except ValueError:
-                    break
+        try:
+            regular = stat.S_ISREG(os.fstat(fobj.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            regular = False
 
+        while True:
+            try:
+                line = fobj.readline()
+            except ValueError:
+                # the file object was closed
+                break
             if line:
-                if isinstance(line, bytes):
-                    line = line.decode()
-
-                # Check to see if we need to break the reader thread
-                if line == fail:
-                    break
-
-                if log:
-                    try:
-                        log.write(line)
-                    except ValueError:
-                        pass
-                try:
-                    que.put(line)
-                except BrokenPipeError:
-                    break
-                except Exception as ex:
-                    print(ex)
+                if not _emit(line):
                     break
+            elif regular:
+                time.sleep(interval)
+            else:
+                # EOF on a pipe, the process is done
+                break
 
-            if fobj.closed:
-                # Try to open up again, in case we have a rotated log file
-                sys.stdout.write("Reopening {}".format(watched))
-                # hmmm, recursion
-                freader(watched, que, seek_end=seek_end, log=log)
-
-    if isinstance(watched, str) or isinstance(watched, bytes):
-        with open(watched, "r") as tailed:
-            _read(tailed)
+    def _tail(path):
+        tailer = Tailer(path, seek_end=seek_end, checkpoint=checkpoint)
+        try:
+            while True:
+                lines = tailer.readlines()
+                for line in lines:
+                    if not _emit(line):
+                        return
+                if not lines:
+                    time.sleep(interval)
+        finally:
+            tailer.close()
+
+    if isinstance(watched, bytes):
+        watched = watched.decode()
+    if isinstance(watched, str):
+        _tail(watched)
     else:
         _read(watched)
 
     glob_logger.info("reader loop is finished")
 
 
-def monitor(handler, que_r):
+def monitor(handler, que_r, poll_interval=1):
     """
     This function will consume items from the queue.  The handler callable will
     be called on each item pulled from the queue and do something accordingly.
@@ -110,27 +332,26 @@ def monitor(handler, que_r):
 
     :param handler: a predicate that takes a single string as an argument
     :param que: a multiprocessing.Queue
+    :param poll_interval: max seconds to block waiting for a line
     :return:
     """
     keep_going = True
     while keep_going:
         try:
-            empty = que_r.empty()
-        except OSError:
+            # block (rather than spin on que_r.empty()) until there's a line
+            line = que_r.get(timeout=poll_interval)
+        except queue.Empty:
+            continue
+        except (OSError, ValueError, EOFError):
             glob_logger.info("queue is closed")
             break
-        if not empty:
-            try:
-                line = que_r.get()
-                keep_going = handler(line)
-            except OSError:
-                glob_logger.debug("queue is closed")
-                break
-            except MonitoredException:
-                break
-            except Exception as ex:
-                glob_logger.debug("queue error type: {}".format(ex))
-                break
+        try:
+            keep_going = handler(line)
+        except MonitoredException:
+            break
+        except Exception as ex:
+            glob_logger.debug("queue error type: {}".format(ex))
+            break
     glob_logger.info("monitor loop is finished")
 
 
@@ -164,6 +385,111 @@ def setup_concurrent(thread):
     return thread
 
 
+class PatternSet(object):
+    """
+    Matches a line against many regexes in (usually) a single pass.
+
+    All the patterns are combined into one alternation, which is used to
+    quickly reject lines that match none of them.  Since most lines of a log
+    match nothing, the individual patterns only have to be tried on the rare
+    lines that pass.  Patterns which are plain strings without any regex
+    syntax are checked with a substring test instead.
+
+    Usage::
+
+        pset = PatternSet()
+        pset.add("oom", r"Out of memory")
+        pset.add("trace", re.compile(r"^Traceback", re.M))
+        for key, m in pset.matches(line):
+            print(key, m.group(0))
+    """
+    _backref = re.compile(r"\\\d|\(\?P=")
+    _special = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+    def __init__(self, patterns=None):
+        """
+        :param patterns: optional sequence of patterns to add, each keyed by
+                         its index
+        """
+        self._entries = []
+        self._literals = []
+        self._combined = None
+        self._separate = []
+        if patterns is not None:
+            for i, ptn in enumerate(patterns):
+                self.add(i, ptn)
+
+    def add(self, key, pattern, flags=0):
+        """
+        :param key: returned by matches() when pattern matches
+        :param pattern: (str|compiled regex)
+        :param flags: re flags, if pattern is a str
+        """
+        literal = False
+        if isinstance(pattern, str):
+            if flags == 0 and not self._special.search(pattern):
+                self._literals.append((key, pattern))
+                literal = True
+            pattern = re.compile(pattern, flags)
+        self._entries.append((key, pattern, literal))
+        self._combined = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _compile(self):
+        by_flags = {}
+        self._separate = []
+        for _, ptn, literal in self._entries:
+            if literal:
+                # checked by substring in search()
+                continue
+            if self._backref.search(ptn.pattern):
+                # group numbers shift once combined, so this one can't be
+                self._separate.append(ptn)
+            else:
+                by_flags.setdefault(ptn.flags, []).append(ptn)
+        combined = []
+        for flags, ptns in by_flags.items():
+            alt = "|".join("(?:{})".format(p.pattern) for p in ptns)
+            try:
+                combined.append(re.compile(alt, flags))
+            except re.error:
+                # eg the same named group in two patterns
+                self._separate.extend(ptns)
+        self._combined = combined
+
+    def search(self, line):
+        """
+        :return: True if any pattern matches line
+        """
+        if self._combined is None:
+            self._compile()
+        for _, lit in self._literals:
+            if lit in line:
+                return True
+        for ptn in self._combined:
+            if ptn.search(line):
+                return True
+        for ptn in self._separate:
+            if ptn.search(line):
+                return True
+        return False
+
+    def matches(self, line):
+        """
+        :return: list of (key, match object) for every pattern matching line
+        """
+        if not self.search(line):
+            return []
+        found = []
+        for key, ptn, _ in self._entries:
+            m = ptn.search(line)
+            if m:
+                found.append((key, m))
+        return found
+
+
 class Handler(object):
     """
     Example handler.  It takes a single argument to its init function which
@@ -178,12 +504,17 @@ class Handler(object):
     is found, it will normally terminate the reader process and mark something
     in the self._result field.  The __call__ method should either return a bool
     or a MonitoredException
+
+    If a Handler is only interested in lines matching some regexes, it should
+    list them in self.patterns.  A HandlerGroup then only calls it for lines
+    that match one of them.  If patterns is None, it is called for every line
     """
     def __init__(self, rdr):
         self._result = None
         self.rdr = rdr
         self.counts = 1
         self.found = 0
+        self.patterns = None
 
     def check_reader(self):
         """
@@ -255,39 +586,43 @@ class ExceptionHandler(Handler):
     def __init__(self, rdr, fail=True, count=1, die=True):
         super(ExceptionHandler, self).__init__(rdr)
         self._patterns = self.base_patterns()
+        self.patterns = self._patterns
+        self._pattern_set = PatternSet(self._patterns)
         self._fail = fail
         self._count = count
         self._found = 0
         self._exceptions = {}
         self._die = die
-        self.base_patterns()
         self.in_q = multiprocessing.Queue()
 
-    def base_patterns(self):
+    @staticmethod
+    def base_patterns():
+        """
+        :return: list of regexes matching python exceptions.  The first group
+                 of a match is the exception name
+        """
         ptn = re.compile(r"((?:\w+\.)*((?:[A-Z][a-z0-9_]+)+(Exception|Error)))")
         ptn2 = re.compile(r"raise exceptions\.(\w+)")
         return [ptn, ptn2]
 
     @finish
     def __call__(self, line):
-        for ptn in self._patterns:
-            m = ptn.search(line)
-            if m:
-                full, ex_type, _ = m.groups()
-                if full in self._exceptions:
-                    self._exceptions[full].append(line)
-                else:
-                    self._exceptions[full] = [line]
-                self.in_q.put(self._exceptions)
-                self._found += 1
-
-                if self._fail and (self._found >= self._count):
-                    self.rdr.terminate()
-                    return False
-                if self._die:
-                    msg = "Found the following: {}".format(self._exceptions)
-                    self.rdr.terminate()
-                    raise MonitoredException(msg)
+        for _, m in self._pattern_set.matches(line):
+            full = m.group(1)
+            if full in self._exceptions:
+                self._exceptions[full].append(line)
+            else:
+                self._exceptions[full] = [line]
+            self.in_q.put(self._exceptions)
+            self._found += 1
+
+            if self._fail and (self._found >= self._count):
+                self.rdr.terminate()
+                return False
+            if self._die:
+                msg = "Found the following: {}".format(self._exceptions)
+                self.rdr.terminate()
+                raise MonitoredException(msg)
         return True
 
     @property
@@ -302,6 +637,104 @@ class ExceptionHandler(Handler):
             raise ArgumentError("Can only set self.result once")
 
 
+class _MemberReader(object):
+    """
+    What a Handler inside a HandlerGroup gets as its rdr.  Terminating it only
+    retires that one handler; the real reader is only terminated once every
+    handler in the group is done.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.done = False
+
+    def terminate(self):
+        self.done = True
+
+    def is_alive(self):
+        return not self.done and self.group.check_reader()
+
+
+class HandlerGroup(Handler):
+    """
+    Runs many Handlers over one stream with a single scan per line.
+
+    The patterns of every handler are merged into one PatternSet, and a
+    handler is only called for the lines which matched one of its patterns
+    (or for every line, if its patterns is None).  So watching a busy log for
+    dozens of signatures costs roughly one regex search per line, rather than
+    one per signature.
+
+    Usage::
+
+        mux.watch(res, HandlerGroup, [ExceptionHandler,
+                                      (RegexHandler, (re.compile("migrat"),))])
+    """
+    def __init__(self, rdr, handlers):
+        """
+        :param rdr: the reader (eg a WatchedStream)
+        :param handlers: list of Handler classes, or of (hcls, args) or
+                         (hcls, args, kwargs) tuples
+        """
+        super(HandlerGroup, self).__init__(rdr)
+        self.patterns = []
+        self.members = []
+        self.always = []
+        self._pattern_set = PatternSet()
+        for spec in handlers:
+            if not isinstance(spec, tuple):
+                spec = (spec,)
+            hcls, args, kwargs = (tuple(spec) + ((), {}))[:3]
+            member_rdr = _MemberReader(self)
+            handler = hcls(member_rdr, *args, **kwargs)
+            idx = len(self.members)
+            self.members.append((handler, member_rdr))
+            ptns = getattr(handler, "patterns", None)
+            if ptns is None:
+                self.always.append(idx)
+                self.patterns = None
+                continue
+            for ptn in ptns:
+                self._pattern_set.add(idx, ptn)
+                if self.patterns is not None:
+                    self.patterns.append(ptn)
+
+    @property
+    def handlers(self):
+        return [h for h, _ in self.members]
+
+    def __call__(self, line):
+        if line == magic:
+            targets = range(len(self.members))
+        else:
+            targets = set(self.always)
+            targets.update(k for k, _ in self._pattern_set.matches(line))
+        error = None
+        for idx in sorted(targets):
+            handler, member_rdr = self.members[idx]
+            if member_rdr.done:
+                continue
+            try:
+                if handler(line) is False:
+                    member_rdr.done = True
+            except MonitoredException as me:
+                member_rdr.done = True
+                error = me
+        if all(r.done for _, r in self.members):
+            self.rdr.terminate()
+            if error is not None:
+                raise error
+            return False
+        return True
+
+    @property
+    def result(self):
+        return [h.result for h in self.handlers]
+
+    @result.setter
+    def result(self, val):
+        raise ArgumentError("HandlerGroup result is read-only")
+
+
 class _Watcher:
     __metaclass__ = ABCMeta
 
@@ -487,11 +920,572 @@ class JournalWatcher(_Watcher):
 
     def start_reader(self, seek_end=False, log=None):
         # get the input from the ResultProcess object
-        cmd = Command("journalctl -f")
+        if isinstance(self._watched, Command):
+            cmd = self._watched
+        else:
+            cmd = Command("journalctl -f")
         res = cmd(block=False)
         return res.proc.stdout
 
 
+class WatchedStream(object):
+    """
+    A stream (the stdout of a ProcessResult, a file object, or the path of a
+    file) registered with a WatchMultiplexer.
+
+    A WatchedStream is what a Handler gets as its rdr, so handler code can
+    still call self.rdr.terminate() or self.rdr.is_alive().  It also has the
+    handler, poll() and close() of a Watcher, so it can be used in place of
+    one.
+    """
+    def __init__(self, mux, name, watched, seek_end=True, log=None,
+                 checkpoint=None):
+        self.mux = mux
+        self.name = name
+        self.log = log
+        self.handler = None
+        self.error = None
+        self._process = None
+        self._fobj = None
+        self.tailer = None
+        self._partial = b""
+        self._stopping = False
+        self._done = threading.Event()
+
+        if isinstance(watched, ProcessResult):
+            self._process = watched.proc
+            self._fobj = watched.proc.stdout
+        elif isinstance(watched, (str, bytes)):
+            if isinstance(watched, bytes):
+                watched = watched.decode()
+            self.tailer = Tailer(watched, seek_end=seek_end,
+                                 checkpoint=checkpoint)
+            self.polled = True
+            if self.name is None:
+                self.name = watched
+            return
+        else:
+            self._fobj = watched
+
+        mode = os.fstat(self.fileno()).st_mode
+        # epoll can not watch regular files (they are always "ready"), so
+        # these are polled instead
+        self.polled = stat.S_ISREG(mode)
+        if self.polled:
+            if seek_end:
+                os.lseek(self.fileno(), 0, os.SEEK_END)
+        else:
+            flags = fcntl.fcntl(self.fileno(), fcntl.F_GETFL)
+            fcntl.fcntl(self.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._fobj.fileno()
+
+    def feed(self, data):
+        """
+        Splits data into lines and calls the handler on each complete one
+
+        :return: False if the stream should be stopped
+        """
+        data = self._partial + data
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if not self._dispatch(line + b"\n"):
+                return False
+        return True
+
+    def feed_eof(self):
+        if self._partial:
+            data, self._partial = self._partial, b""
+            self._dispatch(data)
+
+    def _dispatch(self, raw):
+        if self._stopping:
+            return False
+        line = raw.decode(errors="replace")
+        if self.log:
+            try:
+                self.log.write(line)
+            except ValueError:
+                pass
+        if self.handler is None:
+            return True
+        try:
+            keep_going = self.handler(line)
+        except MonitoredException as me:
+            self.error = me
+            keep_going = False
+        except Exception as ex:
+            glob_logger.error("Handler for {} failed: {}".format(self.name, ex))
+            self.error = ex
+            keep_going = False
+        return keep_going is not False and not self._stopping
+
+    def _stop(self):
+        """
+        Called by the multiplexer once the stream is unregistered
+        """
+        if self.tailer is not None:
+            self.tailer.close()
+        if self._process is not None and self._process.poll() is None:
+            try:
+                self._process.terminate()
+            except ProcessLookupError:
+                pass
+        self._done.set()
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def terminate(self):
+        """
+        Stops watching the stream (and terminates its process, if any).  Safe
+        to call from a handler
+        """
+        self._stopping = True
+        self.mux.remove(self)
+
+    def poll(self):
+        if self._process:
+            return self._process.poll()
+
+    def wait(self, timeout=None):
+        """
+        :return: True if the stream is finished
+        """
+        return self._done.wait(timeout)
+
+    def close(self, timeout=5):
+        self.terminate()
+        self.wait(timeout)
+        if self.log and self.log not in (sys.stdout, sys.stderr):
+            self.log.close()
+
+
+class WatchMultiplexer(object):
+    """
+    Watches any number of streams from a single thread.
+
+    Pipes (eg the stdout of Command("journalctl -f", host=...)(block=False))
+    are registered with a selector, so an idle stream costs nothing.  Regular
+    files can not be selected on, so they are polled every poll_interval
+    seconds instead.  Files given by path are followed across log rotations
+    with a Tailer.  Every complete line read from a stream is passed to the
+    stream's Handler, the same as monitor() does.
+
+    Usage::
+
+        mux = WatchMultiplexer()
+        for host in computes:
+            res = Command("journalctl -f", host=host)(block=False)
+            mux.watch(res, ExceptionHandler, name=host, die=False)
+        mux.watch("/var/log/nova/nova-api.log", ExceptionHandler, die=False)
+        ...
+        mux.close()
+    """
+    def __init__(self, poll_interval=0.5, chunk_size=65536,
+                 logger=glob_logger):
+        """
+        :param poll_interval: seconds between reads of regular files
+        :param chunk_size: max bytes read from a stream at a time
+        """
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self.streams = {}
+        self._selector = selectors.DefaultSelector()
+        self._polled = []
+        self._hooks = []
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def watch(self, watched, hcls=None, *args, name=None, seek_end=True,
+              log=None, checkpoint=None, **kwargs):
+        """
+        Starts watching a stream
+
+        :param watched: a ProcessResult, file object or path
+        :param hcls: a Handler class (not object), or None to only log
+        :param args: passed through to hcls(stream, *args, **kwargs)
+        :param name: a unique name for the stream (defaults to its fileno)
+        :param seek_end: for files, start from the end rather than the start
+        :param log: a file-like object every line is written to
+        :param checkpoint: for a path, a JSON file to persist the offset in
+                           (see Tailer)
+        :return: the WatchedStream
+        """
+        stream = WatchedStream(self, name, watched, seek_end=seek_end, log=log,
+                               checkpoint=checkpoint)
+        if stream.name is None:
+            stream.name = str(stream.fileno())
+        with self._lock:
+            if stream.name in self.streams:
+                stream._stop()
+                raise ArgumentError("{} is already watched".format(stream.name))
+            self.streams[stream.name] = stream
+        if hcls is not None:
+            stream.handler = hcls(stream, *args, **kwargs)
+        self._pending.append(("add", stream))
+        self.start()
+        self._wake()
+        return stream
+
+    def remove(self, stream):
+        self._pending.append(("remove", stream))
+        self._wake()
+
+    def add_hook(self, fn, interval):
+        """
+        Calls fn() from the multiplexer thread every interval seconds (eg to
+        check for a timeout, or for rotated log files)
+        """
+        self._hooks.append([fn, interval, time.time() + interval])
+        self._wake()
+
+    def remove_hook(self, fn):
+        self._hooks = [h for h in self._hooks if h[0] != fn]
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._loop,
+                                            name="watch-multiplexer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"x")
+        except (BlockingIOError, OSError):
+            # the pipe is full (so a wakeup is already pending) or closed
+            pass
+
+    def _apply_pending(self):
+        while self._pending:
+            op, stream = self._pending.popleft()
+            if op == "add":
+                if stream._stopping:
+                    self._finish(stream)
+                elif stream.polled:
+                    self._polled.append(stream)
+                else:
+                    self._selector.register(stream.fileno(),
+                                            selectors.EVENT_READ, stream)
+            else:
+                self._finish(stream)
+
+    def _finish(self, stream):
+        if stream._done.is_set():
+            return
+        if stream in self._polled:
+            self._polled.remove(stream)
+        elif not stream.polled:
+            try:
+                self._selector.unregister(stream.fileno())
+            except (KeyError, ValueError, OSError):
+                pass
+        with self._lock:
+            self.streams.pop(stream.name, None)
+        stream._stop()
+
+    def _read(self, stream):
+        # bound how much is read from one stream per pass, so that a very
+        # busy stream can not starve the others
+        if stream.tailer is not None:
+            lines = stream.tailer.readlines(max_bytes=16 * self.chunk_size)
+            if lines and not stream.feed(b"".join(lines)):
+                self._finish(stream)
+            return
+        for _ in range(16):
+            try:
+                data = os.read(stream.fileno(), self.chunk_size)
+            except BlockingIOError:
+                return
+            except (OSError, ValueError):
+                data = b""
+            if not data:
+                if not stream.polled:
+                    # EOF on a pipe, the process is done
+                    stream.feed_eof()
+                    self._finish(stream)
+                return
+            if not stream.feed(data):
+                self._finish(stream)
+                return
+
+    def _timeout(self):
+        if self._pending:
+            return 0
+        timeouts = []
+        if self._polled:
+            timeouts.append(self.poll_interval)
+        if self._hooks:
+            nxt = min(h[2] for h in self._hooks)
+            timeouts.append(max(0, nxt - time.time()))
+        return min(timeouts) if timeouts else None
+
+    def _run_hooks(self):
+        now = time.time()
+        for hook in list(self._hooks):
+            fn, interval, due = hook
+            if now >= due:
+                hook[2] = now + interval
+                try:
+                    fn()
+                except Exception as ex:
+                    self.logger.error("watch hook {} failed: {}".format(fn, ex))
+
+    def _loop(self):
+        while self._running:
+            self._apply_pending()
+            for key, _ in self._selector.select(self._timeout()):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                self._read(key.data)
+            for stream in list(self._polled):
+                self._read(stream)
+            self._run_hooks()
+        self.logger.info("watch multiplexer loop is finished")
+
+    def close(self, timeout=5):
+        """
+        Stops watching every stream, and stops the multiplexer thread
+        """
+        with self._lock:
+            running, self._running = self._running, False
+        self._wake()
+        if running and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._apply_pending()
+        for stream in list(self.streams.values()):
+            self._finish(stream)
+        self._selector.close()
+        for fd in (self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+DEFAULT_JOURNAL_FIELDS = ("MESSAGE", "PRIORITY", "SYSLOG_IDENTIFIER", "_PID",
+                          "_SYSTEMD_UNIT")
+
+
+def journal_command(units=None, priority=None, grep=None, fields=None,
+                    lines=0, remote=True):
+    """
+    Builds a journalctl -f -o json command line, with the filtering done by
+    journalctl itself so that unwanted entries never leave the host
+
+    :param units: list of systemd units (-u)
+    :param priority: max priority to show, eg "err" or 3 (-p)
+    :param grep: only entries whose MESSAGE matches this regex (-g, needs
+                 systemd 237)
+    :param fields: which fields to output (--output-fields, needs systemd
+                   236).  The __REALTIME_TIMESTAMP is always included
+    :param lines: how many old entries to show first (-n)
+    :param remote: whether the command will run over ssh (needs another
+                   round of quoting)
+    :return: (str) the command
+    """
+    toks = ["journalctl", "-f", "-o", "json", "-n", str(lines)]
+    for unit in units or ():
+        toks.extend(["-u", unit])
+    if priority is not None:
+        toks.extend(["-p", str(priority)])
+    if grep is not None:
+        toks.extend(["-g", grep])
+    if fields:
+        toks.append("--output-fields={}".format(",".join(fields)))
+    quote = shlex.quote
+    if remote:
+        quote = lambda t: shlex.quote(shlex.quote(t))
+    return " ".join(quote(t) for t in toks)
+
+
+def format_journal_entry(host, entry):
+    """
+    :return: entry formatted much like journalctl's short output, prefixed
+             by the host it came from
+    """
+    msg = entry.get("MESSAGE", "")
+    if isinstance(msg, list):
+        # journald sends non UTF-8 messages as an array of bytes
+        msg = bytes(msg).decode(errors="replace")
+    ident = entry.get("SYSLOG_IDENTIFIER") or entry.get("_SYSTEMD_UNIT", "")
+    pid = entry.get("_PID")
+    if pid:
+        ident = "{}[{}]".format(ident, pid)
+    return "{} {}: {}\n".format(host or "localhost", ident, msg)
+
+
+class _JournalParser(object):
+    """
+    The handler of each per host journalctl stream.  It parses the JSON
+    entries and hands them to the MultiJournalWatcher to be merged
+    """
+    def __init__(self, rdr, journal, host):
+        self.rdr = rdr
+        self.journal = journal
+        self.host = host
+        self.patterns = None
+
+    def __call__(self, line):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            glob_logger.debug("Bad journal entry from {}".format(self.host))
+            return True
+        self.journal.add_entry(self.host, entry)
+        return not self.journal.finished
+
+
+class MultiJournalWatcher(object):
+    """
+    Watches the journals of many hosts at once, and feeds their entries, in
+    timestamp order, to a single Handler.
+
+    On every host journalctl -f -o json is run with the unit, priority and
+    grep filters, so only the entries of interest are sent over the wire.
+    Entries are held for window seconds (to allow for network delays and
+    clock skew between the hosts), and then passed in __REALTIME_TIMESTAMP
+    order to the handler as a line formatted like
+    "<host> <identifier>[<pid>]: <message>".  The whole entry is available as
+    self.entry while the handler is being called.
+
+    The MultiJournalWatcher is the handler's rdr, so the handler can
+    terminate() it.  Like a Watcher, it has handler, poll() and close()
+
+    Usage::
+
+        journal = MultiJournalWatcher(computes, ExceptionHandler,
+                                      units=["openstack-nova-compute"],
+                                      priority="err", die=False)
+        ...
+        journal.close()
+        print(journal.handler.result)
+    """
+    def __init__(self, hosts, hcls, *args, units=None, priority=None,
+                 grep=None, fields=DEFAULT_JOURNAL_FIELDS, window=1.0,
+                 user="root", mux=None, log=None, **kwargs):
+        """
+        :param hosts: list of hosts (None for the local journal)
+        :param hcls: a Handler class (not object)
+        :param args: passed through to hcls(self, *args, **kwargs)
+        :param units: see journal_command
+        :param priority: see journal_command
+        :param grep: see journal_command
+        :param fields: see journal_command
+        :param window: (float) seconds entries are held to be merged
+        :param mux: a WatchMultiplexer.  If None, a new one is created (and
+                    closed by close())
+        :param log: a file-like object every merged line is written to
+        """
+        self.window = window
+        self.log = log
+        self.entry = None
+        self.finished = False
+        self.counts = {}
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._own_mux = mux is None
+        self.mux = WatchMultiplexer() if mux is None else mux
+        self.handler = hcls(self, *args, **kwargs)
+        self.streams = []
+        for host in hosts:
+            cmd = journal_command(units=units, priority=priority, grep=grep,
+                                  fields=fields, remote=host is not None)
+            res = Command(cmd, host=host, user=user)(block=False,
+                                                     checkresult=(False, 0))
+            self.counts[host] = 0
+            name = "journal-{}-{}".format(host, id(self))
+            stream = self.mux.watch(res, _JournalParser, self, host, name=name,
+                                    seek_end=False)
+            self.streams.append(stream)
+        self.mux.add_hook(self._release, max(window / 4.0, 0.05))
+
+    def add_entry(self, host, entry):
+        try:
+            ts = int(entry["__REALTIME_TIMESTAMP"])
+        except (KeyError, ValueError):
+            ts = int(time.time() * 1e6)
+        with self._lock:
+            self.counts[host] = self.counts.get(host, 0) + 1
+            self._seq += 1
+            heapq.heappush(self._heap, (ts, self._seq, host, entry))
+
+    def _release(self, flush=False):
+        """
+        Dispatches, in timestamp order, every entry older than the window
+        """
+        watermark = (time.time() - self.window) * 1e6
+        while not self.finished:
+            with self._lock:
+                if not self._heap or (not flush and
+                                      self._heap[0][0] > watermark):
+                    return
+                _, _, host, entry = heapq.heappop(self._heap)
+            self._dispatch(host, entry)
+
+    def _dispatch(self, host, entry):
+        line = format_journal_entry(host, entry)
+        if self.log:
+            try:
+                self.log.write(line)
+            except ValueError:
+                pass
+        self.entry = dict(entry, host=host)
+        try:
+            keep_going = self.handler(line)
+        except MonitoredException as me:
+            glob_logger.info("Journal handler finished: {}".format(me))
+            keep_going = False
+        if keep_going is False:
+            self.terminate()
+
+    def terminate(self):
+        """
+        Stops every journalctl stream
+        """
+        self.finished = True
+        for stream in self.streams:
+            stream.terminate()
+
+    def is_alive(self):
+        return not self.finished and any(s.is_alive() for s in self.streams)
+
+    def poll(self):
+        return None if self.is_alive() else 0
+
+    def close(self, timeout=5):
+        if not self.finished:
+            self._release(flush=True)
+        self.terminate()
+        self.mux.remove_hook(self._release)
+        for stream in self.streams:
+            stream.wait(timeout)
+        if self._own_mux:
+            self.mux.close()
+        if self.log and self.log not in (sys.stdout, sys.stderr):
+            self.log.close()
+
+
 def make_watcher(cmd_, hcls, *args, host=None, cmd_kw=None, log=None, **kwargs):
     """
     Creates a Watcher and Handler, and adds the Watcher object to self
@@ -535,7 +1529,6 @@ if __name__ == "__main__":
     cmd = Command("python -u /home/stoner/dummy.py", host="10.13.57.47", user="stoner")
     logf = open("testlog.log", "w")
     watcher = make_watcher(cmd, ReaderHandler, logf, host="10.13.57.47")
-    import time
     i = 1
     while watcher.poll() is None:
         print("second = ", i)
@@ -570,6 +1563,5 @@ if __name__ == "__main__":
         # 6. Kick off the reader(producer) and consumer processes
         rdr_proc.start()
         mntr_proc.start()
-        import time
         time.sleep(5)
         watcher.close()
\ No newline at end of file
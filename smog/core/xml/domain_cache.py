@@ -0,0 +1,259 @@
+"""
+A cache of parsed libvirt domain XML, filled one hypervisor at a time.
+
+Verifying an instance (its huge pages, vcpu pinning, NUMA placement...) used
+to mean opening a connection to its hypervisor, fetching that one domain's
+XML, and parsing it.  DomainXMLCache.refresh(host) instead lists every domain
+on the hypervisor with one listAllDomains call, and fetches and parses the XML
+of the ones it hasn't seen yet (or which have changed), so verifying many
+instances costs one pass per hypervisor.
+
+Entries are keyed by domain UUID and a generation: the domain's id, which
+changes whenever it is started (or migrated), plus a count of the lifecycle
+events libvirt has sent for it (when the libvirt event loop is running).
+A hypervisor is refreshed again once ttl seconds have passed, or when a UUID
+is not found.
+
+The query helpers (hugepages, vcpupins, numatune, cputune, numa_cells) take
+the root Element of a domain.
+
+Usage::
+
+    from smog.core.xml.domain_cache import default_cache, hugepages
+
+    default_cache.refresh_hosts(computes)
+    for guest in guests:
+        root = default_cache.get(guest.id, host=compute)
+        print(hugepages(root))
+"""
+
+__author__ = 'stoner'
+
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+from smog.core.commander import fan_out
+from smog.core.libvirt_pool import default_pool
+from smog.core.logger import glob_logger
+
+
+class _Domain(object):
+    def __init__(self, host, name, generation, root):
+        self.host = host
+        self.name = name
+        self.generation = generation
+        self.root = root
+
+
+class DomainXMLCache(object):
+    """
+    Parsed domain XML trees of the domains on a set of hypervisors
+    """
+    def __init__(self, pool=None, user="root", driver="qemu+ssh", ttl=60,
+                 flags=0, logger=glob_logger):
+        """
+        :param pool: (LibvirtPool) where connections come from
+                     (smog.core.libvirt_pool.default_pool if None)
+        :param user: (str) user to connect to libvirt as
+        :param driver: (str) libvirt driver
+        :param ttl: (int) seconds after which a hypervisor is listed again
+        :param flags: flags passed to XMLDesc
+        """
+        self.pool = default_pool if pool is None else pool
+        self.user = user
+        self.driver = driver
+        self.ttl = ttl
+        self.flags = flags
+        self.logger = logger
+        self.fetches = 0
+        self._domains = {}
+        self._refreshed = {}
+        self._events = {}
+        # pool key -> the connection the event callback is registered on
+        self._watched = {}
+        self._lock = threading.RLock()
+
+    def _on_event(self, conn, dom, event, detail, opaque):
+        uuid = dom.UUIDString()
+        with self._lock:
+            self._events[uuid] = self._events.get(uuid, 0) + 1
+
+    def _watch(self, host, user, driver):
+        """
+        Counts the lifecycle events of the domains on host, if libvirt can
+        send them.  The callback belongs to the pool's underlying connection,
+        so it is registered again whenever the pool has replaced that (after
+        an eviction or a reconnect)
+        """
+        key = self.pool.key(host, user, driver)
+        conn = self.pool.connection(key)
+        with self._lock:
+            old = self._watched.get(key)
+            if old is conn:
+                return
+            self._watched[key] = conn
+            if old is not None:
+                # events sent while nothing was registered were missed, so
+                # the domains of host have to be fetched again
+                stale = [uuid for uuid, entry in self._domains.items()
+                         if entry.host == host]
+                for uuid in stale:
+                    del self._domains[uuid]
+        try:
+            conn.domainEventRegisterAny(None,
+                                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._on_event, None)
+        except (libvirt.libvirtError, AttributeError) as ex:
+            self.logger.debug("No domain events from {}: {}".format(host, ex))
+
+    def _generation(self, dom):
+        with self._lock:
+            return dom.ID(), self._events.get(dom.UUIDString(), 0)
+
+    def refresh(self, host, user=None, driver=None):
+        """
+        Lists the domains on host, and fetches the XML of any which are new
+        or have changed
+
+        :param host: (str) the hypervisor
+        :param user: (str) overrides self.user
+        :param driver: (str) overrides self.driver
+        :return: (int) number of domains whose XML was fetched
+        """
+        user = user or self.user
+        driver = driver or self.driver
+        conn = self.pool.get(host, user=user, driver=driver)
+        self._watch(host, user, driver)
+        fetched = 0
+        seen = set()
+        for dom in conn.listAllDomains(0):
+            uuid = dom.UUIDString()
+            seen.add(uuid)
+            generation = self._generation(dom)
+            with self._lock:
+                cached = self._domains.get(uuid)
+            if cached is not None and cached.host == host and \
+                    cached.generation == generation:
+                continue
+            try:
+                root = ET.fromstring(dom.XMLDesc(self.flags))
+            except libvirt.libvirtError as le:
+                # it went away between the listing and now
+                self.logger.debug("Could not get xml of {}: {}".format(uuid,
+                                                                       le))
+                continue
+            entry = _Domain(host, dom.name(), generation, root)
+            with self._lock:
+                self._domains[uuid] = entry
+            fetched += 1
+
+        with self._lock:
+            gone = [uuid for uuid, entry in self._domains.items()
+                    if entry.host == host and uuid not in seen]
+            for uuid in gone:
+                del self._domains[uuid]
+            self._refreshed[host] = time.time()
+            self.fetches += fetched
+        self.logger.debug("{} domains on {}, fetched {}".format(len(seen),
+                                                                host, fetched))
+        return fetched
+
+    def refresh_hosts(self, hosts, max_workers=10):
+        """
+        refresh on many hypervisors in parallel
+
+        :return: OrderedDict of host -> HostResult
+        """
+        return fan_out(self.refresh, hosts, max_workers=max_workers)
+
+    def get(self, uuid, host=None, user=None, driver=None):
+        """
+        :param uuid: (str) UUID of the domain (the nova instance id)
+        :param host: (str) the hypervisor the domain should be on.  If None,
+                     only hypervisors already in the cache are looked at
+        :param user: (str) overrides self.user
+        :param driver: (str) overrides self.driver
+        :return: the root Element of the domain's XML, or None if it isn't
+                 found
+        """
+        if host is not None:
+            with self._lock:
+                stale = time.time() - self._refreshed.get(host, 0) > self.ttl
+                cached = self._domains.get(uuid)
+                missing = cached is None or cached.host != host
+            if stale or missing:
+                self.refresh(host, user=user, driver=driver)
+        with self._lock:
+            entry = self._domains.get(uuid)
+        if entry is None or (host is not None and entry.host != host):
+            return None
+        return entry.root
+
+    def invalidate(self, uuid=None):
+        """
+        Drops uuid (or everything, if None) from the cache
+        """
+        with self._lock:
+            if uuid is None:
+                self._domains.clear()
+                self._refreshed.clear()
+            else:
+                self._domains.pop(uuid, None)
+
+
+default_cache = DomainXMLCache()
+
+
+def hugepages(root):
+    """
+    :param root: root Element of a domain's XML
+    :return: list of the attrib dicts of <memoryBacking><hugepages><page>
+    """
+    return [dict(page.attrib)
+            for page in root.findall("./memoryBacking/hugepages/page")]
+
+
+def vcpupins(root):
+    """
+    :return: dict of vcpu (int) -> cpuset (str) from <cputune><vcpupin>
+    """
+    return {int(pin.get("vcpu")): pin.get("cpuset")
+            for pin in root.findall("./cputune/vcpupin")}
+
+
+def numatune(root):
+    """
+    :return: dict with "memory" (the attrib dict of <numatune><memory>, or
+             None) and "memnodes" (list of <memnode> attrib dicts)
+    """
+    memory = root.find("./numatune/memory")
+    return {"memory": None if memory is None else dict(memory.attrib),
+            "memnodes": [dict(node.attrib)
+                         for node in root.findall("./numatune/memnode")]}
+
+
+def cputune(root):
+    """
+    :return: dict with "vcpupin" (see vcpupins), "emulatorpin" (cpuset or
+             None) and the text of any other <cputune> children (eg shares)
+    """
+    tune = {"vcpupin": vcpupins(root), "emulatorpin": None}
+    elem = root.find("./cputune")
+    if elem is None:
+        return tune
+    for child in elem:
+        if child.tag == "emulatorpin":
+            tune["emulatorpin"] = child.get("cpuset")
+        elif child.tag != "vcpupin":
+            tune[child.tag] = child.text
+    return tune
+
+
+def numa_cells(root):
+    """
+    :return: list of the attrib dicts of <cpu><numa><cell>
+    """
+    return [dict(cell.attrib) for cell in root.findall("./cpu/numa/cell")]
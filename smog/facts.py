@@ -0,0 +1,300 @@
+"""
+Gathers facts about hosts (NUMA topology, hugepages, nested KVM, distro and
+PCI devices) and keeps them in a local cache.
+
+All of the facts for a host are collected with one framed remote invocation
+(see smog.core.commander.run_framed), and hosts are gathered in parallel.  The
+facts are cached on disk keyed by host, along with the host's boot id.  On a
+later run:
+
+- if the facts are younger than ttl seconds, no remote call is made at all
+- otherwise only the volatile facts (boot id, free memory and hugepages) are
+  refreshed, and the static facts are reused
+- if the boot id changed (the host rebooted), or the cache was written by a
+  different FACTS_VERSION, everything is gathered again
+
+Usage::
+
+    from smog.facts import gather_facts
+
+    facts = gather_facts(["10.8.0.58", "10.8.0.59"])
+    for host, fact in facts.items():
+        print(host, fact.numa["number"], fact.hugepages["free"], fact.nested)
+"""
+
+__author__ = 'stoner'
+
+import json
+import os
+import re
+import threading
+import time
+import tempfile
+from collections import namedtuple, OrderedDict
+
+from smog.core.commander import run_framed, fan_out
+from smog.core.logger import glob_logger
+
+# Bump this whenever the fields or parsing of HostFacts change, so that stale
+# caches are thrown away
+FACTS_VERSION = 2
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "smog",
+                             "facts.json")
+
+HostFacts = namedtuple("HostFacts", ["host", "version", "boot_id",
+                                     "gathered_at", "refreshed_at", "numa",
+                                     "meminfo", "hugepages", "kvm", "nested",
+                                     "cpu_vendor", "distro", "pci"])
+
+VOLATILE_COMMANDS = OrderedDict([
+    ("boot_id", "cat /proc/sys/kernel/random/boot_id"),
+    ("meminfo", "cat /proc/meminfo"),
+    ("numactl", "numactl -H"),
+])
+
+STATIC_COMMANDS = OrderedDict([
+    ("kvm", "test -c /dev/kvm"),
+    ("lsmod", "lsmod"),
+    ("nested", "cat /sys/module/kvm_intel/parameters/nested "
+               "/sys/module/kvm_amd/parameters/nested 2>/dev/null"),
+    # RHEL/CentOS 6 has no /etc/os-release
+    ("os_release", "cat /etc/os-release 2>/dev/null || "
+                   "cat /etc/redhat-release"),
+    ("lspci", "lspci -Dnn"),
+])
+
+
+def parse_numactl(output):
+    """
+    Parses the output of numactl -H
+
+    :return: a dictionary of
+      node_num:  # where node_num is an int of the numa node index
+         "cpus": a string of the cpus in that node
+         "size": the total memory on the node in MB
+         "free": the free amount of memory on the numa node in MB
+      "number": the number of numa nodes
+    """
+    _patt = re.compile(r"node\s+(\d+)\s+(cpus|size|free):\s+(.+)")
+    nodes = {}
+    for line in output.split("\n"):
+        m = _patt.search(line)
+        if m:
+            node_num, key, val = m.groups()
+            node_num = int(node_num)
+
+            if node_num not in nodes:
+                nodes[node_num] = {}
+            nodes[node_num].update({key: val})
+    nodes["number"] = len(nodes.keys())
+    return nodes
+
+
+def parse_meminfo(output):
+    """
+    :return: dict of /proc/meminfo key -> int (in kB, or a count for the
+             HugePages_ entries)
+    """
+    info = {}
+    for line in output.split("\n"):
+        key, _, val = line.partition(":")
+        toks = val.split()
+        if key and toks and toks[0].isdigit():
+            info[key.strip()] = int(toks[0])
+    return info
+
+
+def parse_os_release(output):
+    """
+    Parses /etc/os-release, or /etc/redhat-release where there is none
+    (eg "CentOS release 6.7 (Final)")
+
+    :return: dict with the name, version and codename of the distro
+    """
+    m = re.search(r"^(.+?) release (\S+)(?: \((.+)\))?\s*$", output.strip())
+    if m and "=" not in output:
+        name, version, codename = m.groups()
+        return {"name": name, "version": version, "codename": codename or ""}
+    fields = {}
+    for line in output.split("\n"):
+        key, _, val = line.partition("=")
+        fields[key.strip()] = val.strip().strip('"')
+    codename = fields.get("VERSION", "")
+    m = re.search(r"\((.+)\)", codename)
+    return {"name": fields.get("NAME", ""),
+            "version": fields.get("VERSION_ID", ""),
+            "codename": m.groups()[0] if m else ""}
+
+
+def parse_lspci(output):
+    """
+    :return: list of dicts with the address, class, vendor and device id of
+             each PCI device, and its description
+    """
+    patt = re.compile(r"^(\S+)\s+(.+?)\s+\[([0-9a-f]{4})\]:\s+(.+)\s+"
+                      r"\[([0-9a-f]{4}):([0-9a-f]{4})\]")
+    devices = []
+    for line in output.split("\n"):
+        m = patt.search(line)
+        if m:
+            addr, cls_name, cls_id, desc, vendor, device = m.groups()
+            devices.append({"address": addr, "class": cls_id,
+                            "class_name": cls_name, "description": desc,
+                            "vendor": vendor, "device": device})
+    return devices
+
+
+def _volatile(frames):
+    """
+    :return: dict of the volatile fields of HostFacts from the framed output
+    """
+    meminfo = parse_meminfo(frames["meminfo"].output or "")
+    hugepages = {"total": meminfo.get("HugePages_Total", 0),
+                 "free": meminfo.get("HugePages_Free", 0),
+                 "size_kb": meminfo.get("Hugepagesize", 0)}
+    numa = {}
+    if frames["numactl"].returncode == 0:
+        numa = parse_numactl(frames["numactl"].output)
+    return {"boot_id": (frames["boot_id"].output or "").strip(),
+            "meminfo": meminfo, "hugepages": hugepages, "numa": numa,
+            "refreshed_at": time.time()}
+
+
+def _static(frames):
+    """
+    :return: dict of the static fields of HostFacts from the framed output
+    """
+    vendor = None
+    m = re.search(r"^kvm_(intel|amd)\s", frames["lsmod"].output or "", re.M)
+    if m:
+        vendor = m.groups()[0]
+    nested = any(v in ("Y", "1") for v in
+                 (frames["nested"].output or "").split())
+    return {"kvm": frames["kvm"].returncode == 0,
+            "nested": nested,
+            "cpu_vendor": vendor,
+            "distro": parse_os_release(frames["os_release"].output or ""),
+            "pci": parse_lspci(frames["lspci"].output or "")}
+
+
+class FactCache(object):
+    """
+    A JSON file of host -> HostFacts
+    """
+    def __init__(self, path=DEFAULT_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._facts = None
+
+    def _load(self):
+        if self._facts is not None:
+            return
+        self._facts = {}
+        try:
+            with open(self.path, "r") as cache_f:
+                data = json.load(cache_f)
+        except (IOError, OSError, ValueError):
+            return
+        for entry in data.values():
+            if entry.get("version") != FACTS_VERSION:
+                continue
+            try:
+                fact = HostFacts(**entry)
+            except TypeError:
+                continue
+            # json turns the int numa node keys into strs
+            numa = {(int(k) if k.isdigit() else k): v
+                    for k, v in fact.numa.items()}
+            self._facts[fact.host] = fact._replace(numa=numa)
+
+    def get(self, host):
+        with self._lock:
+            self._load()
+            return self._facts.get(host)
+
+    def put(self, fact):
+        with self._lock:
+            self._load()
+            self._facts[fact.host] = fact
+
+    def invalidate(self, host=None):
+        with self._lock:
+            self._load()
+            if host is None:
+                self._facts.clear()
+            else:
+                self._facts.pop(host, None)
+
+    def save(self):
+        """
+        Atomically writes the cache to self.path
+        """
+        with self._lock:
+            self._load()
+            data = {h: f._asdict() for h, f in self._facts.items()}
+            dirname = os.path.dirname(self.path) or "."
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".facts")
+            with os.fdopen(fd, "w") as tmp_f:
+                json.dump(data, tmp_f)
+            os.rename(tmp, self.path)
+
+
+default_fact_cache = FactCache()
+
+
+def host_facts(host, cache=None, ttl=60, refresh=False, user="root"):
+    """
+    Gets the facts for one host, making at most two framed remote calls
+
+    :param host: (str) ip or hostname
+    :param cache: (FactCache) if None, use default_fact_cache
+    :param ttl: (int) seconds for which cached facts are used as is
+    :param refresh: (bool) ignore the cache and gather everything
+    :return: HostFacts
+    """
+    cache = default_fact_cache if cache is None else cache
+    cached = None if refresh else cache.get(host)
+    if cached is not None and time.time() - cached.refreshed_at < ttl:
+        return cached
+
+    commands = OrderedDict(VOLATILE_COMMANDS)
+    if cached is None:
+        commands.update(STATIC_COMMANDS)
+    frames = run_framed(host, commands, user=user)
+    if frames["boot_id"].returncode != 0:
+        raise Exception("Could not gather facts from {}".format(host))
+    volatile = _volatile(frames)
+
+    if cached is not None and cached.boot_id == volatile["boot_id"]:
+        fact = cached._replace(**volatile)
+    else:
+        if cached is not None:
+            glob_logger.info("{} rebooted, regathering facts".format(host))
+            frames.update(run_framed(host, STATIC_COMMANDS, user=user))
+        fields = dict(volatile, **_static(frames))
+        fact = HostFacts(host=host, version=FACTS_VERSION,
+                         gathered_at=volatile["refreshed_at"], **fields)
+    cache.put(fact)
+    return fact
+
+
+def gather_facts(hosts, cache=None, ttl=60, refresh=False, user="root",
+                 max_workers=10):
+    """
+    Gets the facts of all hosts in parallel, and saves the cache
+
+    :param hosts: sequence of ip addresses or hostnames
+    :return: OrderedDict of host -> HostFacts
+    """
+    cache = default_fact_cache if cache is None else cache
+
+    def gather(host):
+        return host_facts(host, cache=cache, ttl=ttl, refresh=refresh,
+                          user=user)
+
+    results = fan_out(gather, hosts, max_workers=max_workers, throws=True)
+    cache.save()
+    return OrderedDict((h, r.value) for h, r in results.items())
@@ -4,7 +4,9 @@ import os
 
 from smog.core.exceptions import ArgumentError
 from smog import add_client_to_path
-from smog.core.downloader import Downloader
+from smog.core.downloader import default_downloader
+from smog.core.metrics import instrument
+from smog.catalog import Catalog
 
 DEBUG = False
 add_client_to_path(debug=DEBUG)
@@ -30,7 +32,7 @@ def create_glance(keystone_cl, version):
     glance_endpt = url_for(service_type="image", endpoint_type="publicURL") + "/v" + version
     glance = GlanceFactory(endpoint=glance_endpt,
                            token=keystone_cl.auth_token)
-    return glance
+    return instrument(glance, "glance")
 
 
 def glance_image_list(gl_obj):
@@ -97,6 +99,7 @@ def create_image(glance_cl, path, img_name, public=True, disk_format="qcow2",
         glance_cl.images.create(name=img_name, is_public=public, data=fimage,
                                 disk_format=disk_format, properties=properties,
                                 container_format=container_format)
+    Catalog.invalidate_all("images")
 
     # stupidly, the python-glanceclient Image.create() does not return anything
     # so let's figure out if it was successful or not and return the newly
@@ -142,11 +145,23 @@ def set_image_property(img, meta):
     return update_image(img, properties=meta)
 
 
-def get_cloud_image(location, name):
-    # Download a cirros image
-    if not os.path.exists(location):
-        if not Downloader.download_url(location, "/tmp", binary=True):
-            raise Exception("Could not download cirros image")
-        else:
-            location = "/tmp/" + name
-    return location
\ No newline at end of file
+def get_cloud_image(location, name, checksum=None, downloader=None):
+    """
+    Gets a cloud image (eg cirros) into /tmp/<name>, unless location is
+    already a local file.  Images come from the download cache, so one that
+    was already downloaded is not fetched again
+
+    :param location: local path or url of the image
+    :param name: file name to give it in /tmp
+    :param checksum: optional "algo:hexdigest" to verify the download
+    :param downloader: a StreamingDownloader (default_downloader if None)
+    :return: the local path of the image
+    """
+    if os.path.exists(location):
+        return location
+    downloader = default_downloader if downloader is None else downloader
+    try:
+        return downloader.fetch_to(location, os.path.join("/tmp", name),
+                                   checksum=checksum)
+    except Exception as ex:
+        raise Exception("Could not download cirros image: {}".format(ex))
\ No newline at end of file
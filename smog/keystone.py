@@ -22,6 +22,7 @@ add_client_to_path(debug=DEBUG)
 import keystoneclient.v2_0.client as ksclient
 from smog import load_config
 from smog.core.logger import glob_logger
+from smog.core.metrics import instrument
 
 
 def get_keystone_init(**kwargs):
@@ -82,7 +83,7 @@ def create_keystone(**kwargs):
         creds.update(valid)
 
     keystone = ksclient.Client(**creds)
-    return keystone
+    return instrument(keystone, "keystone")
 
 
 def get_endpoint(key_cl, name, end_type="publicURL"):
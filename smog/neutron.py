@@ -3,6 +3,7 @@ __author__ = 'stoner'
 from neutronclient.v2_0.client import Client
 
 from smog.core.exceptions import AmbiguityException, ArgumentError
+from smog.core.metrics import instrument
 
 
 def create_neutron_client(key_cl=None, creds=None):
@@ -21,7 +22,7 @@ def create_neutron_client(key_cl=None, creds=None):
                  "password": key_cl.password,
                  "auth_url": key_cl.auth_url}
 
-    return Client(**creds)
+    return instrument(Client(**creds), "neutron")
 
 
 def list_neutron_nets(net_cl, filter_fn=None):
@@ -73,7 +74,7 @@ def has_network_field(value, key="name"):
     return find
 
 
-def get_network_uuid(net_cl, name="private", no_ambiguity=True):
+def get_network_uuid(net_cl, name="private", no_ambiguity=True, catalog=None):
     """
     Retrieves the network UUID from neutron with the matching name.
 
@@ -83,14 +84,20 @@ def get_network_uuid(net_cl, name="private", no_ambiguity=True):
 
     :param net_cl: a neutron client
     :param name: (str) name of the network (eg "public")
-    :return: the UUID (str) of the network from neutron
+    :param catalog: optional smog.catalog.Catalog to look the network up in,
+                    rather than listing the networks
+    :return: the UUID (str) of the network from neutron, or None
     """
-    name_pred = has_network_field(name)
-    nets = list_neutron_nets(net_cl, filter_fn=name_pred)
+    if catalog is not None:
+        nets = catalog.networks.by_name(name)
+    else:
+        name_pred = has_network_field(name)
+        nets = list_neutron_nets(net_cl, filter_fn=name_pred)
 
     if len(nets) > 1 and no_ambiguity:
-        err = "Found more than one net: ".format(nets)
+        err = "Found more than one net: {}".format(nets)
         raise AmbiguityException(err)
+    return nets[0]["id"] if nets else None
 
 
 class NIC:
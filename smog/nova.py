@@ -5,10 +5,16 @@ import httplib2
 import os
 import json
 import time
+import threading
+import datetime
+from collections import OrderedDict
+from concurrent.futures import Future
 
 from smog.keystone import get_keystone_init
 from smog import add_client_to_path
 from smog.core.logger import glob_logger
+from smog.core.metrics import instrument
+from smog.catalog import Catalog
 
 DEBUG = False
 add_client_to_path(debug=DEBUG)
@@ -57,7 +63,7 @@ def create_nova_client(key_cl, creds=None):
     nvcreds = [creds[key]
                for key in ["username", "password", "tenant_name", "auth_url"]]
     nova = nvclient.Client(*nvcreds)
-    return nova
+    return instrument(nova, "nova")
 
 
 def boot_instance(nc, server_name, server_image, flavor, **kwargs):
@@ -321,6 +327,328 @@ def poll_status(instance, status, block=True, poll_interval=3, timeout=300,
                                 timeout=timeout, log=log)
 
 
+class StatusWaiter(object):
+    """
+    Waits for many instances to reach a status with one API call per tick.
+
+    Rather than calling instance.get() for every instance, each tick makes a
+    single servers.list call with changes-since set to the last time any
+    server changed, so that only the servers which changed come back (a newly
+    watched instance is looked up once with servers.get, in case it is
+    already in the wanted status).  When an API call fails, or a tick brings
+    no news about the watched instances, the interval grows by backoff (up to
+    max_interval), and it drops back to poll_interval as soon as something
+    changes.
+
+    Every watched instance gets a Future, which resolves to True if the status
+    was reached and to False if the instance went to ERROR (when not waiting
+    for ERROR), vanished or timed out, just like poll_status.
+
+    Usage::
+
+        waiter = StatusWaiter(nova)
+        futures = [waiter.watch(inst, "ACTIVE") for inst in instances]
+        results = waiter.wait()      # or waiter.start() to poll in a thread
+    """
+    def __init__(self, nc, poll_interval=2, max_interval=15, backoff=1.5,
+                 timeout=300, skew=60, logger=glob_logger):
+        """
+        :param nc: a nova client instance
+        :param poll_interval: (float) seconds between ticks while servers are
+                              changing
+        :param max_interval: (float) upper bound on the seconds between ticks
+        :param backoff: (float) how much the interval grows after a quiet tick
+        :param timeout: (float) default seconds to wait for each instance
+        :param skew: (int) seconds subtracted from changes-since, to allow for
+                     the clock of this host being ahead of the server's
+        """
+        self.nc = nc
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.skew = skew
+        self.logger = logger
+        self.interval = poll_interval
+        self.since = None
+        self.calls = 0
+        self._pending = OrderedDict()
+        self._fresh = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def watch(self, instance, status, callback=None, timeout=None):
+        """
+        Starts tracking an instance
+
+        :param instance: a Server instance
+        :param status: a nova status (eg "ACTIVE"), or "deleted"
+        :param callback: optional fn(instance, achieved) called once it is
+                         known whether the status was reached
+        :param timeout: seconds to wait, defaults to self.timeout
+        :return: a concurrent.futures.Future
+        """
+        fut = Future()
+        if callback is not None:
+            fut.add_done_callback(lambda f: callback(instance, f.result()))
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        start = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=self.skew)
+        with self._lock:
+            if self.since is None or start < self.since:
+                self.since = start
+            self._pending[instance.id] = (instance, status, deadline, fut)
+            self._fresh.add(instance.id)
+        self.interval = self.poll_interval
+        self._wakeup.set()
+        return fut
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _resolve(self, inst_id, achieved):
+        with self._lock:
+            entry = self._pending.pop(inst_id, None)
+        if entry is not None:
+            entry[3].set_result(achieved)
+
+    def _check(self, instance, status, server_status):
+        """
+        :return: True or False once the outcome is known, otherwise None
+        """
+        if server_status == "DELETED":
+            return status == "deleted"
+        if server_status == "ERROR":
+            if status != "ERROR":
+                self.logger.error("{} went to ERROR".format(instance.name))
+            return status == "ERROR"
+        if server_status == status:
+            return True
+        return None
+
+    def _update(self, srv):
+        """
+        Updates the watched instance srv is about, and resolves its future if
+        the outcome is known
+
+        :return: True if srv is a watched instance
+        """
+        with self._lock:
+            entry = self._pending.get(srv.id)
+        if entry is None:
+            return False
+        instance, status, _, _ = entry
+        try:
+            instance._add_details(srv._info)
+        except AttributeError:
+            instance.status = srv.status
+        achieved = self._check(instance, status, srv.status)
+        if achieved is not None:
+            self._resolve(srv.id, achieved)
+        else:
+            msg = "Checking for {} on {}: status is {}"
+            self.logger.debug(msg.format(status, instance.name, srv.status))
+        return True
+
+    def _check_new(self):
+        """
+        changes-since only returns servers updated after it, so an instance
+        which was already in its status when it was watched would never show
+        up.  Each newly watched instance is therefore looked at once with
+        servers.get
+
+        :return: number of new instances checked
+        """
+        with self._lock:
+            fresh = [k for k in self._fresh if k in self._pending]
+        for inst_id in fresh:
+            self.calls += 1
+            try:
+                srv = self.nc.servers.get(inst_id)
+            except NotFound:
+                with self._lock:
+                    entry = self._pending.get(inst_id)
+                if entry is not None:
+                    self._resolve(inst_id, entry[1] == "deleted")
+            else:
+                self._update(srv)
+            with self._lock:
+                self._fresh.discard(inst_id)
+        return len(fresh)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (_, _, deadline, _) in self._pending.items()
+                       if deadline is not None and deadline < now]
+        for inst_id in expired:
+            self._resolve(inst_id, False)
+
+    def tick(self):
+        """
+        Makes one servers.list call (plus one servers.get per newly watched
+        instance) and resolves the futures of the instances whose outcome is
+        now known.  Instances past their deadline are resolved to False even
+        if the API calls fail
+
+        :return: number of watched instances which changed
+        """
+        try:
+            return self._tick()
+        finally:
+            self._expire()
+
+    def _tick(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+        self._check_new()
+        with self._lock:
+            if not self._pending:
+                return 0
+            since = self.since
+        opts = {"changes-since": since.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        self.calls += 1
+        servers = self.nc.servers.list(detailed=True, search_opts=opts)
+
+        changed = 0
+        newest = None
+        for srv in servers:
+            updated = getattr(srv, "updated", None)
+            if updated:
+                try:
+                    ts = datetime.datetime.strptime(updated,
+                                                    "%Y-%m-%dT%H:%M:%SZ")
+                    newest = ts if newest is None else max(newest, ts)
+                except ValueError:
+                    pass
+            if self._update(srv):
+                changed += 1
+
+        if newest is not None:
+            # Anything older than newest has already been seen
+            newest -= datetime.timedelta(seconds=self.skew)
+            with self._lock:
+                self.since = max(self.since, newest)
+
+        if changed:
+            self.interval = self.poll_interval
+        else:
+            self._back_off()
+        return changed
+
+    def _back_off(self):
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def _safe_tick(self):
+        """
+        tick, but a failing API call is logged and backed off from rather
+        than raised, so that polling carries on until the deadlines
+        """
+        try:
+            return self.tick()
+        except Exception as ex:
+            self.logger.error("StatusWaiter tick failed: {}".format(ex))
+            self._back_off()
+            return 0
+
+    def _sleep(self):
+        with self._lock:
+            deadlines = [d for _, _, d, _ in self._pending.values()
+                         if d is not None]
+        delay = self.interval
+        if deadlines:
+            delay = max(0, min(delay, min(deadlines) - time.time()))
+        self._wakeup.wait(delay)
+        self._wakeup.clear()
+
+    def wait(self):
+        """
+        Polls in this thread until every watched instance is resolved
+
+        :return: OrderedDict of instance id -> bool (achieved or not)
+        """
+        with self._lock:
+            futures = OrderedDict((k, e[3]) for k, e in self._pending.items())
+        if self._thread is None:
+            while self.pending:
+                self._safe_tick()
+                if self.pending:
+                    self._sleep()
+        return OrderedDict((k, f.result()) for k, f in futures.items())
+
+    def _run(self):
+        while not self._stopped:
+            if self.pending:
+                self._safe_tick()
+            self._sleep()
+
+    def start(self):
+        """
+        Polls from a daemon thread, so that watch() can be called at any time
+        and futures resolve in the background
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="StatusWaiter")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the polling thread.  Futures still pending are left unresolved
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def histogram(values, buckets=(15, 30, 60, 120, 300)):
+    """
+    Counts values into buckets, eg for instance boot times
+
+    :param values: sequence of numbers
+    :param buckets: ascending upper bounds
+    :return: OrderedDict of "<=bound" (and ">last bound") -> count
+    """
+    counts = OrderedDict(("<={}".format(b), 0) for b in buckets)
+    counts[">{}".format(buckets[-1])] = 0
+    for val in values:
+        for b in buckets:
+            if val <= b:
+                counts["<={}".format(b)] += 1
+                break
+        else:
+            counts[">{}".format(buckets[-1])] += 1
+    return counts
+
+
+def wait_for_status(nc, instances, status, timeout=300, poll_interval=2,
+                    max_interval=15):
+    """
+    Waits for all instances to reach status, with one API call per tick for
+    all of them (see StatusWaiter)
+
+    :param nc: a nova client instance
+    :param instances: sequence of Server instances
+    :param status: a nova status, or "deleted"
+    :return: OrderedDict of instance id -> bool
+    """
+    waiter = StatusWaiter(nc, poll_interval=poll_interval,
+                          max_interval=max_interval, timeout=timeout)
+    for instance in instances:
+        waiter.watch(instance, status)
+    return waiter.wait()
+
+
 def server_group_create(nc, name, policies="affinity"):
     """
     Creates an affinity or anti-affinity group
@@ -346,4 +674,6 @@ def create_flavor(nc, name, ram, num_vcpus, disksize):
     :param disksize: the disksize in GB
     :return:
     """
-    return nc.flavors.create(name, ram, num_vcpus, disksize)
\ No newline at end of file
+    flavor = nc.flavors.create(name, ram, num_vcpus, disksize)
+    Catalog.invalidate_all("flavors")
+    return flavor
\ No newline at end of file
@@ -2,16 +2,17 @@
 This is the base class from which all the fog.tests classes should inherit from.
 """
 import time
+import threading
 
 __author__ = 'stoner'
 
 from abc import ABCMeta
 import unittest
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from functools import wraps, reduce
 import re
-import xml.etree.ElementTree as ET
+import shlex
 import sys
 import random
 
@@ -19,18 +20,25 @@ import libvirt
 from novaclient.exceptions import NotFound
 
 import smog.nova
+import smog.keystone
 from smog.core.logger import glob_logger, make_timestamped_filename
-from smog.keystone import create_keystone
-from smog.nova import create_nova_client, list_flavors, list_instances
-from smog.glance import create_glance, glance_image_list, glance_images_by_name
-from smog.neutron import create_neutron_client
+from smog.nova import list_instances
 from smog.core.exceptions import ReadOnlyException, BootException, ArgumentError
-from smog.nova import boot_instance, poll_status
+from smog.nova import boot_instance
 from smog.core.commander import Command, CommandException
-from smog.core.watcher import Watcher, ExceptionHandler
+from smog.core.commander import run_framed, fan_out
+from smog.core.watcher import ExceptionHandler, WatchMultiplexer
+from smog.core.watcher import HandlerGroup
 import smog.core.exceptions as sce
 import smog.virt
 import smog.neutron
+import smog.facts
+import smog.clients
+from smog.catalog import Catalog
+from smog.core.metrics import default_registry
+from smog.core.cfgedit import edit_file, ConfigEditError
+from smog.core.libvirt_pool import default_pool as libvirt_pool
+import smog.core.xml.domain_cache as domain_cache
 
 TRACE = 5
 LOGGER = glob_logger
@@ -117,11 +125,11 @@ def declare(fn):
 
 
 def get_virt_connection(ip, user, driver="qemu+ssh"):
-    drv_format = "{}://{}@{}/system".format(driver, user, ip)
-    glob_logger.info("getting libvirt xml from {}".format(drv_format))
-
-    conn = libvirt.open(drv_format)
-    return conn
+    """
+    :return: a PooledConnection to the hypervisor (see
+             smog.core.libvirt_pool).  Closing it does nothing
+    """
+    return libvirt_pool.get(ip, user=user, driver=driver)
 
 
 def get_hosts_from_uri(opts):
@@ -254,6 +262,81 @@ def openstack_config(cfile, section, key, value="", opt="get", host=None):
     return res
 
 
+def parse_config_value(val):
+    """
+    Turns a value read from a config file into a bool, int or float if it
+    looks like one
+
+    :param val: (str) the value
+    :return: the typed value (or val, stripped, if it is just a string)
+    """
+    val = val.strip()
+    if val.lower() in ("true", "false"):
+        return val.lower() == "true"
+    for typ in (int, float):
+        try:
+            return typ(val)
+        except ValueError:
+            pass
+    return val
+
+
+def openstack_configs(cfile, items, opt="get", host=None, typed=True):
+    """
+    Batched version of openstack_config, which gets (or sets) many keys of
+    cfile with a single remote invocation
+
+    :param cfile: (str) path to cfile on host
+    :param items: if opt="get", a list of (section, key).  If opt="set", a
+                  dict of (section, key) -> value (use an OrderedDict to
+                  control the order they are set in)
+    :param opt: (str) one of "get" or "set"
+    :param host: (str) host to run on, or None for the local machine
+    :param typed: (bool) convert the values with parse_config_value
+    :return: OrderedDict of (section, key) -> value, or None if the key is
+             not in cfile.  For opt="set" the values are read back after
+             setting them, so they show what was actually written
+    """
+    keys = list(items)
+    commands = OrderedDict()
+    for i, (section, key) in enumerate(keys):
+        args = " ".join(shlex.quote(str(a)) for a in (cfile, section, key))
+        if opt == "set":
+            value = shlex.quote(str(items[(section, key)]).strip())
+            commands["s{}".format(i)] = "openstack-config --set {} {}".format(
+                args, value)
+        commands["g{}".format(i)] = "openstack-config --get {}".format(args)
+    frames = run_framed(host, commands)
+
+    found = OrderedDict()
+    for i, item in enumerate(keys):
+        setter = frames.get("s{}".format(i))
+        if setter is not None and setter.returncode != 0:
+            LOGGER.error("Setting {} in {} on {} failed: {}".format(
+                item, cfile, host, setter.output))
+        getter = frames["g{}".format(i)]
+        if getter.returncode != 0:
+            found[item] = None
+        elif typed:
+            found[item] = parse_config_value(getter.output)
+        else:
+            found[item] = getter.output.strip()
+    return found
+
+
+def openstack_configs_on_hosts(hosts, cfile, items, opt="get", typed=True,
+                               max_workers=10):
+    """
+    openstack_configs on many hosts in parallel
+
+    :return: OrderedDict of host -> HostResult, where HostResult.value is the
+             OrderedDict returned by openstack_configs
+    """
+    return fan_out(lambda h: openstack_configs(cfile, items, opt=opt, host=h,
+                                               typed=typed),
+                   hosts, max_workers=max_workers)
+
+
 def get_cfg(key, cfile):
     """
     Finds all occurrences of key in a file.  The key must be at the beginning
@@ -291,8 +374,9 @@ def set_cfg(token, value, o_file, b_file, not_found="ignore", delim=None,
     """Change the value of the token in a given config file.
 
     This function was made to replace the ConfigParser class, because the
-    parser object does not save any comments.  The disadvantage of this function
-    is that multiple adjustments requires writing multiple times
+    parser object does not save any comments.  To change several keys, pass
+    them all to smog.core.cfgedit.edit_file instead, which reads and writes
+    the file only once
 
     :param token: (str) key within the config file
     :param value: (str) value for token.  if None, return value of key
@@ -301,106 +385,39 @@ def set_cfg(token, value, o_file, b_file, not_found="ignore", delim=None,
         before changing the original file.
     :param not_found: (str) can be one of 'ignore', 'append', or 'fail'.
         ignore: if no match is found by the end of the file, dont write
-        append: will append at the end of the file
+        append: will append at the end of the file (or of section)
         fail: will throw an exception if no match is found
     :param delim: If specified, use delim as the delimiter instead of
         what is found from the regex.
     :param section: The section the token|value should belong to.
     """
-    # Write a backup before changing the original.
+    if value is None:
+        return get_cfg(token, o_file)
+
     msg = "Trying to set {} to {} in file {}".format(token, value, o_file)
     LOGGER.log(TRACE, msg)
-    org_file = open(o_file, 'r')
-    backup_file = open(b_file, 'w')
-    make_backup_file(org_file, backup_file, o_file)
-
+    edit = {"op": "set", "key": token, "value": value, "section": section,
+            "not_found": not_found, "delim": delim}
     try:
-        # here is where we overwrite the original file after creating a backup.
-        new_file = open(o_file, 'w')
-        backup_file = open(b_file, 'r')
-        new_lines = backup_file.readlines()
-
-        # This is a regex to read a line, and see if we have a match.  If it
-        # matches, match.groups() will return 4 capturing groups: a comment
-        # key, delimiter, and value
-        s = r"(#\s*)*\s*({0})(\s*[=:]\s*)(.*)".format(token)
-        patt = re.compile(s)
-        sect_patt = re.compile(r"\[(\w+)\]")
-
-        found = []
-        matched = False
-        current_section = None
-        for i, line in enumerate(new_lines):
-            sect = sect_patt.search(line)
-            if section and sect:
-                new_sect = sect.groups()[0]
-                if not_found == "append" and not found:
-                    d = delim if delim is not None else "="
-                    line = "{0}{1}{2}\n{3}\n".format(token, d, value, line)
-                    msg = "Appending {} to section {}".format(line,
-                                                              current_section)
-                    LOGGER.log(TRACE, msg)
-                    found.append(value)
-                    matched = True
-                current_section = new_sect
-            if section is not None and section != current_section:
-                continue
-
-            m = patt.search(line)
-            if m:
-                comment, key, delimiter, val = m.groups()
-                if delim == "strip":
-                    delimiter = delimiter.strip()
-                else:
-                    delimiter = delim if delim is not None else delimiter
-                # If we've already found the token, skip it
-                if key in found:
-                    msg = "Already found {0} in {1}".format(token, line)
-                    LOGGER.log(TRACE, msg)
-                    if comment is None:
-                        # don't write out the line, since we already wrote it
-                        continue
-                else:
-                    line = "{0}{1}{2}\n".format(token, delimiter, value)
-                    msg = "Matched {0}->{1} on line {2}, setting to {3}"
-                    msg = msg.format(token, key, i, line)
-                    LOGGER.log(TRACE, msg)
-                    found.append(key)
-                    matched = True
-            new_file.write(line)
-
-        if not matched:
-            if not_found == "fail":
-                msg = "Could not find {0} in file {1}".format(token, o_file)
-                raise Exception(msg)
-            elif not_found == "append":
-                delim = "=" if delim is None else delim
-                line = "{0}{1}{2}\n".format(token, delim, value)
-                msg = "{0} was not found in {1}. Appending {2}"
-                msg = msg.format(token, o_file, line)
-                LOGGER.log(TRACE, msg)
-                new_file.write(line)
-
-        new_file.close()
-        backup_file.close()
-    except IOError:
-        print("Could complete requested file modification on: "
-              "{0} and {1}".format(o_file, b_file))
-        exit()
+        edit_file(o_file, [edit], backup=b_file, keep_original=True)
+    except ConfigEditError as cee:
+        raise Exception("{0} in file {1}".format(cee, o_file))
 
     return get_cfg(token, o_file)
 
 
-def read_proc_file(host, mfile):
+def read_proc_file(host, mfile, cache=False):
     """
     This function is meant to be called on small in-memory files
 
     It could in theory be used to get contents of regular files too
     :param host: (str) ip of host to run command
     :param mfile: (str) file path
+    :param cache: (bool|CommandCache) reuse a recent result (see CommandCache)
     :return: result of cat on the file
     """
-    res = Command("cat {}".format(mfile), host=host)(showout=False)
+    cmd = Command("cat {}".format(mfile), host=host, cache=cache)
+    res = cmd(showout=False)
     return res
 
 
@@ -420,24 +437,78 @@ def echo_proc_file(host, mfile, content, append=True):
     return Command(cmd, host=host)()
 
 
-def get_free_hugepages(host):
+def _file_commands(files, fmt="cat {}"):
+    return OrderedDict(("f{}".format(i), fmt.format(shlex.quote(f)))
+                       for i, f in enumerate(files))
+
+
+def read_proc_files(host, files):
+    """
+    Batched version of read_proc_file, which reads all of files with a single
+    remote invocation
+
+    :param host: (str) ip of host to run command
+    :param files: list of file paths
+    :return: OrderedDict of path -> contents (str), or None if the file could
+             not be read
+    """
+    commands = _file_commands(files)
+    frames = run_framed(host, commands)
+    return OrderedDict((f, frames[name].output
+                        if frames[name].returncode == 0 else None)
+                       for f, name in zip(files, commands))
+
+
+def read_proc_files_on_hosts(hosts, files, max_workers=10):
+    """
+    read_proc_files on many hosts in parallel
+
+    :return: OrderedDict of host -> HostResult, where HostResult.value is the
+             OrderedDict returned by read_proc_files
+    """
+    return fan_out(lambda h: read_proc_files(h, files), hosts,
+                   max_workers=max_workers)
+
+
+def echo_proc_files(host, contents, append=True):
+    """
+    Batched version of echo_proc_file, which writes to several files with a
+    single remote invocation
+
+    :param host: str, IP address of remote host
+    :param contents: OrderedDict of path -> content to write to it
+    :param append: boolean, if true, append to existing files
+    :return: OrderedDict of path -> returncode of the write
+    """
+    redirect = ">>" if append else ">"
+    commands = OrderedDict()
+    for i, (path, content) in enumerate(contents.items()):
+        cmd = "echo {} {} {}".format(shlex.quote(str(content)), redirect,
+                                     shlex.quote(path))
+        commands["f{}".format(i)] = cmd
+    frames = run_framed(host, commands)
+    for path, name in zip(contents, commands):
+        if frames[name].returncode != 0:
+            LOGGER.error("Writing {} on {} failed: {}".format(
+                path, host, frames[name].output))
+    return OrderedDict((path, frames[name].returncode)
+                       for path, name in zip(contents, commands))
+
+
+def get_free_hugepages(host, ttl=0):
     """
     Determine how many huge free pages lg_host_ip has
     :param host:
+    :param ttl: (int) seconds for which the cached facts of host are used as
+                is.  Free pages change with every instance, so by default
+                they are read again
     :return:
     """
-    res = read_proc_file(host, "/proc/meminfo")
-    patt = re.compile(r"HugePages_Free:\s+(\d+)")
-
-    for line in res.output.split("\n"):
-        m = patt.search(line)
-        if m:
-            free_pages = m.groups()[0]
-            break
-    else:
+    fact = smog.facts.host_facts(host, ttl=ttl)
+    if "HugePages_Free" not in fact.meminfo:
         err = "{} has no free HugePages".format(host)
         raise sce.FreePageException(err)
-    return int(free_pages.strip())
+    return fact.hugepages["free"]
 
 
 def set_hugepages(host, num_pages=256, persistent=False):
@@ -526,8 +597,8 @@ class Host(object):
     def type(self, _):
         raise AttributeError("Cant change value of type")
 
-    # FIXME:  This should become a Context Manager so that we can clean the
-    # resources of the libvirt connection better
+    # The connection is shared through the libvirt pool, so there is nothing
+    # to clean up after using it
     def get_libvirt_conn(self):
         return get_virt_connection(self.host, self.user, driver=self.driver)
 
@@ -666,29 +737,31 @@ class Instance(object):
         :param driver: (str) the libvirt driver to use
         :return: a string of the XML domain information
         """
-        driver = self.host.driver
-        user = self.host.user
-        host = self.host.host
-        drv_format = "qemu:///system"
         uid = self.instance.id
-
-        if host is not None:
-            drv_format = "{}://{}@{}/system".format(driver, user, host)
-        self.logger.info("getting libvirt xml from {}".format(drv_format))
-        conn = libvirt.open(drv_format)
-        xml_desc = None
+        conn = self.host.get_libvirt_conn()
+        self.logger.info("getting libvirt xml from {}".format(conn.uri))
         try:
             inst = conn.lookupByUUIDString(uid)
-            xml_desc = inst.XMLDesc(flags=flags)
-        except libvirt.libvirtError as le:
+            return inst.XMLDesc(flags=flags)
+        except libvirt.libvirtError:
             msg = "Unable to find instance with UUID: {}".format(uid)
             self.logger.error(msg)
-            raise le
-        finally:
-            conn.close()
-            return xml_desc
+            return None
 
-    def verify_hugepage(self):
+    def domain_tree(self, cache=None):
+        """
+        The parsed domain XML of the instance, from a DomainXMLCache (which
+        fetches the XML of every domain on the hypervisor at once, so that
+        verifying many instances on it costs one pass)
+
+        :param cache: (DomainXMLCache) if None, use the shared default_cache
+        :return: root Element of the domain XML, or None if not found
+        """
+        cache = domain_cache.default_cache if cache is None else cache
+        return cache.get(self.instance.id, host=self.host.host,
+                         user=self.host.user, driver=self.host.driver)
+
+    def verify_hugepage(self, cache=None):
         """
         This function will verify that the instance is backed by huge pages::
 
@@ -698,24 +771,18 @@ class Instance(object):
             </hugepages>
           </memoryBacking>
 
+        :param cache: (DomainXMLCache) see domain_tree
         :return: boolean
         """
-        xml_dump = self.dumpxml()
-        root = ET.fromstring(xml_dump)
-        mb = root.iter("memoryBacking")
-        try:
-            mb = next(mb)
-        except StopIteration:
+        root = self.domain_tree(cache=cache)
+        if root is None:
             return False
 
-        pages = [child for child in mb.iter() if child.tag == "page"]
-        for page in pages:
-            if page.attrib["nodeset"] == "0" and page.attrib["size"] == "2048":
-                tag, attrib, txt = page.tag, page.attrib, page.text
-                self.logger.info("Verified huge page: {} {} {}".format(tag, attrib, txt))
+        for page in domain_cache.hugepages(root):
+            if page.get("nodeset") == "0" and page.get("size") == "2048":
+                self.logger.info("Verified huge page: {}".format(page))
                 return True
-        else:
-            return False
+        return False
 
 
 def safe_delete(instances):
@@ -743,14 +810,13 @@ class BaseStack(object):
         :return:
         """
         self._kwargs = kwargs
-        self._keystone = None
-        self._nova = None
-        self._glance = None
-        self._neutron = None
+        self._clients = None
         self.allow_negative = True
         self.logger = logger
         self.glance_version = "1"
         self.monitors = {}
+        self._multiplexer = None
+        self.boot_times = OrderedDict()
 
     def make_demo(self, tenant_name, tenant_kw, user_name, user_kw):
         tenant = smog.keystone.create_tenant(self.keystone, tenant_name,
@@ -760,14 +826,30 @@ class BaseStack(object):
         creds = {"username": user_name, "tenant_name": tenant.id,
                  "password": user_kw["password"],
                  "auth_url": self.keystone.auth_url}
-        nova = smog.nova.create_nova_client(self.keystone, creds)
+        nova = smog.clients.get_clients(**creds).nova
         return {"tenant": tenant, "user": user, "nova": nova}
 
+    @property
+    def clients(self):
+        """
+        The ClientSet shared by every BaseStack (and thread) with the same
+        credentials.  See smog.clients
+        """
+        if self._clients is None:
+            self._clients = smog.clients.get_clients(
+                glance_version=self.glance_version, **self._kwargs)
+        return self._clients
+
+    @property
+    def catalog(self):
+        """
+        The cached images, flavors and networks.  See smog.catalog
+        """
+        return self.clients.catalog
+
     @property
     def keystone(self):
-        if self._keystone is None:
-            self._keystone = create_keystone(**self._kwargs)
-        return self._keystone
+        return self.clients.keystone
 
     @keystone.setter
     def keystone(self, val):
@@ -776,9 +858,7 @@ class BaseStack(object):
 
     @property
     def nova(self):
-        if self._nova is None:
-            self._nova = create_nova_client(self.keystone)
-        return self._nova
+        return self.clients.nova
 
     @nova.setter
     def nova(self, val):
@@ -787,9 +867,7 @@ class BaseStack(object):
 
     @property
     def glance(self):
-        if self._glance is None:
-            self._glance = create_glance(self.keystone, self.glance_version)
-        return self._glance
+        return self.clients.glance
 
     @glance.setter
     def glance(self, val):
@@ -798,19 +876,16 @@ class BaseStack(object):
 
     @property
     def neutron(self):
-        if self._neutron is None:
-            self._neutron = create_neutron_client(key_cl=self.keystone)
-        return self._neutron
+        return self.clients.neutron
 
     def refresh(self):
         """
-        If keystone token expires, set clients with refreshed keystone client
+        Gets a new token for the clients now.  Tokens are normally refreshed
+        shortly before they expire, so this is rarely needed
 
         :return:
         """
-        self._keystone = create_keystone(**self._kwargs)
-        self._nova = create_nova_client(self.keystone)
-        self._glance = create_glance(self.keystone, self.glance_version)
+        self.clients.refresh()
         return self.keystone
 
     def boot_instance(self, img=None, flv=None, name="test", nic_list=None,
@@ -832,10 +907,9 @@ class BaseStack(object):
         # For Kilo, convert the nic object to a dict
         if nic_list is None:
             # By default we will use the private network
-            pvt_net_pred = smog.neutron.has_network_field("private")
-            nets = smog.neutron.list_neutron_nets(self.neutron,
-                                                  filter_fn=pvt_net_pred)
-            pvt_net = nets[0]
+            pvt_net = self.catalog.networks.get("private")
+            if pvt_net is None:
+                raise Exception("There is no private network")
             if pvt_net["status"] != "ACTIVE":
                 raise Exception("Private network is not active")
             nic = smog.neutron.NIC(net_id=pvt_net["id"])
@@ -857,45 +931,125 @@ class BaseStack(object):
         instance = boot_instance(self.nova, name, img, flv, **kwargs)
         return instance
 
-    def boot_instances(self, images, flavors, name="test", poll=True, **kwargs):
+    def boot_instances(self, images, flavors, name="test", poll=True,
+                       in_flight=None, timeout=300, cleanup=True, **kwargs):
         """
         Allows a nova instance to boot up given a sequence of images and flavors
 
         This function takes two equal sized sequences of images and flavors,
-        and one by one it boots up a nova instance from the pair
+        and boots up a nova instance from each pair.  Creates are issued while
+        fewer than in_flight instances are still building, and all of the
+        building instances are tracked by one StatusWaiter.  How long each
+        instance took to go ACTIVE is kept in self.boot_times, and a histogram
+        of them is logged.
+
+        If any instance fails to boot (and cleanup is True) every instance
+        created by this call is deleted before BootException is raised
 
         :param images: A sequence of Glance image objects
         :param flavors: A sequence of Flavor objects
+        :param poll: (bool) wait for the instances to be ACTIVE
+        :param in_flight: (int) max instances building at once (None for no
+                          limit).  Ignored if poll is False
+        :param timeout: (int) seconds to wait for each instance
+        :param cleanup: (bool) delete all the new instances on a failure
         :return: A sequence of instances
         """
         data = []
-        i_id = 0
-        for img, flavor in zip(images, flavors):
-            name = "{}-{}".format(name, i_id)
-
-            self.logger.debug("Booting up instance {}".format(name))
-            instance = boot_instance(self.nova, name, img, flavor, **kwargs)
-            if instance is None:
-                raise BootException("Unable to boot up new instance")
-            if instance.status == "error":
-                msg = "Error booting instance: {}".format(instance.fault)
-                raise BootException(msg)
+        failed = []
+        limit = threading.BoundedSemaphore(in_flight) if in_flight else None
+        waiter = smog.nova.StatusWaiter(self.nova, timeout=timeout,
+                                        logger=self.logger)
+        if poll:
+            waiter.start()
+        started = {}
+
+        def booted(instance, achieved):
+            elapsed = time.time() - started[instance.id]
+            if achieved:
+                self.boot_times[instance.name] = elapsed
+                default_registry.histogram("smog_boot_seconds").observe(
+                    elapsed)
+            else:
+                default_registry.counter("smog_boot_failures_total").inc()
+                failed.append(instance)
+            if limit is not None:
+                limit.release()
+
+        try:
+            for i_id, (img, flavor) in enumerate(zip(images, flavors)):
+                inst_name = "{}-{}".format(name, i_id)
+                if poll and limit is not None:
+                    limit.acquire()
+                if failed:
+                    break
+
+                self.logger.debug("Booting up instance {}".format(inst_name))
+                instance = boot_instance(self.nova, inst_name, img, flavor,
+                                         **kwargs)
+                if instance is None:
+                    raise BootException("Unable to boot up new instance")
+                data.append(instance)
+                if instance.status == "error":
+                    msg = "Error booting instance: {}".format(instance.fault)
+                    raise BootException(msg)
+                started[instance.id] = time.time()
+                if poll:
+                    waiter.watch(instance, "ACTIVE", callback=booted)
 
             # Wait for the instance(s) to be in ACTIVE state
             if poll:
-                active = poll_status(instance, "ACTIVE", timeout=300)
-                if not active:
+                waiter.wait()
+                if failed:
+                    instance = failed[0]
                     msg = "Problem bringing up instance {}: {}"
                     try:
-                        fault = instance.status
-                        msg = msg.format(name, fault)
+                        msg = msg.format(instance.name, instance.status)
                     except NotFound:
-                        msg = msg.format(name, "")
+                        msg = msg.format(instance.name, "")
                     raise BootException(msg)
-            data.append(instance)
-            i_id += 1
+        except Exception:
+            if cleanup and data:
+                self.logger.error("Deleting the {} instances booted so "
+                                  "far".format(len(data)))
+                self.delete_booted(data, timeout=timeout)
+            raise
+        finally:
+            waiter.stop()
+
+        if poll and data:
+            times = [self.boot_times[i.name] for i in data]
+            hist = smog.nova.histogram(times)
+            self.logger.info("Boot times for {} instances: {}".format(
+                len(data), ", ".join("{}s: {}".format(k, v)
+                                     for k, v in hist.items())))
         return data
 
+    def delete_booted(self, instances, timeout=300):
+        """
+        Deletes instances and waits (with one servers.list per tick) until
+        they are all gone.  How long each took is recorded in the
+        smog_delete_seconds histogram
+
+        :return: OrderedDict of instance id -> bool (deleted or not)
+        """
+        waiter = smog.nova.StatusWaiter(self.nova, timeout=timeout,
+                                        logger=self.logger)
+        start = time.time()
+
+        def deleted(instance, achieved):
+            if achieved:
+                default_registry.histogram("smog_delete_seconds").observe(
+                    time.time() - start)
+
+        for guest in instances:
+            try:
+                guest.delete()
+            except NotFound:
+                pass
+            waiter.watch(guest, "deleted", callback=deleted)
+        return waiter.wait()
+
     def discover(self, guests=None, user="root", htype=VM):
         """
         For each instance, create an Instance object
@@ -948,9 +1102,10 @@ class BaseStack(object):
         :param name: a name to look up (not by ID)
         :return:
         """
-        images = glance_image_list(self.glance)
-        img = glance_images_by_name(name, images)
-        return img[0]
+        img = self.catalog.images.get(name)
+        if img is None:
+            raise IndexError("No image named {}".format(name))
+        return img
 
     def get_flavor(self, name):
         """
@@ -959,10 +1114,10 @@ class BaseStack(object):
         :param name:
         :return:
         """
-        flv = list_flavors(self.nova, filt=smog.nova.get_by_name(name))
-        if not flv:
-            flv = list_flavors(self.nova, filt=smog.nova.get_by_id(name))
-        return flv[0]
+        flv = self.catalog.flavors.find(name)
+        if flv is None:
+            raise IndexError("No flavor with name or id {}".format(name))
+        return flv
 
     def create_flavor(self, name, ram=1024, vcpus=1, disksize=10, specs=None):
         """
@@ -978,6 +1133,7 @@ class BaseStack(object):
         :return: Flavor object
         """
         flavor = self.nova.flavors.create(name, ram, vcpus, disksize)
+        Catalog.invalidate_all("flavors")
         if specs is not None:
             flavor.set_keys(specs)
         return flavor
@@ -993,6 +1149,7 @@ class BaseStack(object):
         flaves = smog.nova.list_flavors(self.nova, filt=filt)
         for flv in flaves:
             flv.delete()
+        Catalog.invalidate_all("flavors")
 
     def delete_instances(self, filt=None):
         # Delete all instances
@@ -1018,7 +1175,8 @@ class BaseStack(object):
 
     def monitor(self, cmd, name, host, hcls, *args, log=None, **kwargs):
         """
-        Creates a Watcher and Handler, and adds the Watcher object to self
+        Runs cmd on host, and watches its output with a Handler.  All the
+        monitors of a BaseStack share one WatchMultiplexer thread
 
         :param cmd: The command to run which will be watched
         :param name: a name to give the monitor
@@ -1027,30 +1185,49 @@ class BaseStack(object):
         :param log: defaults to sys.stdout, but can be a file-like object
         :param args: passed through to hcls(*args, **kwargs)
         :param kwargs: passed through to hcls(*args, **kwargs)
-        :return: Watcher object
+        :return: WatchedStream object (which has the handler, poll() and
+                 close() of a Watcher)
         """
         if log is None:
             log = sys.stdout
+        if name in self.monitors:
+            raise ArgumentError("{} already in self.monitors".format(name))
 
         cmd = Command(cmd, host=host)
         res = cmd(block=False, remote=True)
-        watcher = Watcher(res, log=log)
-        rdr_proc = watcher.start_reader()
 
         if "log" in kwargs:
             kwargs.pop("log")
-        handler = hcls(rdr_proc, *args, **kwargs)
-
-        # start the consumer that will read from the que
-        mntr_proc = watcher.start_monitor(handler, watcher.queue)
-        rdr_proc.start()
-        mntr_proc.start()
-        mon = {name: watcher}
-        if name in self.monitors:
-            raise ArgumentError("{} already in self.monitors".format(name))
-        self.monitors.update(mon)
+        watcher = self.multiplexer.watch(res, hcls, *args, name=name, log=log,
+                                         **kwargs)
+        self.monitors.update({name: watcher})
         return watcher
 
+    def monitor_many(self, cmd, name, host, handlers, log=None):
+        """
+        Like monitor, but runs several Handlers over the output of a single
+        cmd, sharing one scan of each line (see HandlerGroup)
+
+        Usage::
+
+            cmd = "journalctl -f -u openstack-nova-compute"
+            watcher = stack.monitor_many(cmd, "compute", host,
+                                         [ExceptionHandler,
+                                          (RegexHandler, (patt,))])
+            exceptions, regex_result = watcher.handler.result
+
+        :param handlers: list of Handler classes, or (hcls, args) or
+                         (hcls, args, kwargs) tuples
+        :return: WatchedStream object, whose handler is a HandlerGroup
+        """
+        return self.monitor(cmd, name, host, HandlerGroup, handlers, log=log)
+
+    @property
+    def multiplexer(self):
+        if self._multiplexer is None:
+            self._multiplexer = WatchMultiplexer()
+        return self._multiplexer
+
     def create_host_aggregate(self, name, metadata=None, host=None,
                               zone="nova"):
         """
@@ -1255,15 +1432,41 @@ class BaseTest(unittest.TestCase):
     def setUpClass(cls):
         """
         Reads in the configuration file for our parameters which will be available
-        in the cls.config variable
+        in the cls.config variable.  The facts of the computes in the config
+        are gathered into cls.facts (from the local fact cache on warm runs)
 
         :param cls:
         :return:
         """
         config = get_yaml_file(cls.config_dir, cls.config_file)
         cls.config = config
+        cls.facts = {}
+        computes = (config.get("hosts") or {}).get("computes") or []
+        hosts = [c["host"] for c in computes]
+        if hosts:
+            try:
+                cls.gather_facts(hosts)
+            except Exception as ex:
+                LOGGER.warning("Could not gather facts: {}".format(ex))
         return cls.config
 
+    @classmethod
+    def gather_facts(cls, hosts=None, ttl=60, refresh=False):
+        """
+        Gets the HostFacts (see smog.facts) of hosts in parallel, using the
+        local fact cache.  The facts are also stored in cls.facts
+
+        :param hosts: list of hosts.  If None, use the computes in cls.config
+        :param ttl: (int) seconds for which cached facts are used as is
+        :param refresh: (bool) if True, ignore the cache
+        :return: dict of host -> HostFacts
+        """
+        if hosts is None:
+            hosts = [c["host"] for c in cls.config["hosts"]["computes"]]
+        facts = smog.facts.gather_facts(hosts, ttl=ttl, refresh=refresh)
+        cls.facts.update(facts)
+        return facts
+
     def same_host(self, guests, check="compute1"):
         for guest in guests:
             host = guest.host
@@ -1281,13 +1484,37 @@ class BaseTest(unittest.TestCase):
         :param conf_f: Configuration file to use (eg /etc/nova/nova.conf)
         :param key: the key to look up
         :param valid: (str) compare this to what is found in file
-        :param computes: a list of ip addresses to check
         :param section: section to look up key
-        :return: hosts where
+        :return: True if the value in the file is valid
         """
-        res = openstack_config(conf_f, section, key, host=host)
-        current = res.output
-        return current.strip() == valid.strip()
+        found = cls.verify_configs([host], conf_f, {(section, key): valid})
+        return not found[host]
+
+    @classmethod
+    def verify_configs(cls, hosts, conf_f, expected, max_workers=10):
+        """
+        Verify that several keys have the expected values in a config file on
+        many hosts.  Each host is checked with one remote invocation, and the
+        hosts are checked in parallel
+
+        :param hosts: list of hosts to check
+        :param conf_f: Configuration file to use (eg /etc/nova/nova.conf)
+        :param expected: dict of (section, key) -> (str) valid value
+        :return: OrderedDict of host -> dict of the (section, key) whose value
+                 is not valid, to the value found (None if it is missing, or
+                 the host could not be checked).  So a host that is fine
+                 maps to an empty dict
+        """
+        results = openstack_configs_on_hosts(hosts, conf_f, list(expected),
+                                             typed=False,
+                                             max_workers=max_workers)
+        wrong = OrderedDict()
+        for host, res in results.items():
+            current = res.value if res.ok else {}
+            wrong[host] = {item: current.get(item)
+                           for item, valid in expected.items()
+                           if current.get(item) != str(valid).strip()}
+        return wrong
 
     @classmethod
     def set_base_config(cls):
@@ -1295,6 +1522,9 @@ class BaseTest(unittest.TestCase):
         Verify that we have the filters from our config enabled.  Make sure that
         virt_type specified in the config is set
 
+        Each compute is read with one remote call, and (if it needs changing)
+        written and verified with another.  The computes are done in parallel
+
         :param cls:
         :return:
         """
@@ -1305,22 +1535,19 @@ class BaseTest(unittest.TestCase):
         virt_type = cls.config["nova"]["virt_type"]
 
         # verify we have the nova filters
-        def_filters = "scheduler_default_filters"
+        def_filters = ("DEFAULT", "scheduler_default_filters")
+        virt = ("libvirt", "virt_type")
         default = "RetryFilter,AvailabilityZoneFilter,RamFilter,ComputeFilter," \
                   "ComputeCapabilitiesFilter,ImagePropertiesFilter," \
-                  "ServerGroupAntiAffinityFilter,ServerGroupAffinityFilter\n"
+                  "ServerGroupAntiAffinityFilter,ServerGroupAffinityFilter"
         nova_conf = "/etc/nova/nova.conf"
 
-        for host in computes:
-            # Get the current filters.  Check to see if what we need is already
-            # in, and if not, add it
-            res = openstack_config(nova_conf, "DEFAULT", def_filters,
-                                   opt="get", host=host)
-            if res != 0:
-                current = default
-            else:
-                current = res.output
-            curr_items = current.strip().split(",")
+        def configure(host):
+            # Get the current filters and virt_type.  Check to see if what we
+            # need is already in, and if not, add it
+            current = openstack_configs(nova_conf, [def_filters, virt],
+                                        host=host, typed=False)
+            curr_items = (current[def_filters] or default).split(",")
             final_items = curr_items[:]  # hack to get a copy
             changed = False
 
@@ -1337,30 +1564,35 @@ class BaseTest(unittest.TestCase):
                 final_items.remove("ComputeCapabilitiesFilter")
                 changed = True
 
-            fltr_val = ",".join(final_items) + "\n"
-
-            # fltr_val has the final filters, set it to this
-            if (len(final_items) != len(curr_items)) or changed:
-                openstack_config(nova_conf, "DEFAULT", def_filters,  opt="set",
-                                 value=fltr_val, host=host)
-
-            success = cls.verify_config(host, nova_conf, def_filters, fltr_val)
-            if not success:
-                err = "Could not set {} {} to {}".format(nova_conf, def_filters,
-                                                         fltr_val)
-                cls.fail(err)
+            wanted = OrderedDict()
+            if changed:
+                wanted[def_filters] = ",".join(final_items)
+            if current[virt] != virt_type:
+                wanted[virt] = virt_type
+            if not wanted:
+                return
+
+            # Set everything that needs changing, reading it back in the same
+            # call to verify it
+            written = openstack_configs(nova_conf, wanted, opt="set",
+                                        host=host, typed=False)
+            for item, val in wanted.items():
+                if written[item] != val:
+                    err = "Could not set {} {} to {}".format(nova_conf, item,
+                                                             val)
+                    raise cls.failureException(err)
 
             # restart openstack services
             if changed:
-                cmd = Command("openstack-service restart openstack-nova", host=host)
+                cmd = Command("openstack-service restart openstack-nova",
+                              host=host)
                 cmd()
 
-            if cls.verify_config(host, nova_conf, "virt_type", virt_type,
-                                 section="libvirt"):
-                pass
-            else:
-                openstack_config(nova_conf, "libvirt", "virt_type", opt="set",
-                                 value=virt_type, host=host)
+        results = fan_out(configure, computes)
+        errors = ["{}: {}".format(host, res.error)
+                  for host, res in results.items() if not res.ok]
+        if errors:
+            raise cls.failureException("\n".join(errors))
 
     def _setup_monitor(self, base, name, cmd=None, log_path=None,
                        hdlr=ExceptionHandler):
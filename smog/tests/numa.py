@@ -24,13 +24,15 @@ import untangle
 from smog.tests import base
 from smog.core.exceptions import ArgumentError, BootException
 from smog.core.logger import glob_logger, make_timestamped_filename
-from smog.core.commander import Command
-from smog.core.decorators import require_remote
+from smog.core.commander import Command, CommandException
+from smog.core.remote_edit import remote_get
 from smog.core.xml.helper import get_xml_children
+from smog.core.xml.domain_cache import numa_cells
 from smog.core.functional import bytes_iter, powers_two
 from smog.glance import create_image, get_cloud_image
 import smog.nova
 import smog.virt
+import smog.facts
 
 
 def determine_fit(nodes, mem_type, delta="smaller", factor=2, size_fmt="MB"):
@@ -106,19 +108,15 @@ def get_nova_instance_info(instance, key=None):
 
 
 def check_largepage_support_persist(host):
-    smog.tests.base.scp("root@{}:/etc/sysctl.conf".format(host), ".")
-
-    patt = re.compile(r"vm\.nr_hugepages=(\d+)")
-    hp = 0
-    with open("sysctl.conf") as sysctl:
-        for line in sysctl:
-            m = patt.search(line)
-            if m:
-                hp = m.groups()[0]
-                break
+    """
+    Reads vm.nr_hugepages from /etc/sysctl.conf on host (without copying the
+    file over)
 
-    os.unlink("sysctl.conf")
-    return hp
+    :return: the number of huge pages (str), or 0 if it is not set
+    """
+    values = remote_get(host, "/etc/sysctl.conf", ["vm.nr_hugepages"])
+    found = values["vm.nr_hugepages"]
+    return found[0].strip() if found else 0
 
 
 def check_largepage_support_current(host):
@@ -340,43 +338,31 @@ class NUMA(base.BaseStack):
         """
         return {"hw:cpu_policy": policy, "hw:cpu_thread_policy": thread_policy}
 
-    @require_remote("numactl")
     def get_host_numactl(self, **kwargs):
         """
-        Retrieves the numactl -H information for a hosts
+        Retrieves the numactl -H information for a hosts, from its HostFacts
+        (see smog.facts)
 
-        To call on a remote machine, the keywords of hosts, username, and
-        password must be supplied which will be passed to paramiko to make the
-        remote call.  If no kwargs are given, it is assumed the command will be
-        run on the local machine
-
-        :param kwargs: Optional hosts= ipaddress of remote machine
-                                username= username to ssh as
+        :param kwargs: host= ipaddress of remote machine
+                       username= username to ssh as
+                       cache= reuse facts gathered in the last minute.  Note
+                              that the free memory may then be stale
         :return: a dictionary of
           node_num:  # where node_num is an int of the numa node index
              "cpus": a string of the cpus in that node
              "size": the total memory on the node in MB
              "free": the free amount of memory on the numa node in MB
+          "number": the number of numa nodes
         """
         # FIXME: replace the dependency on numactl by using libvirt
-        cmd = Command("numactl -H", host=kwargs["host"],
-                      user=kwargs["username"])
-        res = cmd(throws=True, showout=False, remote=True)
-        output = res.output
-
-        _patt = re.compile(r"node\s+(\d+)\s+(cpus|size|free):\s+(.+)")
-        nodes = {}
-        for line in output.split("\n"):
-            m = _patt.search(line)
-            if m:
-                node_num, key, val = m.groups()
-                node_num = int(node_num)
-
-                if node_num not in nodes:
-                    nodes[node_num] = {}
-                nodes[node_num].update({key: val})
-        nodes["number"] = len(nodes.keys())
-        return nodes
+        host = kwargs["host"]
+        ttl = 60 if kwargs.get("cache") else 0
+        fact = smog.facts.host_facts(host, ttl=ttl,
+                                     user=kwargs.get("username", "root"))
+        if not fact.numa:
+            raise CommandException("numactl -H failed on {}".format(host))
+        # a copy, since callers pop "number" from it
+        return dict(fact.numa)
 
     def dumpxml(self, uid, host=None, driver="qemu+ssh", user="root"):
         """
@@ -388,22 +374,15 @@ class NUMA(base.BaseStack):
         :param driver: (str) the libvirt driver to use
         :return: a string of the XML domain information
         """
-        drv_format = "qemu:///system"
-        if host is not None:
-            drv_format = "{}://{}@{}/system".format(driver, user, host)
-        self.logger.info("getting libvirt xml from {}".format(drv_format))
-        conn = libvirt.open(drv_format)
-        xml_desc = None
+        conn = smog.virt.get_connection(host, user=user, driver=driver)
+        self.logger.info("getting libvirt xml from {}".format(conn.uri))
         try:
             inst = conn.lookupByUUIDString(uid)
-            xml_desc = inst.XMLDesc()
-        except libvirt.libvirtError as le:
+            return inst.XMLDesc()
+        except libvirt.libvirtError:
             msg = "Unable to find instance with UUID: {}".format(uid)
             self.logger.error(msg)
-            raise le
-        finally:
-            conn.close()
-            return xml_desc
+            return None
 
     def get_hypervisors(self):
         return [hyper.host_ip for hyper in self.nova.hypervisors.list()]
@@ -812,15 +791,13 @@ class NUMATopologyTest(base.NovaTest):
         #       </numa>
         #   </cpu>
         for guest in guests:
-            dump = guest.dumpxml()
-            root = et.fromstring(dump)
-            print(dump)
+            root = guest.domain_tree()
+            self.assertIsNotNone(root, msg="no domain xml for guest")
 
-            # Look for the <numa> element inside <cpu>
-            numa = [child for child in root.iter("cpu") if child.tag == "numa"]
-            self.assertTrue(numa, msg="domain xml did not have <numa> element")
-            cell = [child for child in numa[0].iter() if child.tag == "cell"]
-            self.assertTrue(cell)
+            # Look for the <numa> cells inside <cpu>
+            cells = numa_cells(root)
+            self.assertTrue(cells, msg="domain xml did not have <numa> cells")
+            self.logger.info("numa cells: {}".format(cells))
 
         # TODO:  Create a small stress test (IO traffic for 1 min)
         self.assertTrue(1)
@@ -853,15 +830,13 @@ class NUMATopologyTest(base.NovaTest):
         self.assertTrue(len(guests) == 2)
 
         for guest in guests:
-            dump = guest.dumpxml()
-            root = et.fromstring(dump)
-            print(dump)
+            root = guest.domain_tree()
+            self.assertIsNotNone(root, msg="no domain xml for guest")
 
-            # Look for the <numa> element inside <cpu>
-            numa = [child for child in root.iter("cpu") if child.tag == "numa"]
-            self.assertTrue(numa, msg="domain xml did not have <numa> element")
-            cell = [child for child in numa[0].iter() if child.tag == "cell"]
-            self.assertTrue(cell)
+            # Look for the <numa> cells inside <cpu>
+            cells = numa_cells(root)
+            self.assertTrue(cells, msg="domain xml did not have <numa> cells")
+            self.logger.info("numa cells: {}".format(cells))
 
     @base.declare
     def test_too_many_nodes(self):
@@ -966,15 +941,13 @@ class NUMATopologyTest(base.NovaTest):
         self.assertTrue(len(guests) == 2)
         self.same_host(guests)
         for guest in guests:
-            dump = guest.dumpxml()
-            root = et.fromstring(dump)
-            print(dump)
+            root = guest.domain_tree()
+            self.assertIsNotNone(root, msg="no domain xml for guest")
 
-            # Look for the <numa> element inside <cpu>
-            numa = [child for child in root.iter("cpu") if child.tag == "numa"]
-            self.assertTrue(numa, msg="domain xml did not have <numa> element")
-            cell = [child for child in numa[0].iter() if child.tag == "cell"]
-            self.assertTrue(cell)
+            # Look for the <numa> cells inside <cpu>
+            cells = numa_cells(root)
+            self.assertTrue(cells, msg="domain xml did not have <numa> cells")
+            self.logger.info("numa cells: {}".format(cells))
 
     def not_ready_test_split_node(self):
         """
@@ -10,21 +10,21 @@ __author__ = 'stoner'
 import unittest
 import xmlrunner
 import os
+import re
 import time
 import multiprocessing
 
-import libvirt
 import novaclient.exceptions
 from novaclient.exceptions import NotFound
 import toolz
 
 from smog.tests import base
 from smog.core.logger import glob_logger
-from smog.core.downloader import Downloader
 from smog.core.watcher import Handler
 from smog.core.exceptions import ArgumentError
 from smog.glance import create_image
 from smog.core.commander import Command
+from smog.core.metrics import default_registry
 import smog.virt
 import smog.nova
 
@@ -44,13 +44,7 @@ class NovaSanity(base.BaseStack):
     # FIXME: This method shouldn't be confined to this class
     @staticmethod
     def get_cloud_image(location, name):
-        # Download a cirros image
-        if not os.path.exists(location):
-            if not Downloader.download_url(location, "/tmp", binary=True):
-                raise Exception("Could not download cirros image")
-            else:
-                location = "/tmp/" + name
-        return location
+        return smog.glance.get_cloud_image(location, name)
 
 
 class ConfigDriveHandler(Handler):
@@ -63,10 +57,13 @@ class ConfigDriveHandler(Handler):
         self.line = None
         self.id = instance_id
         self.res_q = multiprocessing.Queue()
+        self.patterns = [re.escape(self.instance_line())]
+
+    def instance_line(self):
+        return "[instance: {}] Creating config drive".format(self.id)
 
     def __call__(self, line):
-        instance = "[instance: {}] Creating config drive".format(self.id)
-        if instance in line:
+        if self.instance_line() in line:
             self.found += 1
             if self.found >= self.counts:
                 self.res_q.put(("Success", line))
@@ -290,8 +287,11 @@ class EvacuateTest(base.NovaTest):
             if host_attr and host_attr != orig_host:
                 break
             if time.time() > end_time:
+                default_registry.counter("smog_migrate_failures_total").inc()
                 raise Exception("live migration failed")
             time.sleep(1)
+        default_registry.histogram("smog_migrate_seconds").observe(
+            time.time() - start_time)
 
         # FIXME: Ugghhh all this state management.  I feel dirty
         self.update_info(info, self.sanity)
@@ -322,7 +322,7 @@ class EvacuateTest(base.NovaTest):
         else:
             instance = filter(lambda x: x.name == instance_name, info.instances)[0]
 
-        conn = libvirt.open("qemu+ssh://root@{}/system".format(master))
+        conn = smog.virt.get_connection(master)
         domain = conn.lookupByName(name)
         glob_logger.info("Shutting down {} for evacuation".format(name))
         smog.virt.shutdown(domain)
@@ -0,0 +1,128 @@
+__author__ = 'stoner'
+
+
+import asyncio
+import shutil
+import tempfile
+import time
+import unittest
+
+from smog.core.async_commander import AsyncCommand, run_on_hosts
+from smog.core.commander import CommandException, CommandTimeout
+from smog.core.sshpool import SSHControlPool
+
+
+class FakePool(SSHControlPool):
+    """
+    Runs "remote" commands locally, with SMOG_HOST set to the host, and
+    records how many were in flight per host at most
+    """
+    def __init__(self, control_dir, max_sessions=2):
+        super(FakePool, self).__init__(control_dir=control_dir,
+                                       max_sessions=max_sessions, ssh="true")
+        self.peak = 0
+
+    def ssh_args(self, user, host):
+        return ["env", "SMOG_HOST={}".format(host)]
+
+    def acquire(self, user, host):
+        master = super(FakePool, self).acquire(user, host)
+        with self._lock:
+            self.peak = max(self.peak, master.in_use)
+        return master
+
+
+class AsyncCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = FakePool(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stream_lines(self):
+        async def main():
+            cmd = AsyncCommand("sh -c 'echo one; echo two; sleep 0.1; "
+                               "printf three'")
+            res = await cmd(block=False)
+            lines = [line async for line in res.stdout]
+            await res.wait(timeout=5)
+            return lines, res
+
+        lines, res = asyncio.run(main())
+        self.assertEqual(lines, ["one\n", "two\n", "three"])
+        self.assertEqual(res, 0)
+
+    def test_long_line(self):
+        async def main():
+            res = await AsyncCommand("sh -c 'head -c 100 /dev/zero | "
+                                     "tr \"\\\\0\" a; echo; echo end'")(
+                block=False, limit=16)
+            lines = [line async for line in res.stdout]
+            await res.wait(timeout=5)
+            return lines
+
+        lines = asyncio.run(main())
+        self.assertGreater(len(lines), 2)
+        self.assertEqual("".join(lines), "a" * 100 + "\nend\n")
+
+    def test_timeout(self):
+        start = time.time()
+        with self.assertRaises(CommandTimeout):
+            asyncio.run(AsyncCommand("sleep 30")(timeout=0.2))
+        self.assertLess(time.time() - start, 5)
+
+    def test_cancel(self):
+        async def main():
+            res = await AsyncCommand("sleep 30")(block=False)
+            task = asyncio.ensure_future(res.wait())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return res
+
+        res = asyncio.run(main())
+        # the process was killed rather than left running
+        self.assertIsNotNone(res.returncode)
+        self.assertNotEqual(res, 0)
+
+    def test_run_on_hosts(self):
+        hosts = ["h1", "h2", "bad"]
+        cmd = "sh -c 'test $SMOG_HOST != bad && echo $SMOG_HOST'"
+        results = asyncio.run(run_on_hosts(cmd, hosts, pool=self.pool,
+                                           showout=False, showerr=False))
+        self.assertEqual(list(results.keys()), hosts)
+        self.assertEqual(results["h1"].output, "h1\n")
+        self.assertEqual(results["h2"].output, "h2\n")
+        self.assertIsInstance(results["bad"], CommandException)
+
+    def test_session_limit(self):
+        async def main():
+            cmds = [AsyncCommand("sleep 0.1", host="h1", pool=self.pool)
+                    for _ in range(6)]
+            return await asyncio.gather(*[c(showout=False) for c in cmds])
+
+        results = asyncio.run(main())
+        self.assertTrue(all(res == 0 for res in results))
+        self.assertEqual(self.pool.peak, 2)
+        self.assertEqual(self.pool.stats()["root@h1"]["in_use"], 0)
+
+    def test_nonblocking_pins(self):
+        async def main():
+            res = await AsyncCommand("sleep 0.2", host="h1",
+                                     pool=self.pool)(block=False)
+            evicted = self.pool.evict_idle(idle_timeout=0)
+            await res.proc.wait()
+            return evicted
+
+        self.assertEqual(asyncio.run(main()), [])
+        self.assertEqual(self.pool.evict_idle(idle_timeout=0),
+                         [("root", "h1")])
+
+
+if __name__ == "__main__":
+    unittest.main()
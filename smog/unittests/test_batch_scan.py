@@ -0,0 +1,69 @@
+__author__ = 'stoner'
+
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from smog.core.watcher import ExceptionHandler, Handler
+from smog.utils.monitors.batch_scan import chunk_ranges, scan_file
+
+
+class MigrationHandler(Handler):
+    def __init__(self, rdr):
+        super(MigrationHandler, self).__init__(rdr)
+        self.patterns = [re.compile(r"migrat")]
+        self.lines = []
+
+    def __call__(self, line):
+        self.lines.append(line)
+        return True
+
+
+class BatchScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "nova-compute.log")
+        with open(self.path, "w") as log:
+            for i in range(2000):
+                if i % 500 == 7:
+                    log.write("line {} raise exceptions.NotFound\n".format(i))
+                elif i % 300 == 1:
+                    log.write("line {} live migration started\n".format(i))
+                else:
+                    log.write("line {} nothing to see\n".format(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_chunk_ranges(self):
+        ranges = chunk_ranges(self.path, chunk_size=1000)
+        self.assertGreater(len(ranges), 10)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, "rb") as log:
+            data = log.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b"\n")
+
+    def test_scan_in_order(self):
+        handlers = [(ExceptionHandler, (), {"fail": False, "die": False}),
+                    MigrationHandler]
+        group = scan_file(self.path, handlers, max_workers=2,
+                          chunk_size=1000)
+        exc, migrations = group.handlers
+        self.assertEqual(len(exc.result["NotFound"]), 4)
+        expected = ["line {} live migration started\n".format(i)
+                    for i in range(2000) if i % 300 == 1]
+        self.assertEqual(migrations.lines, expected)
+
+    def test_stops_when_done(self):
+        group = scan_file(self.path, [(ExceptionHandler, (),
+                                       {"count": 2, "die": False})],
+                          max_workers=2, chunk_size=1000)
+        self.assertTrue(group.rdr.done)
+        self.assertEqual(len(group.handlers[0].result["NotFound"]), 2)
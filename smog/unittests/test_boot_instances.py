@@ -0,0 +1,152 @@
+__author__ = 'stoner'
+
+
+import threading
+import unittest
+
+import smog.nova
+from smog.tests.base import BaseStack
+from smog.core.exceptions import BootException
+from smog.core.metrics import default_registry
+
+
+class FakeServer(object):
+    def __init__(self, servers, id, name):
+        self.servers = servers
+        self.id = id
+        self.name = name
+        self.status = "BUILD"
+        self.fault = None
+
+    def delete(self):
+        self.servers.deleted.append(self.name)
+
+
+class FakeServers(object):
+    """
+    Creates FakeServers, and counts how many are building at once
+    """
+    def __init__(self, fail=(), delay=0.05):
+        self.fail = fail
+        self.delay = delay
+        self.created = []
+        self.deleted = []
+        self.building = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def create(self, name, image, flavor, **kwargs):
+        server = FakeServer(self, "id-{}".format(len(self.created)), name)
+        self.created.append(server)
+        return server
+
+    def list(self):
+        return list(self.created)
+
+
+class FakeWaiter(object):
+    """
+    Stands in for smog.nova.StatusWaiter.  A watched server goes ACTIVE after
+    its servers' delay, unless its name is in fail, in which case it goes to
+    ERROR straight away.  Deletes are done at once
+    """
+    def __init__(self, nova, timeout=300, logger=None):
+        self.servers = nova.servers
+        self.timers = []
+        self.results = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def watch(self, server, status, callback=None):
+        if status == "deleted":
+            self._resolve(server, True, callback)
+            return
+        servers = self.servers
+        with servers._lock:
+            servers.building += 1
+            servers.peak = max(servers.peak, servers.building)
+        failed = server.name in servers.fail
+        delay = 0 if failed else servers.delay
+        timer = threading.Timer(delay, self._built,
+                                (server, not failed, callback))
+        self.timers.append(timer)
+        timer.start()
+
+    def _built(self, server, achieved, callback):
+        with self.servers._lock:
+            self.servers.building -= 1
+        server.status = "ACTIVE" if achieved else "ERROR"
+        self._resolve(server, achieved, callback)
+
+    def _resolve(self, server, achieved, callback):
+        self.results[server.id] = achieved
+        if callback is not None:
+            callback(server, achieved)
+
+    def wait(self):
+        for timer in list(self.timers):
+            timer.join()
+        return self.results
+
+
+class FakeNova(object):
+    def __init__(self, **kwargs):
+        self.servers = FakeServers(**kwargs)
+
+
+class FakeClients(object):
+    def __init__(self, **kwargs):
+        self.nova = FakeNova(**kwargs)
+
+
+class BootInstancesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig = smog.nova.StatusWaiter
+        smog.nova.StatusWaiter = FakeWaiter
+
+    def tearDown(self):
+        smog.nova.StatusWaiter = self.orig
+
+    def make_stack(self, **kwargs):
+        stack = BaseStack()
+        stack._clients = FakeClients(**kwargs)
+        return stack
+
+    def test_in_flight_limit(self):
+        stack = self.make_stack()
+        hist = default_registry.histogram("smog_boot_seconds")
+        before = hist.count
+        instances = stack.boot_instances(["img"] * 6, ["flv"] * 6,
+                                         in_flight=2)
+        servers = stack.nova.servers
+        self.assertEqual([i.name for i in instances],
+                         ["test-{}".format(i) for i in range(6)])
+        self.assertEqual(servers.peak, 2)
+        self.assertEqual(servers.deleted, [])
+        # boot_times is kept in the order they went ACTIVE
+        self.assertEqual(sorted(stack.boot_times.keys()),
+                         [i.name for i in instances])
+        self.assertTrue(all(t > 0 for t in stack.boot_times.values()))
+        self.assertEqual(hist.count - before, 6)
+
+    def test_failure_cleans_up(self):
+        stack = self.make_stack(fail=("test-1",), delay=0.2)
+        failures = default_registry.counter("smog_boot_failures_total")
+        before = failures.value
+        with self.assertRaises(BootException):
+            stack.boot_instances(["img"] * 6, ["flv"] * 6, in_flight=2)
+        servers = stack.nova.servers
+        # test-1 failed before a third create was let through
+        self.assertEqual([s.name for s in servers.created],
+                         ["test-0", "test-1"])
+        self.assertEqual(sorted(servers.deleted), ["test-0", "test-1"])
+        self.assertEqual(failures.value - before, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+__author__ = 'stoner'
+
+
+import unittest
+
+from smog.catalog import Catalog
+
+
+class Resource(object):
+    def __init__(self, id, name, status="active", deleted=False):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.deleted = deleted
+
+
+class Images(object):
+    def __init__(self):
+        self.images = [Resource("i1", "cirros"), Resource("i2", "fedora")]
+        self.changed = []
+        self.calls = []
+
+    def list(self, filters=None):
+        self.calls.append(filters)
+        if filters is None:
+            return list(self.images)
+        return list(self.changed)
+
+
+class Flavors(object):
+    def __init__(self):
+        self.flavors = [Resource("1", "m1.tiny"), Resource("2", "m1.small")]
+        self.calls = 0
+
+    def list(self):
+        self.calls += 1
+        return list(self.flavors)
+
+
+class FakeNeutron(object):
+    def list_networks(self):
+        return {"networks": [{"id": "n1", "name": "private"},
+                             {"id": "n2", "name": "public"}]}
+
+
+class FakeClients(object):
+    def __init__(self, glance_version="1"):
+        self.glance_version = glance_version
+        self.glance = type("Glance", (), {})()
+        self.glance.images = Images()
+        self.nova = type("Nova", (), {})()
+        self.nova.flavors = Flavors()
+        self.neutron = FakeNeutron()
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = FakeClients()
+        self.catalog = Catalog(self.clients)
+
+    def test_lookups_load_once(self):
+        flavors = self.catalog.flavors
+        self.assertEqual(flavors.find("m1.tiny").id, "1")
+        self.assertEqual(flavors.find("2").name, "m1.small")
+        self.assertEqual(flavors.by_id("1").name, "m1.tiny")
+        self.assertEqual(self.clients.nova.flavors.calls, 1)
+        self.assertEqual(self.catalog.networks.get("private")["id"], "n1")
+
+    def test_incremental_refresh(self):
+        images = self.catalog.images
+        self.assertEqual(images.get("cirros").id, "i1")
+        self.clients.glance.images.changed = [
+            Resource("i1", "cirros", deleted=True), Resource("i3", "centos")]
+        images.ttl = -1
+        self.assertIsNone(images.get("cirros"))
+        self.assertEqual(images.get("centos").id, "i3")
+        self.assertIn("changes-since", self.clients.glance.images.calls[-1])
+
+    def test_glance_v2_full_reload(self):
+        clients = FakeClients(glance_version="2")
+        images = Catalog(clients).images
+        self.assertEqual(images.get("cirros").id, "i1")
+        # v2 would take changes-since for a property, and match nothing
+        clients.glance.images.images.append(Resource("i3", "centos"))
+        images.ttl = -1
+        self.assertEqual(images.get("centos").id, "i3")
+        # a miss reloads everything too
+        images.ttl = 300
+        images.min_refresh = -1
+        clients.glance.images.images.append(Resource("i4", "rhel"))
+        self.assertEqual(images.get("rhel").id, "i4")
+        self.assertEqual(clients.glance.images.calls, [None, None, None])
+
+    def test_invalidate_all(self):
+        self.catalog.flavors.find("m1.tiny")
+        self.clients.nova.flavors.flavors.append(Resource("3", "numa"))
+        Catalog.invalidate_all("flavors")
+        self.assertEqual(self.catalog.flavors.find("numa").id, "3")
+        self.assertEqual(self.clients.nova.flavors.calls, 2)
@@ -0,0 +1,100 @@
+__author__ = 'stoner'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from smog.core.cfgedit import ConfigFile, ConfigEditError, edit_file
+from smog.core.commander import CommandException
+from smog.core.remote_edit import remote_edit
+
+NOVA_CONF = """# nova config
+[DEFAULT]
+# the vnc address
+#vncserver_listen = 127.0.0.1
+debug = False
+debug = True
+
+[libvirt]
+virt_type=kvm
+
+# end of libvirt
+"""
+
+
+class TestCfgEdit(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "nova.conf")
+        with open(self.path, "w") as cfg:
+            cfg.write(NOVA_CONF)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_set(self):
+        cfg = ConfigFile(NOVA_CONF)
+        cfg.set("vncserver_listen", "0.0.0.0")
+        cfg.set("debug", "False", section="DEFAULT")
+        cfg.set("live_migration_flag", "X", section="libvirt")
+        cfg.set("missing", "1", not_found="ignore")
+        text = cfg.text()
+        self.assertIn("vncserver_listen = 0.0.0.0\n", text)
+        self.assertIn("# the vnc address\n", text)
+        self.assertEqual(cfg.get("debug"), ["False"])
+        self.assertIn("virt_type=kvm\nlive_migration_flag=X\n\n# end", text)
+        self.assertNotIn("missing", text)
+        self.assertRaises(ConfigEditError, cfg.set, "missing", "1",
+                          not_found="fail")
+
+    def test_batch(self):
+        edits = [{"op": "set", "key": "virt_type", "value": "qemu",
+                  "section": "libvirt", "delim": " = "},
+                 {"op": "append", "key": "listen_tls", "value": "0",
+                  "section": "new"},
+                 {"op": "delete", "key": "debug"}]
+        backup = self.path + ".bak"
+        edit_file(self.path, edits, backup=backup, keep_original=True)
+
+        cfg = ConfigFile.read(self.path)
+        self.assertEqual(cfg.get("virt_type", section="libvirt"), ["qemu"])
+        self.assertEqual(cfg.get("listen_tls", section="new"), ["0"])
+        self.assertEqual(cfg.get("debug"), [])
+        for saved in (backup, self.path + ".orig"):
+            with open(saved) as orig:
+                self.assertEqual(orig.read(), NOVA_CONF)
+
+    def test_unchanged(self):
+        mtime = os.path.getmtime(self.path)
+        os.utime(self.path, (mtime - 100, mtime - 100))
+        cfg = edit_file(self.path, [{"key": "virt_type", "value": "kvm",
+                                     "section": "libvirt"}])
+        self.assertEqual(cfg.changes, 0)
+        self.assertEqual(os.path.getmtime(self.path), mtime - 100)
+
+    def test_remote_edit(self):
+        # with no host, the request runs through a local "python -"
+        edit = {"op": "set", "key": "virt_type", "value": "qemu",
+                "section": "libvirt"}
+        res = remote_edit(None, self.path, [edit], get=[("virt_type",
+                                                         "libvirt")],
+                          dry_run=True)
+        self.assertEqual(res.changes, 1)
+        self.assertIn("+virt_type=qemu", res.diff)
+        self.assertEqual(res.values[("virt_type", "libvirt")], ["qemu"])
+        with open(self.path) as cfg:
+            self.assertEqual(cfg.read(), NOVA_CONF)
+
+        backup = self.path + ".bak"
+        remote_edit(None, self.path, [edit], backup=backup)
+        self.assertEqual(ConfigFile.read(self.path).get("virt_type"),
+                         ["qemu"])
+        self.assertTrue(os.path.exists(backup))
+        self.assertRaises(CommandException, remote_edit, None,
+                          self.path + ".missing", [edit])
+
+
+if __name__ == "__main__":
+    unittest.main()
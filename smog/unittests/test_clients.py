@@ -0,0 +1,134 @@
+__author__ = 'stoner'
+
+
+import threading
+import time
+import unittest
+
+from smog.clients import ClientSet, ClientRegistry
+from smog.core.metrics import unwrap
+
+CREDS = {"username": "admin", "password": "secret", "tenant_name": "admin",
+         "auth_url": "http://10.0.0.2:5000/v2.0/"}
+
+
+class FakeAccess(object):
+    def __init__(self, token, lifetime):
+        self.auth_token = token
+        self.expires = time.time() + lifetime
+
+    def will_expire_soon(self, stale_duration=30):
+        return self.expires - time.time() < stale_duration
+
+
+class FakeAuth(object):
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.tokens = 0
+        self.invalidated = 0
+
+    def get_access(self, session):
+        self.tokens += 1
+        return FakeAccess("token-{}".format(self.tokens), self.lifetime)
+
+    def invalidate(self):
+        self.invalidated += 1
+
+
+class FakeSession(object):
+    def __init__(self, auth):
+        self.auth = auth
+
+    def get_endpoint(self, **kwargs):
+        return "http://10.0.0.2:9292/"
+
+
+class FakeClient(object):
+    def __init__(self, name, token=None):
+        self.name = name
+        self.token = token
+
+
+class FakeClientSet(ClientSet):
+    """
+    A ClientSet whose clients are FakeClients, and which counts how many of
+    each it built
+    """
+    def __init__(self, creds, glance_version="1", **kwargs):
+        auth = kwargs.pop("auth", None) or FakeAuth()
+        super(FakeClientSet, self).__init__(creds,
+                                            glance_version=glance_version,
+                                            auth=auth,
+                                            session=FakeSession(auth),
+                                            **kwargs)
+        self.built = {}
+
+    def _build(self, name, token=None):
+        # give other threads a chance to race us
+        time.sleep(0.01)
+        self.built[name] = self.built.get(name, 0) + 1
+        return FakeClient(name, token)
+
+    def _make_nova(self):
+        return self._build("nova")
+
+    def _make_glance(self):
+        return self._build("glance", self._access.auth_token)
+
+
+class ClientSetTest(unittest.TestCase):
+
+    def test_same_creds_same_set(self):
+        registry = ClientRegistry(factory=FakeClientSet)
+        clients = registry.get(**CREDS)
+        self.assertIs(registry.get(**CREDS), clients)
+        other = dict(CREDS, password="other")
+        self.assertIsNot(registry.get(**other), clients)
+        self.assertIsNot(registry.get(glance_version="2", **CREDS), clients)
+
+    def test_concurrent_build(self):
+        clients = FakeClientSet(CREDS)
+        barrier = threading.Barrier(10)
+        seen = []
+
+        def use():
+            barrier.wait()
+            seen.append(clients.nova)
+
+        threads = [threading.Thread(target=use) for _ in range(10)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        self.assertEqual(clients.built["nova"], 1)
+        self.assertTrue(all(nova is seen[0] for nova in seen))
+        self.assertEqual(clients._auth.tokens, 1)
+
+    def test_refresh_margin(self):
+        auth = FakeAuth(lifetime=1000)
+        clients = FakeClientSet(CREDS, refresh_margin=300, auth=auth)
+        self.assertEqual(clients.token, "token-1")
+        self.assertEqual(clients.token, "token-1")
+        # the token now expires within refresh_margin, so a new one is got
+        # before it is used
+        clients._access.expires = time.time() + 100
+        self.assertEqual(clients.token, "token-2")
+        self.assertEqual(auth.invalidated, 1)
+
+    def test_glance_rebuilt_on_new_token(self):
+        clients = FakeClientSet(CREDS)
+        nova = clients.nova
+        glance = clients.glance
+        self.assertEqual(unwrap(glance).token, "token-1")
+        self.assertIs(clients.glance, glance)
+
+        clients.refresh()
+        self.assertIsNot(clients.glance, glance)
+        self.assertEqual(unwrap(clients.glance).token, "token-2")
+        self.assertEqual(clients.built["glance"], 2)
+        # clients using the session get the new token from it
+        self.assertIs(clients.nova, nova)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+__author__ = 'stoner'
+
+
+import os
+import queue
+import shlex
+import shutil
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+from subprocess import PIPE
+
+from smog.core.commander import fan_out, FanOutException
+from smog.core.commander import Command, CommandTimeout, OutputBuffer
+from smog.core.commander import QueueSink, CommandCache
+from smog.core.commander import run_framed, shell_command
+
+
+class FanOutTest(unittest.TestCase):
+
+    @staticmethod
+    def flaky(host):
+        if host.startswith("bad"):
+            raise Exception("{} is down".format(host))
+        return host.upper()
+
+    def test_partial_failure(self):
+        hosts = ["a", "bad1", "b"]
+        results = fan_out(self.flaky, hosts, max_workers=2)
+        self.assertEqual(list(results.keys()), hosts)
+        self.assertEqual(results["a"].value, "A")
+        self.assertTrue(results["b"].ok)
+        self.assertFalse(results["bad1"].ok)
+        self.assertIsNotNone(results["bad1"].error)
+
+    def test_throws(self):
+        with self.assertRaises(FanOutException) as cm:
+            fan_out(self.flaky, ["a", "bad1"], throws=True)
+        self.assertTrue(cm.exception.results["a"].ok)
+
+    def test_rolling_batches(self):
+        hosts = ["bad1", "a", "b", "c"]
+        results = fan_out(self.flaky, hosts, batch_size=2, max_failures=1)
+        self.assertFalse(results["bad1"].ok)
+        self.assertTrue(results["a"].ok)
+        self.assertTrue(results["b"].skipped)
+        self.assertTrue(results["c"].skipped)
+
+
+class CommandTimeoutTest(unittest.TestCase):
+
+    def test_kill_on_timeout(self):
+        start = time.time()
+        with self.assertRaises(CommandTimeout):
+            Command("sleep 30")(timeout=0.5, showout=False)
+        self.assertLess(time.time() - start, 5)
+
+    def test_no_throw_on_timeout(self):
+        res = Command("sh -c 'echo started; sleep 30'")(timeout=0.5,
+                                                        throws=False,
+                                                        checkresult=(False, 0),
+                                                        showout=False)
+        self.assertTrue(res.meta["timed_out"])
+        self.assertIsNotNone(res.returncode)
+        self.assertIn("started", res.output)
+
+    def test_separate_streams(self):
+        cmd = Command("sh -c 'echo out; echo err >&2'", stderr=PIPE)
+        res = cmd(showout=False, showerr=False)
+        self.assertEqual(res.output.strip(), "out")
+        self.assertEqual(res.error.strip(), "err")
+
+    def test_input(self):
+        # more than a pipe buffer, to check stdout is drained while writing
+        data = "line\n" * 30000
+        res = Command("wc -l")(input=data, showout=False)
+        self.assertEqual(res.output.strip(), "30000")
+
+    def test_output_buffer(self):
+        buf = OutputBuffer(max_bytes=4)
+        for chunk in (b"abc", b"def", b"gh"):
+            buf.write(chunk)
+        self.assertEqual(buf.getvalue(), b"efgh")
+        self.assertTrue(buf.truncated)
+
+
+class CaptureTest(unittest.TestCase):
+
+    def test_ring_buffer_lines(self):
+        buf = OutputBuffer(max_lines=2)
+        buf.write(b"one\ntwo\nth")
+        buf.write(b"ree\nfour\n")
+        self.assertEqual(buf.lines(), [b"three", b"four"])
+
+    def test_spill(self):
+        path = os.path.join(tempfile.mkdtemp(), "out.log")
+        res = Command("seq 1 1000")(max_lines=3, spill=path, showout=False)
+        self.assertEqual(res.output.split(), ["998", "999", "1000"])
+        self.assertEqual(res.meta["spilled"], [path])
+        with open(path) as spilled:
+            self.assertEqual(len(spilled.read().split()), 1000)
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_drop_backpressure(self):
+        que = queue.Queue(maxsize=2)
+        sink = QueueSink(que, backpressure="drop")
+        for chunk in (b"a", b"b", b"c"):
+            sink.write(chunk)
+        self.assertEqual(sink.dropped, 1)
+        self.assertEqual([que.get(), que.get()], [b"b", b"c"])
+
+    def test_nonblocking_capture(self):
+        res = Command("seq 1 100000")(block=False, showout=False)
+        buf = res.capture(max_bytes=64, queue_size=4, backpressure="drop")
+        res.proc.wait()
+        self.assertTrue(res.output.endswith("100000\n"))
+        self.assertLessEqual(len(buf.getvalue()), 64)
+
+
+class CommandCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CommandCache(ttl=60, max_entries=2)
+
+    def test_hit_and_invalidate(self):
+        cmd = Command("date +%N", cache=self.cache)
+        first = cmd(showout=False)
+        cmd.proc = None
+        self.assertIs(cmd(showout=False), first)
+        self.assertIs(cmd.proc, first.proc)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        # an uncached command to the same host invalidates it
+        Command("true")(showout=False)
+        self.assertIsNot(cmd(showout=False), first)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_ttl_and_lru(self):
+        self.cache.put(("h", "root", "a"), 1, ttl=-1)
+        self.assertIsNone(self.cache.get(("h", "root", "a")))
+        for name in ("a", "b", "c"):
+            self.cache.put(("h", "root", name), name)
+        self.assertIsNone(self.cache.get(("h", "root", "a")))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.assertEqual(self.cache.invalidate("h", cmd="b"), 1)
+        self.cache.put(("h", "root", "ls -l"), "ls")
+        self.assertEqual(self.cache.invalidate("h", cmd=["ls", "-l"]), 1)
+
+
+class FramedTest(unittest.TestCase):
+
+    def test_run_framed(self):
+        cmds = OrderedDict([("one", "echo hello; echo world"),
+                            ("two", "printf 'no newline'"),
+                            ("three", "echo 'it''s quoted' >&2; exit 3")])
+        frames = run_framed(None, cmds)
+        self.assertEqual(list(frames.keys()), ["one", "two", "three"])
+        self.assertEqual(frames["one"].output, "hello\nworld\n")
+        self.assertEqual(frames["two"].output, "no newline")
+        self.assertEqual(frames["three"].output, "its quoted\n")
+        self.assertEqual(frames["three"].returncode, 3)
+
+    def test_shell_command_remote_quoting(self):
+        script = "echo \"$HOME\" 'a b'"
+        toks = shlex.split(shell_command(script, remote=True))
+        # after ssh joins the tokens, the remote shell sees sh -c <script>
+        self.assertEqual(shlex.split(" ".join(toks)), ["sh", "-c", script])
@@ -0,0 +1,145 @@
+__author__ = 'stoner'
+
+
+import unittest
+
+from smog.core.libvirt_pool import LibvirtPool
+from smog.core.xml.domain_cache import DomainXMLCache, hugepages, vcpupins
+from smog.core.xml.domain_cache import numatune, cputune, numa_cells
+
+DOMAIN_XML = """<domain type='kvm' id='{id}'>
+  <name>{name}</name>
+  <uuid>{uuid}</uuid>
+  <memoryBacking>
+    <hugepages>
+      <page size='2048' unit='KiB' nodeset='0'/>
+    </hugepages>
+  </memoryBacking>
+  <cputune>
+    <shares>2048</shares>
+    <vcpupin vcpu='0' cpuset='2'/>
+    <vcpupin vcpu='1' cpuset='3'/>
+    <emulatorpin cpuset='2-3'/>
+  </cputune>
+  <numatune>
+    <memory mode='strict' nodeset='0'/>
+    <memnode cellid='0' mode='strict' nodeset='0'/>
+  </numatune>
+  <cpu>
+    <numa>
+      <cell id='0' cpus='0-1' memory='524288' unit='KiB'/>
+    </numa>
+  </cpu>
+</domain>
+"""
+
+
+class FakeDomain(object):
+    def __init__(self, uuid, dom_id):
+        self.uuid = uuid
+        self.dom_id = dom_id
+        self.xml_calls = 0
+
+    def UUIDString(self):
+        return self.uuid
+
+    def ID(self):
+        return self.dom_id
+
+    def name(self):
+        return "instance-{}".format(self.uuid)
+
+    def XMLDesc(self, flags=0):
+        self.xml_calls += 1
+        return DOMAIN_XML.format(id=self.dom_id, name=self.name(),
+                                 uuid=self.uuid)
+
+
+class FakeConn(object):
+    def __init__(self, uri, domains):
+        self.domains = domains
+        self.lists = 0
+        self.callbacks = []
+
+    def isAlive(self):
+        return 1
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+    def listAllDomains(self, flags=0):
+        self.lists += 1
+        return list(self.domains)
+
+    def domainEventRegisterAny(self, dom, event_id, cb, opaque):
+        self.callbacks.append(cb)
+        return len(self.callbacks)
+
+    def close(self):
+        return 0
+
+
+class TestDomainCache(unittest.TestCase):
+    def setUp(self):
+        self.conns = {}
+        self.domains = {}
+
+        def opener(uri):
+            domains = self.domains.setdefault(
+                uri, [FakeDomain("u{}".format(i), i) for i in range(20)])
+            self.conns[uri] = FakeConn(uri, domains)
+            return self.conns[uri]
+
+        self.pool = LibvirtPool(opener=opener)
+        self.cache = DomainXMLCache(pool=self.pool)
+
+    def test_one_pass_per_hypervisor(self):
+        for i in range(20):
+            self.assertIsNotNone(self.cache.get("u{}".format(i), host="hv1"))
+        conn = self.conns["qemu+ssh://root@hv1/system"]
+        self.assertEqual(conn.lists, 1)
+        self.assertEqual(self.cache.fetches, 20)
+
+        # a restarted domain gets a new id, so only it is fetched again
+        conn.domains[3].dom_id = 99
+        conn.domains.pop()
+        self.assertEqual(self.cache.refresh("hv1"), 1)
+        self.assertIsNone(self.cache.get("u19"))
+        self.assertEqual(conn.domains[3].xml_calls, 2)
+        self.assertEqual(conn.domains[4].xml_calls, 1)
+
+    def test_events_after_reconnect(self):
+        uri = "qemu+ssh://root@hv1/system"
+        self.cache.refresh("hv1")
+        first = self.conns[uri]
+        self.assertEqual(len(first.callbacks), 1)
+        self.cache.refresh("hv1")
+        self.assertEqual(len(first.callbacks), 1)
+
+        # an event changes the generation, so the domain is fetched again
+        dom = first.domains[0]
+        first.callbacks[0](first, dom, 0, 0, None)
+        self.assertEqual(self.cache.refresh("hv1"), 1)
+
+        # the pool closed the connection, so the callback went with it
+        self.pool.close_all()
+        self.assertEqual(self.cache.refresh("hv1"), 20)
+        second = self.conns[uri]
+        self.assertIsNot(second, first)
+        self.assertEqual(len(second.callbacks), 1)
+
+    def test_queries(self):
+        root = self.cache.get("u0", host="hv1")
+        self.assertEqual(hugepages(root), [{"size": "2048", "unit": "KiB",
+                                            "nodeset": "0"}])
+        self.assertEqual(vcpupins(root), {0: "2", 1: "3"})
+        self.assertEqual(numatune(root)["memory"]["mode"], "strict")
+        self.assertEqual(len(numatune(root)["memnodes"]), 1)
+        tune = cputune(root)
+        self.assertEqual(tune["emulatorpin"], "2-3")
+        self.assertEqual(tune["shares"], "2048")
+        self.assertEqual(numa_cells(root)[0]["cpus"], "0-1")
+
+
+if __name__ == "__main__":
+    unittest.main()
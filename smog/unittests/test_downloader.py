@@ -0,0 +1,127 @@
+__author__ = 'stoner'
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from smog.core.downloader import StreamingDownloader, DownloadError
+
+DATA = os.urandom(300000)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA, honouring Range requests.  The first fail_after bytes of the
+    first GET are sent before the connection is dropped
+    """
+    fail_after = None
+    gets = []
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, start, end):
+        rng = self.headers.get("Range")
+        self.send_response(206 if rng else 200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"v1"')
+        if rng:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, end - 1, len(DATA)))
+        self.end_headers()
+
+    def _range(self):
+        rng = self.headers.get("Range")
+        if not rng:
+            return 0, len(DATA)
+        start, _, end = rng.split("=")[1].partition("-")
+        return int(start), int(end) + 1 if end else len(DATA)
+
+    def do_HEAD(self):
+        self._headers(0, len(DATA))
+
+    def do_GET(self):
+        start, end = self._range()
+        RangeHandler.gets.append((start, end))
+        self._headers(start, end)
+        body = DATA[start:end]
+        if RangeHandler.fail_after is not None:
+            body = body[:RangeHandler.fail_after]
+            RangeHandler.fail_after = None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class StreamingDownloaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:{}/cirros.img".format(
+            cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        RangeHandler.gets = []
+        RangeHandler.fail_after = None
+        self.dl = StreamingDownloader(cache_dir=os.path.join(self.tmpdir, "c"),
+                                      chunk_size=8192, min_segment=50000,
+                                      retries=2)
+        self.sha = hashlib.sha256(DATA).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_parallel_segments(self):
+        dest = os.path.join(self.tmpdir, "img")
+        self.dl.download(self.url, dest, checksum="sha256:" + self.sha)
+        with open(dest, "rb") as img:
+            self.assertEqual(img.read(), DATA)
+        self.assertEqual(len(RangeHandler.gets), 4)
+        self.assertFalse(os.path.exists(dest + ".part"))
+
+    def test_resume(self):
+        self.dl.segments = 1
+        RangeHandler.fail_after = 100000
+        dest = os.path.join(self.tmpdir, "img")
+        self.dl.download(self.url, dest, checksum=self.sha)
+        with open(dest, "rb") as img:
+            self.assertEqual(img.read(), DATA)
+        # the retry picked up where the dropped connection stopped
+        self.assertEqual(RangeHandler.gets[-1][0], 100000)
+
+    def test_bad_checksum(self):
+        dest = os.path.join(self.tmpdir, "img")
+        with self.assertRaises(DownloadError):
+            self.dl.download(self.url, dest, checksum="md5:" + "0" * 32)
+        self.assertFalse(os.path.exists(dest))
+
+    def test_cache(self):
+        first = self.dl.fetch(self.url)
+        self.assertTrue(first.endswith(self.sha))
+        gets = len(RangeHandler.gets)
+        dest = os.path.join(self.tmpdir, "cirros.img")
+        self.assertEqual(self.dl.fetch_to(self.url, dest), dest)
+        self.assertEqual(len(RangeHandler.gets), gets)
+        with open(dest, "rb") as img:
+            self.assertEqual(img.read(), DATA)
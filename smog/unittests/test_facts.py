@@ -0,0 +1,67 @@
+__author__ = 'stoner'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import smog.facts
+from smog.facts import FactCache, host_facts, parse_numactl, parse_lspci
+from smog.facts import parse_os_release
+
+
+NUMACTL = """available: 2 nodes (0-1)
+node 0 cpus: 0 1 2 3
+node 0 size: 8192 MB
+node 0 free: 4096 MB
+node 1 cpus: 4 5 6 7
+node 1 size: 8192 MB
+node 1 free: 2048 MB
+"""
+
+LSPCI = "0000:00:19.0 Ethernet controller [0200]: Intel Corporation " \
+        "Ethernet Connection I217-LM [8086:153a] (rev 04)"
+
+
+class FactsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "facts.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_parsers(self):
+        nodes = parse_numactl(NUMACTL)
+        self.assertEqual(nodes["number"], 2)
+        self.assertEqual(nodes[1]["free"], "2048 MB")
+        dev = parse_lspci(LSPCI)[0]
+        self.assertEqual((dev["vendor"], dev["device"]), ("8086", "153a"))
+        self.assertEqual(dev["class"], "0200")
+        rhel7 = parse_os_release('NAME="Red Hat Enterprise Linux Server"\n'
+                                 'VERSION="7.2 (Maipo)"\nVERSION_ID="7.2"\n')
+        self.assertEqual(rhel7, {"name": "Red Hat Enterprise Linux Server",
+                                 "version": "7.2", "codename": "Maipo"})
+        # RHEL/CentOS 6 only have /etc/redhat-release
+        centos6 = parse_os_release("CentOS release 6.7 (Final)\n")
+        self.assertEqual(centos6, {"name": "CentOS", "version": "6.7",
+                                   "codename": "Final"})
+
+    def test_cache_roundtrip(self):
+        # host None gathers the facts of the local machine
+        cache = FactCache(self.path)
+        first = host_facts(None, cache=cache)
+        self.assertEqual(first.version, smog.facts.FACTS_VERSION)
+        self.assertTrue(first.boot_id)
+        cache.save()
+
+        # a fresh cache loads it from disk without gathering anything
+        cached = host_facts(None, cache=FactCache(self.path))
+        self.assertEqual(cached, first)
+
+        # past the ttl, only the volatile facts are refreshed
+        refreshed = host_facts(None, cache=cache, ttl=0)
+        self.assertEqual(refreshed.gathered_at, first.gathered_at)
+        self.assertGreater(refreshed.refreshed_at, first.refreshed_at)
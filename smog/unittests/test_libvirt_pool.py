@@ -0,0 +1,88 @@
+__author__ = 'stoner'
+
+
+import unittest
+
+import libvirt
+
+from smog.core.libvirt_pool import LibvirtPool
+
+
+class FakeConn(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.alive = True
+        self.closed = False
+        self.keepalive = None
+        self.drop = False
+
+    def isAlive(self):
+        return 1 if self.alive else 0
+
+    def setKeepAlive(self, interval, count):
+        self.keepalive = (interval, count)
+
+    def getHostname(self):
+        if self.drop:
+            self.alive = False
+        if not self.alive:
+            raise libvirt.libvirtError("connection is dead")
+        return self.uri
+
+    def close(self):
+        self.closed = True
+        self.alive = False
+        return 0
+
+
+class TestLibvirtPool(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+
+        def opener(uri):
+            conn = FakeConn(uri)
+            self.opened.append(conn)
+            return conn
+
+        self.pool = LibvirtPool(max_connections=2, opener=opener)
+
+    def test_reuse_and_close(self):
+        conn = self.pool.get("10.0.0.1")
+        self.assertEqual(conn.getHostname(), "qemu+ssh://root@10.0.0.1/system")
+        conn.close()
+        again = self.pool.get("10.0.0.1")
+        again.getHostname()
+        self.assertEqual(len(self.opened), 1)
+        self.assertFalse(self.opened[0].closed)
+        self.assertEqual(self.opened[0].keepalive, (5, 3))
+
+    def test_reconnect(self):
+        conn = self.pool.get("10.0.0.1")
+        # dies between calls: noticed by isAlive
+        self.opened[0].alive = False
+        conn.getHostname()
+        self.assertEqual(len(self.opened), 2)
+        # dies during a call: the call is retried on a new connection
+        self.opened[1].drop = True
+        self.assertEqual(conn.getHostname(),
+                         "qemu+ssh://root@10.0.0.1/system")
+        self.assertEqual(len(self.opened), 3)
+
+    def test_lru_eviction(self):
+        first = self.pool.get("10.0.0.1")
+        self.pool.get("10.0.0.2")
+        self.pool.get("10.0.0.1")
+        self.pool.get("10.0.0.3")
+        # 10.0.0.2 was the least recently used
+        self.assertTrue(self.opened[1].closed)
+        self.assertFalse(self.opened[0].closed)
+        self.assertEqual(len(self.pool.stats()), 2)
+        self.pool.close_all()
+        self.assertTrue(all(conn.closed for conn in self.opened))
+        # a proxy whose connection was closed just reopens it
+        first.getHostname()
+        self.assertEqual(len(self.opened), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
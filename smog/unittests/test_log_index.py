@@ -0,0 +1,62 @@
+__author__ = 'stoner'
+
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from smog.utils.log_analysis.log_index import LogIndex
+
+REQ = "req-0c2f5c4a-2a0b-4c3e-9a6d-3f1f5b7f9e11"
+INST = "1c3a0e5b-8c1d-4d43-a3c4-16c6e6d6a7b2"
+
+COMPUTE = """\
+2015-09-11 10:22:33.100 4242 INFO nova.compute.manager [{req} admin admin - - -] [instance: {inst}] Starting instance...
+2015-09-11 10:22:34.200 4242 ERROR nova.compute.manager [{req} admin admin - - -] [instance: {inst}] Instance failed to spawn
+Traceback (most recent call last):
+  File "/usr/lib/python2.7/site-packages/nova/compute/manager.py", line 2461, in _build_resources
+libvirtError: internal error: process exited while connecting to monitor
+2015-09-11 10:22:35.000 4242 DEBUG nova.openstack.common.periodic_task [-] Running periodic task
+""".format(req=REQ, inst=INST)
+
+API = """\
+2015-09-11 10:22:33.000 1717 INFO nova.osapi_compute.wsgi.server [{req} admin admin - - -] POST /v2/servers
+2015-09-11 10:22:36.000 1717 ERROR nova.api.openstack [{req} admin admin - - -] raise exceptions.NotFound
+""".format(req=REQ)
+
+
+class LogIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        compute_dir = os.path.join(self.root, "compute1", "var", "log", "nova")
+        api_dir = os.path.join(self.root, "controller", "var", "log", "nova")
+        os.makedirs(compute_dir)
+        os.makedirs(api_dir)
+        with gzip.open(os.path.join(compute_dir, "nova-compute.log.1.gz"),
+                       "wt") as log:
+            log.write(COMPUTE)
+        with open(os.path.join(api_dir, "nova-api.log"), "w") as log:
+            log.write(API)
+        self.index = LogIndex()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_ingest_and_query(self):
+        self.assertEqual(self.index.ingest_dir(self.root), 5)
+        # unchanged files are not ingested again
+        self.assertEqual(self.index.ingest_dir(self.root), 0)
+
+        errors = self.index.query(request_id=REQ, level="ERROR")
+        self.assertEqual([e.host for e in errors], ["compute1", "controller"])
+        self.assertIn("libvirtError", errors[0].message)
+        self.assertEqual(errors[0].instance, INST)
+        self.assertEqual(errors[1].exception, "NotFound")
+
+        self.assertEqual(len(self.index.query(instance=INST)), 2)
+        self.assertEqual(self.index.request_ids(), [REQ])
+        self.assertEqual(len(self.index.query(since="2015-09-11 10:22:35")), 2)
@@ -0,0 +1,99 @@
+__author__ = 'stoner'
+
+
+import json
+import unittest
+
+from smog.core.metrics import MetricsRegistry, Histogram, instrument, unwrap
+from smog.core.metrics import connect_errors
+
+
+class Servers(object):
+    def __init__(self):
+        self.calls = 0
+
+    def list(self):
+        return ["vm1"]
+
+    def get(self, name):
+        self.calls += 1
+        if self.calls == 1:
+            raise IOError("connection reset")
+        return name
+
+    def create(self, name):
+        raise IOError("connection reset")
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.servers = Servers()
+        self.auth_url = "http://keystone:5000/v2.0"
+
+    def list_networks(self):
+        raise ValueError("boom")
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        hist = Histogram(sub_buckets=32)
+        for val in range(1, 1001):
+            hist.observe(val / 100.0)
+        self.assertEqual(hist.count, 1000)
+        self.assertAlmostEqual(hist.percentile(50), 5.0, delta=5.0 / 32)
+        self.assertAlmostEqual(hist.percentile(99), 9.9, delta=9.9 / 32)
+        self.assertEqual(hist.percentile(100), 10.0)
+        self.assertEqual(hist.cumulative()[-1], ("+Inf", 1000))
+
+
+class InstrumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.client = instrument(FakeClient(), "nova", registry=self.registry,
+                                 retries=1, retry_on=(IOError,),
+                                 retry_delay=0.5)
+
+    def test_calls_recorded(self):
+        self.assertEqual(self.client.servers.list(), ["vm1"])
+        self.assertEqual(self.client.servers.get("vm2"), "vm2")
+        self.assertEqual(self.client.auth_url, "http://keystone:5000/v2.0")
+        with self.assertRaises(ValueError):
+            self.client.list_networks()
+        # creates aren't safe to retry
+        with self.assertRaises(IOError):
+            self.client.servers.create("vm3")
+
+        reg = self.registry
+        get = reg.histogram("smog_api_seconds", service="nova",
+                            op="servers.get")
+        self.assertEqual(get.count, 2)
+        # each attempt is timed on its own, without the retry_delay
+        self.assertLess(get.sum, 0.5)
+        self.assertEqual(reg.counter("smog_api_retries_total", service="nova",
+                                     op="servers.get").value, 1)
+        self.assertEqual(reg.counter("smog_api_retries_total", service="nova",
+                                     op="servers.create").value, 0)
+        self.assertEqual(reg.counter("smog_api_errors_total", service="nova",
+                                     op="list_networks",
+                                     error="ValueError").value, 1)
+        self.assertIsInstance(unwrap(self.client), FakeClient)
+
+    def test_default_retries(self):
+        client = instrument(FakeClient(), "nova", registry=self.registry)
+        self.assertEqual(client._retry_on, connect_errors())
+        self.assertTrue(client._retries)
+
+    def test_exports(self):
+        self.client.servers.list()
+        data = json.loads(self.registry.to_json())
+        entry = data["smog_api_seconds"][0]
+        self.assertEqual(entry["labels"], {"service": "nova",
+                                           "op": "servers.list"})
+        self.assertEqual(entry["value"]["count"], 1)
+        text = self.registry.to_prometheus()
+        self.assertIn("# TYPE smog_api_seconds histogram", text)
+        self.assertIn('smog_api_seconds_count{op="servers.list",'
+                      'service="nova"} 1', text)
+        self.assertIn('le="+Inf"', text)
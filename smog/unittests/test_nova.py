@@ -0,0 +1,130 @@
+__author__ = 'stoner'
+
+
+import datetime
+import time
+import unittest
+
+from novaclient.exceptions import NotFound
+
+from smog.nova import StatusWaiter, histogram
+
+
+class FakeServer(object):
+    def __init__(self, id, name, status):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.updated = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        self._info = {"status": status}
+
+    def _add_details(self, info):
+        for key, val in info.items():
+            setattr(self, key, val)
+
+
+class FakeServers(object):
+    def __init__(self, script, current=None, fail=False):
+        # one list of (id, status) per call to list
+        self.script = script
+        # id -> status returned by get (BUILD if missing, None if deleted)
+        self.current = {} if current is None else current
+        self.fail = fail
+        self.opts = []
+
+    def get(self, id):
+        status = self.current.get(id, "BUILD")
+        if status is None:
+            raise NotFound("no server {}".format(id))
+        return FakeServer(id, "vm-{}".format(id), status)
+
+    def list(self, detailed=True, search_opts=None):
+        self.opts.append(search_opts)
+        if self.fail:
+            raise IOError("nova is down")
+        changes = self.script.pop(0) if self.script else []
+        return [FakeServer(i, "vm-{}".format(i), s) for i, s in changes]
+
+
+class FakeNova(object):
+    def __init__(self, script, **kwargs):
+        self.servers = FakeServers(script, **kwargs)
+
+
+class StatusWaiterTest(unittest.TestCase):
+
+    def test_one_call_per_tick(self):
+        nova = FakeNova([[(1, "BUILD"), (2, "BUILD")],
+                         [(1, "ACTIVE"), (3, "ACTIVE")],
+                         [],
+                         [(2, "ERROR")]])
+        waiter = StatusWaiter(nova, poll_interval=0.01, max_interval=0.02)
+        instances = [FakeServer(i, "vm-{}".format(i), "BUILD")
+                     for i in (1, 2)]
+        seen = []
+        for inst in instances:
+            waiter.watch(inst, "ACTIVE",
+                         callback=lambda i, ok: seen.append((i.id, ok)))
+        results = waiter.wait()
+        self.assertEqual(results, {1: True, 2: False})
+        self.assertEqual(sorted(seen), [(1, True), (2, False)])
+        # a get for each new instance, then one list per tick
+        self.assertEqual(waiter.calls, 6)
+        self.assertEqual(len(nova.servers.opts), 4)
+        self.assertEqual(instances[0].status, "ACTIVE")
+        self.assertIn("changes-since", nova.servers.opts[0])
+
+    def test_deleted_and_timeout(self):
+        nova = FakeNova([[(1, "DELETED")]])
+        waiter = StatusWaiter(nova, poll_interval=0.01)
+        gone = waiter.watch(FakeServer(1, "vm-1", "ACTIVE"), "deleted")
+        stuck = waiter.watch(FakeServer(2, "vm-2", "BUILD"), "ACTIVE",
+                             timeout=0.05)
+        waiter.wait()
+        self.assertTrue(gone.result())
+        self.assertFalse(stuck.result())
+
+    def test_already_there(self):
+        nova = FakeNova([], current={1: "ACTIVE", 2: None})
+        waiter = StatusWaiter(nova, poll_interval=0.01, skew=0)
+        active = waiter.watch(FakeServer(1, "vm-1", "BUILD"), "ACTIVE",
+                              timeout=5)
+        gone = waiter.watch(FakeServer(2, "vm-2", "ACTIVE"), "deleted",
+                            timeout=5)
+        start = time.time()
+        waiter.wait()
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(active.result())
+        self.assertTrue(gone.result())
+        self.assertEqual(nova.servers.opts, [])
+
+    def test_failing_api(self):
+        nova = FakeNova([], fail=True)
+        waiter = StatusWaiter(nova, poll_interval=0.01, max_interval=0.05)
+        fut = waiter.watch(FakeServer(1, "vm-1", "BUILD"), "ACTIVE",
+                           timeout=0.3)
+        start = time.time()
+        self.assertEqual(waiter.wait(), {1: False})
+        self.assertLess(time.time() - start, 2)
+        self.assertFalse(fut.result())
+        # failed ticks back off rather than spinning
+        self.assertLess(len(nova.servers.opts), 30)
+
+        waiter = StatusWaiter(nova, poll_interval=0.01,
+                              max_interval=0.05).start()
+        fut = waiter.watch(FakeServer(2, "vm-2", "BUILD"), "ACTIVE",
+                           timeout=0.3)
+        self.assertFalse(fut.result(timeout=5))
+        waiter.stop()
+
+    def test_background(self):
+        nova = FakeNova([[], [(1, "ACTIVE")]])
+        waiter = StatusWaiter(nova, poll_interval=0.01).start()
+        fut = waiter.watch(FakeServer(1, "vm-1", "BUILD"), "ACTIVE")
+        self.assertTrue(fut.result(timeout=5))
+        waiter.stop()
+
+    def test_histogram(self):
+        hist = histogram([1, 20, 25, 400], buckets=(15, 30))
+        self.assertEqual(list(hist.items()),
+                         [("<=15", 1), ("<=30", 2), (">30", 1)])
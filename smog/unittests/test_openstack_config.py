@@ -0,0 +1,116 @@
+__author__ = 'stoner'
+
+
+import shlex
+import unittest
+from collections import OrderedDict
+
+import smog.tests.base as base
+from smog.core.commander import FramedOutput
+
+NOVA_CONF = "/etc/nova/nova.conf"
+
+
+class FakeHosts(object):
+    """
+    Stands in for run_framed, running openstack-config against a dict of
+    (section, key) -> value per host
+    """
+    def __init__(self, configs):
+        self.configs = configs
+        self.calls = []
+
+    def __call__(self, host, commands, **kwargs):
+        self.calls.append((host, commands))
+        if host not in self.configs:
+            raise Exception("could not reach {}".format(host))
+        config = self.configs[host]
+        frames = OrderedDict()
+        for name, cmd in commands.items():
+            toks = shlex.split(cmd)
+            opt, item = toks[1], (toks[3], toks[4])
+            if opt == "--set":
+                config[item] = toks[5]
+                frames[name] = FramedOutput(name, "", 0)
+            elif item in config:
+                frames[name] = FramedOutput(name, config[item] + "\n", 0)
+            else:
+                frames[name] = FramedOutput(name, "", 1)
+        return frames
+
+
+class OpenstackConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeHosts({
+            "c1": {("DEFAULT", "debug"): "True",
+                   ("DEFAULT", "cpu_allocation_ratio"): "16.0",
+                   ("libvirt", "virt_type"): "kvm"},
+            "c2": {("DEFAULT", "debug"): "False",
+                   ("libvirt", "virt_type"): "kvm"}})
+        self.orig = base.run_framed
+        base.run_framed = self.fake
+
+    def tearDown(self):
+        base.run_framed = self.orig
+
+    def test_parse_config_value(self):
+        self.assertIs(base.parse_config_value("True"), True)
+        self.assertIs(base.parse_config_value(" false\n"), False)
+        self.assertEqual(base.parse_config_value("8"), 8)
+        self.assertEqual(base.parse_config_value("1.5"), 1.5)
+        self.assertEqual(base.parse_config_value(" kvm\n"), "kvm")
+
+    def test_get(self):
+        items = [("DEFAULT", "debug"), ("DEFAULT", "cpu_allocation_ratio"),
+                 ("DEFAULT", "missing")]
+        found = base.openstack_configs(NOVA_CONF, items, host="c1")
+        self.assertEqual(list(found.items()),
+                         [(("DEFAULT", "debug"), True),
+                          (("DEFAULT", "cpu_allocation_ratio"), 16.0),
+                          (("DEFAULT", "missing"), None)])
+        # one invocation, with one frame per key
+        self.assertEqual(len(self.fake.calls), 1)
+        host, commands = self.fake.calls[0]
+        self.assertEqual(host, "c1")
+        self.assertEqual(list(commands.keys()), ["g0", "g1", "g2"])
+        self.assertEqual(commands["g0"], "openstack-config --get "
+                                         "/etc/nova/nova.conf DEFAULT debug")
+        untyped = base.openstack_configs(NOVA_CONF, items[:1], host="c1",
+                                         typed=False)
+        self.assertEqual(untyped[("DEFAULT", "debug")], "True")
+
+    def test_set(self):
+        items = OrderedDict([(("libvirt", "virt_type"), "qemu"),
+                             (("DEFAULT", "vnc_keymap"), "en us")])
+        found = base.openstack_configs(NOVA_CONF, items, opt="set",
+                                       host="c2")
+        self.assertEqual(list(found.values()), ["qemu", "en us"])
+        _, commands = self.fake.calls[0]
+        # each key is set, then read back
+        self.assertEqual(list(commands.keys()), ["s0", "g0", "s1", "g1"])
+        self.assertEqual(commands["s1"], "openstack-config --set "
+                                         "/etc/nova/nova.conf DEFAULT "
+                                         "vnc_keymap 'en us'")
+        self.assertEqual(self.fake.configs["c2"][("libvirt", "virt_type")],
+                         "qemu")
+
+    def test_verify_configs(self):
+        expected = {("DEFAULT", "debug"): "True",
+                    ("libvirt", "virt_type"): "kvm"}
+        wrong = base.BaseTest.verify_configs(["c1", "c2", "down"], NOVA_CONF,
+                                             expected)
+        self.assertEqual(list(wrong.keys()), ["c1", "c2", "down"])
+        self.assertEqual(wrong["c1"], {})
+        self.assertEqual(wrong["c2"], {("DEFAULT", "debug"): "False"})
+        # a host which could not be checked has every item wrong
+        self.assertEqual(wrong["down"], {("DEFAULT", "debug"): None,
+                                         ("libvirt", "virt_type"): None})
+        self.assertTrue(base.BaseTest.verify_config("c1", NOVA_CONF, "debug",
+                                                    "True"))
+        self.assertFalse(base.BaseTest.verify_config("c2", NOVA_CONF,
+                                                     "debug", "True"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+__author__ = 'stoner'
+
+
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from smog.core.sshpool import SSHControlPool
+
+
+class SSHControlPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control_dir = tempfile.mkdtemp()
+        # use true(1) in place of ssh so the control commands always succeed
+        self.pool = SSHControlPool(control_dir=self.control_dir, ssh="true",
+                                   max_sessions=2, idle_timeout=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def test_ssh_args(self):
+        args = self.pool.ssh_args("root", "10.0.0.1")
+        self.assertEqual(args[0], "true")
+        self.assertEqual(args[-1], "root@10.0.0.1")
+        self.assertIn("ControlMaster=auto", args)
+        path = "ControlPath={}".format(self.pool.control_path("root",
+                                                              "10.0.0.1"))
+        self.assertIn(path, args)
+
+    def test_disabled(self):
+        self.pool.enabled = False
+        self.assertEqual(self.pool.ssh_args("root", "10.0.0.1"),
+                         ["true", "root@10.0.0.1"])
+
+    def test_session_limit(self):
+        self.pool.acquire("root", "10.0.0.1")
+        self.pool.acquire("root", "10.0.0.1")
+        master = self.pool._get_master("root", "10.0.0.1")
+        self.assertFalse(master.sessions.acquire(blocking=False))
+        self.pool.release("root", "10.0.0.1")
+        self.assertTrue(master.sessions.acquire(blocking=False))
+        master.sessions.release()
+        self.pool.release("root", "10.0.0.1")
+
+    def test_evict_idle(self):
+        with self.pool.session("root", "10.0.0.1"):
+            # in use masters are never evicted
+            self.assertEqual(self.pool.evict_idle(), [])
+        self.assertEqual(self.pool.evict_idle(), [("root", "10.0.0.1")])
+        self.assertEqual(self.pool.stats(), {})
+
+    def test_pinned_not_evicted(self):
+        # a non-blocking command, eg journalctl -f, streaming over the master
+        proc = subprocess.Popen(["sleep", "30"])
+        self.pool.pin("root", "10.0.0.1", proc)
+        with self.pool.session("root", "10.0.0.2"):
+            pass
+        self.assertEqual(self.pool.evict_idle(), [("root", "10.0.0.2")])
+        self.assertEqual(self.pool.stats()["root@10.0.0.1"]["streams"], 1)
+        proc.kill()
+        proc.wait()
+        self.assertEqual(self.pool.evict_idle(), [("root", "10.0.0.1")])
+
+    def test_waiting_acquire_reserves(self):
+        self.pool.acquire("root", "10.0.0.1")
+        self.pool.acquire("root", "10.0.0.1")
+        waiter = threading.Thread(target=self.pool.acquire,
+                                  args=("root", "10.0.0.1"))
+        waiter.start()
+        time.sleep(0.1)
+        # the blocked acquire already counts, so the master can't be evicted
+        # from under it (which would hand it a fresh, second semaphore)
+        self.assertEqual(self.pool.stats()["root@10.0.0.1"]["in_use"], 3)
+        for _ in range(2):
+            self.pool.release("root", "10.0.0.1")
+            self.assertEqual(self.pool.evict_idle(), [])
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.pool.release("root", "10.0.0.1")
+        self.assertEqual(self.pool.evict_idle(), [("root", "10.0.0.1")])
+
+    def test_close_while_in_use(self):
+        self.pool.acquire("root", "10.0.0.1")
+        self.pool.close_all()
+        # still in use, so only marked for closing
+        self.assertEqual(list(self.pool.stats().keys()), ["root@10.0.0.1"])
+        self.pool.release("root", "10.0.0.1")
+        self.assertEqual(self.pool.stats(), {})
+        # releasing a master the pool no longer knows about does nothing
+        self.pool.release("root", "10.0.0.1")
+        with self.pool.session("root", "10.0.0.1"):
+            pass
@@ -1,9 +1,18 @@
 __author__ = 'stoner'
 
 
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from smog.core.watcher import Watcher, Handler
+from smog.core.watcher import Watcher, Handler, WatchMultiplexer
+from smog.core.watcher import ExceptionHandler, HandlerGroup, PatternSet
+from smog.core.watcher import Tailer, MultiJournalWatcher, journal_command
 from smog.core.commander import Command
 
 
@@ -23,4 +32,178 @@ class WatcherTest(unittest.TestCase):
         mntr_proc = watcher.start_monitor(handler, watcher.queue)
         rdr_proc.start()
         mntr_proc.start()
-        mntr_proc.join(600)
\ No newline at end of file
+        mntr_proc.join(600)
+
+class WatchMultiplexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mux = WatchMultiplexer(poll_interval=0.05)
+
+    def tearDown(self):
+        self.mux.close()
+
+    def test_pipe(self):
+        res = Command("sh -c 'echo a; echo FOO; sleep 30'")(block=False)
+        stream = self.mux.watch(res, Handler, name="pipe")
+        # Handler terminates its reader when it sees FOO
+        self.assertTrue(stream.wait(5))
+        self.assertEqual(stream.handler.result, "failed")
+        self.assertIsNotNone(res.proc.wait(5))
+
+    def test_file_and_hook(self):
+        ticks = []
+        self.mux.add_hook(lambda: ticks.append(1), 0.05)
+        with tempfile.NamedTemporaryFile("w") as logf:
+            logf.write("FOO from before we started watching\n")
+            logf.flush()
+            stream = self.mux.watch(logf.name, Handler, name="file")
+            time.sleep(0.2)
+            self.assertTrue(stream.is_alive())
+            logf.write("a partial li")
+            logf.flush()
+            time.sleep(0.2)
+            logf.write("ne with FOO\n")
+            logf.flush()
+            self.assertTrue(stream.wait(5))
+        self.assertEqual(stream.handler.result, "failed")
+        self.assertTrue(ticks)
+        self.assertEqual(self.mux.streams, {})
+
+
+class PatternSetTest(unittest.TestCase):
+
+    def test_matches(self):
+        pset = PatternSet()
+        pset.add("literal", "Creating config drive")
+        pset.add("regex", re.compile(r"(\w+Error)"))
+        pset.add("backref", r"(\d)\1")
+        self.assertEqual(pset.matches("nothing to see"), [])
+        found = pset.matches("ValueError while Creating config drive")
+        self.assertEqual(sorted(k for k, _ in found), ["literal", "regex"])
+        self.assertEqual(dict(found)["regex"].group(1), "ValueError")
+        self.assertEqual([k for k, _ in pset.matches("port 8811")], ["backref"])
+
+    def test_mixed_patterns_one_key(self):
+        pset = PatternSet()
+        pset.add(0, "Creating config drive")
+        pset.add(0, r"migrat\w+")
+        self.assertEqual([k for k, _ in pset.matches("live migration started")],
+                         [0])
+        self.assertEqual([k for k, _ in pset.matches("Creating config drive")],
+                         [0])
+
+        seen = []
+
+        class Mixed(Handler):
+            def __init__(self, rdr):
+                super(Mixed, self).__init__(rdr)
+                self.patterns = ["Creating config drive", r"migrat\w+"]
+
+            def __call__(self, line):
+                seen.append(line)
+                return True
+
+        group = HandlerGroup(threading.Thread(), [Mixed])
+        group("live migration started\n")
+        group("Creating config drive\n")
+        group("all quiet\n")
+        self.assertEqual(seen, ["live migration started\n",
+                                "Creating config drive\n"])
+
+    def test_handler_group(self):
+        seen = []
+
+        class Everything(Handler):
+            def __call__(self, line):
+                seen.append(line)
+                return True
+
+        rdr = threading.Thread()
+        group = HandlerGroup(rdr, [Everything, (ExceptionHandler, (),
+                                                {"die": False})])
+        group.rdr.terminate = lambda: None
+        self.assertTrue(group("all quiet\n"))
+        # ExceptionHandler is done, but Everything keeps the group going
+        self.assertTrue(group("raise exceptions.NotFound\n"))
+        self.assertTrue(group.members[1][1].done)
+        self.assertEqual(len(seen), 2)
+        self.assertIn("NotFound", group.result[1])
+
+
+class TailerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "nova.log")
+        self.ckpt = os.path.join(self.tmpdir, "offsets.json")
+        self.write("old\n", "w")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write(self, text, mode="a"):
+        with open(self.path, mode) as logf:
+            logf.write(text)
+
+    def test_rename_rotation(self):
+        tailer = Tailer(self.path)
+        self.write("one\ntw")
+        self.assertEqual(tailer.readlines(), [b"one\n"])
+        self.write("o\n")
+        os.rename(self.path, self.path + ".1")
+        self.write("three\n", "w")
+        self.assertEqual(tailer.readlines(), [b"two\n", b"three\n"])
+        self.assertEqual(tailer.rotations, 1)
+
+    def test_copytruncate(self):
+        tailer = Tailer(self.path)
+        self.write("one\n")
+        self.assertEqual(tailer.readlines(), [b"one\n"])
+        self.write("two\n", "w")
+        self.assertEqual(tailer.readlines(), [b"two\n"])
+
+    def test_checkpoint(self):
+        tailer = Tailer(self.path, checkpoint=self.ckpt)
+        self.write("one\ntw")
+        self.assertEqual(tailer.readlines(), [b"one\n"])
+        tailer.close()
+        self.write("o\n")
+        resumed = Tailer(self.path, checkpoint=self.ckpt)
+        self.assertEqual(resumed.readlines(), [b"two\n"])
+
+
+class MultiJournalWatcherTest(unittest.TestCase):
+
+    def test_journal_command(self):
+        cmd = journal_command(units=["openstack-nova-compute"], priority="err",
+                              grep="instance: 1 failed", remote=True)
+        # shlex.split by Command, then again by the remote shell
+        toks = shlex.split(" ".join(shlex.split(cmd)))
+        self.assertEqual(toks[toks.index("-g") + 1], "instance: 1 failed")
+        self.assertIn("openstack-nova-compute", toks)
+
+    def test_merge_order(self):
+        seen = []
+
+        class Collect(Handler):
+            def __call__(self, line):
+                seen.append(line)
+                return "stop" not in line
+
+        now = int(time.time() * 1e6)
+        journal = MultiJournalWatcher([], Collect, window=60)
+        journal.add_entry("c2", {"__REALTIME_TIMESTAMP": str(now + 2),
+                                 "MESSAGE": "second", "_PID": "7",
+                                 "SYSLOG_IDENTIFIER": "nova-compute"})
+        journal.add_entry("c1", {"__REALTIME_TIMESTAMP": str(now + 1),
+                                 "MESSAGE": "first"})
+        # too recent to leave the merge window yet
+        journal._release()
+        self.assertEqual(seen, [])
+        journal.add_entry("c1", {"__REALTIME_TIMESTAMP": str(now + 3),
+                                 "MESSAGE": list(b"stop")})
+        journal.close()
+        self.assertEqual(seen, ["c1 : first\n",
+                                "c2 nova-compute[7]: second\n",
+                                "c1 : stop\n"])
+        self.assertEqual(journal.counts, {"c1": 2, "c2": 1})
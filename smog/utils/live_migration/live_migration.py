@@ -8,26 +8,34 @@ import platform
 import yaml
 
 from smog import load_config
-from smog.tests.base import get_remote_file, set_cfg
-from smog.core.commander import Command
+from smog.core.remote_edit import remote_edit_hosts
+from smog.core.commander import Command, fan_out
 from smog.core.exceptions import ArgumentError
 from smog.core.logger import glob_logger, banner
 import smog.tests.base
+import smog.facts
 
 py_version = """'python -c "from platform import linux_distribution\n\
 print linux_distribution()"'"""
 
 
-def distro_factory(host, command=py_version):
+def distro_factory(host, command=None):
     """
+    :param command: a command printing the (flavor, version, codename) tuple
+                    of platform.linux_distribution (eg py_version).  If None,
+                    the distro of the HostFacts of host is used, falling back
+                    to py_version if the facts have no version
     :return: RHEL release version number.
     """
-    cmd = Command(command, host=host)
-    res = cmd()
-    lines = res.output
-
-    res = eval(lines.strip())
-    flavor, version, codename = res
+    if command is None:
+        distro = smog.facts.host_facts(host).distro
+        flavor, version = distro["name"], distro["version"]
+        codename = distro["codename"]
+        if not version:
+            command = py_version
+    if command is not None:
+        res = Command(command, host=host)()
+        flavor, version, codename = eval(res.output.strip())
     patt = re.compile(r"(\d+(\.\d+)?)")
     m = patt.search(version)
     if not m:
@@ -420,35 +428,25 @@ class ConfigureNFS(Configure):
 
     def make_conf_fn(self, tmp_path, key_excludes=None):
         """
-        Returns a closure that retrieves a file from the remote host, modifies
-        it according to our yaml config file, and then copies the modified
-        file back to the remote host.
+        Returns a closure that modifies a file on remote hosts according to
+        our yaml config file.  The edits are made on the hosts themselves
+        (see smog.core.remote_edit), so the file is not copied back and forth
 
-        :param tmp_path: The path to the (local) file to modify
+        :param tmp_path: no longer used, as nothing is copied locally
         :param key_excludes: (list) of keys in rules to remove
-        :param kwargs: keyword args which gets passed to set_cfg()
 
         :return: A closure, which takes the following arguments
-        :param host: (str) host to get file from
+        :param host: (str|list) host, or list of hosts, to edit the file on.
+                     Several hosts are done in parallel
         :param rules: (dict) a dict of k/v pairs to set in the config file
         :param rpath: (str) path to the remote config file to adjust
-        :param tpath: (str) path to local copy
-        :param kwargs: keyword args passed down to set_cfg
+        :param dry_run: (bool) only log the diff of what would change
+        :param kwargs: not_found, delim and section, as for set_cfg
 
-        The closure will copy rpath to tpath, and use the key-value pairs in the
-        rules to set any parameters (if the key doesn't already exist it will
+        The closure will use the key-value pairs in the rules to set any
+        parameters in rpath, keeping a copy of the original in rpath.bak
         """
-        def configure_file(host, rules, rpath, tpath=None, **kwargs):
-            self.logger.info("Getting {} from {}".format(rpath, host))
-            get_remote_file(host, rpath, dest=tmp_path)
-
-            base_name = os.path.basename(rpath)
-            local_path = os.path.join(tmp_path, base_name)
-            temp_bak = local_path + ".bak"
-
-            if tpath is None:
-                tpath = local_path
-
+        def configure_file(host, rules, rpath, dry_run=False, **kwargs):
             # Edit the rules dictionary.  Make a copy of it, and take out
             # any k/v pairs from key_excludes
             newcfg = copy.copy(rules)
@@ -456,17 +454,24 @@ class ConfigureNFS(Configure):
                 for key in key_excludes:
                     newcfg.pop(key)
 
-            # Set the config file (tpath) with the new k/v values as specified
-            # in the rules dictionary
+            # All the k/v values in the rules dictionary are sent to the host
+            # as one batch of edits
+            kwargs.setdefault("not_found", "ignore")
+            edits = []
             for key, val in newcfg.items():
-                msg = "Setting {} to {} in {}".format(key, val, tpath)
+                msg = "Setting {} to {} in {}".format(key, val, rpath)
                 self.logger.info(msg)
-                set_cfg(key, val, local_path, temp_bak, **kwargs)
-
-            # Copy the now modified file back to the host
-            dest = "root@{}:{}".format(host, rpath)
-            self.logger.info("Copying {} to {}".format(tpath, dest))
-            self.scp(tpath, dest)
+                edit = {"op": "set", "key": key, "value": val}
+                edit.update(kwargs)
+                edits.append(edit)
+
+            hosts = [host] if isinstance(host, str) else list(host)
+            self.logger.info("Editing {} on {}".format(rpath, hosts))
+            results = remote_edit_hosts(hosts, rpath, edits,
+                                        backup=rpath + ".bak",
+                                        keep_original=True, dry_run=dry_run,
+                                        throws=True, logger=self.logger)
+            return results[host] if isinstance(host, str) else results
         return configure_file
 
     def libvirtd_setup(self):
@@ -486,10 +491,9 @@ class ConfigureNFS(Configure):
 
         configure_file = self.make_conf_fn(tmp_path, key_excludes=["filepath"])
 
-        # Copy the remote libvirtd from each compute node
-        for cmpt in self.computes:
-            configure_file(cmpt, _libvirtd_cfg, libvirtd_path)
-            configure_file(cmpt, _libvirtd_syscfg, libvirtd_syscfg_path)
+        # Edit libvirtd's config on all the compute nodes at once
+        configure_file(self.computes, _libvirtd_cfg, libvirtd_path)
+        configure_file(self.computes, _libvirtd_syscfg, libvirtd_syscfg_path)
 
     def nova_setup(self):
         """
@@ -512,12 +516,7 @@ class ConfigureNFS(Configure):
             def conf_adjust(conf_list, targets):
                 for _conf in conf_list:
                     fpath = _conf["filepath"]
-                    msg = "Copying {0} to {1}".format(fpath, tmp_path)
-                    self.logger.debug(msg)
-
-                    # Create the state_path directory and configure nova
-                    for target in targets:
-                        configure_nova(target, _conf, fpath)
+                    configure_nova(targets, _conf, fpath)
 
             # For the computes, we only need to adjust the nova.conf (which is head)
             conf_adjust([head], self.computes)
@@ -667,8 +666,8 @@ class ConfigureNFS(Configure):
     def configure_etc_hosts(self):
         """Sets the /etc/hosts file on both the controllers and compute2 nodes
 
-        It copies the /etc/hosts file locally, edits it, then copies the edited
-        file back.  The function will also run the hostname command remotely in
+        It edits the /etc/hosts file on the hosts themselves.  The function
+        will also run the hostname command remotely in
         order to get the hostname from the nodes.  It compares this with the
         cdomain name from the nfs_idmapd section.  If there is a discrepancy or
         it can't retrieve the hostname, it will raise an error
@@ -708,15 +707,13 @@ class ConfigureNFS(Configure):
         domain_name = self.share_storage_cfg["nfs"]["nfs_idmapd"]["Domain"]
 
         # Get the /etc/hosts file from all the remote machines
-        entries = {}
-        for comp in self.computes:
-            compute_entry = "{0} {1}".format(*get_host_names(comp,
-                                                             domain_name))
-            entries.update({comp: compute_entry})
+        names = fan_out(lambda comp: get_host_names(comp, domain_name),
+                        self.computes, throws=True)
+        entries = {comp: "{0} {1}".format(*res.value)
+                   for comp, res in names.items()}
 
-        for comp in self.computes:
-            configure_hosts(comp, entries, "/etc/hosts", not_found="append",
-                            delim=" ")
+        configure_hosts(self.computes, entries, "/etc/hosts",
+                        not_found="append", delim=" ")
 
         return True
 
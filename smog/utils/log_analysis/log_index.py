@@ -0,0 +1,290 @@
+"""
+Indexes collected OpenStack logs into SQLite, for post-mortems.
+
+Logs (plain or gzipped) are streamed in, and every line is parsed into its
+timestamp, pid, level, module, request id and instance uuid.  Lines which are
+not in the OpenStack format (eg the rest of a multi-line message) are folded
+into the entry before them.  The exception named by an entry, if any, is found
+with ExceptionHandler.base_patterns.
+
+Usage::
+
+    from smog.utils.log_analysis.log_index import LogIndex
+
+    index = LogIndex("postmortem.db")
+    index.ingest_dir("collected/")   # collected/<host>/var/log/nova/...
+    for entry in index.query(request_id="req-0c2f...", level="ERROR"):
+        print(entry.host, entry.ts, entry.message)
+    print(index.exception_summary())
+"""
+
+__author__ = 'stoner'
+
+import gzip
+import os
+import re
+import sqlite3
+from collections import namedtuple
+
+from smog.core.watcher import ExceptionHandler, PatternSet
+from smog.core.logger import glob_logger
+
+LINE_PATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?)\s+"   # timestamp
+    r"(\d+)\s+"                                              # pid
+    r"(TRACE|DEBUG|INFO|AUDIT|WARNING|ERROR|CRITICAL)\s+"    # level
+    r"(\S+)\s+"                                              # module
+    r"(?:\[(req-[0-9a-f-]+)?[^\]]*\]\s+)?"                   # request id
+    r"(.*)$")
+INSTANCE_PATTERN = re.compile(r"\[instance: ([0-9a-f-]{36})\]")
+
+LogEntry = namedtuple("LogEntry", ["host", "path", "lineno", "ts", "pid",
+                                   "level", "module", "request_id",
+                                   "instance", "exception", "message"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    host TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    UNIQUE (host, path)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    file_id INTEGER,
+    lineno INTEGER,
+    ts TEXT,
+    pid INTEGER,
+    level TEXT,
+    module TEXT,
+    request_id TEXT,
+    instance TEXT,
+    exception TEXT,
+    message TEXT
+);
+"""
+
+# Building the indexes once after a bulk load is much faster than updating
+# them on every insert, so they are dropped by ingest() and only (re)built
+# when a query needs them
+INDEXES = {
+    "entries_request": "entries (request_id)",
+    "entries_level_ts": "entries (level, ts)",
+    "entries_instance": "entries (instance)",
+    "entries_exception": "entries (exception)",
+    "entries_ts": "entries (ts)",
+}
+
+
+def open_log(path):
+    """
+    Opens a plain or gzipped log for reading as text
+    """
+    with open(path, "rb") as fobj:
+        magic = fobj.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, "r", errors="replace")
+
+
+def parse_lines(lines):
+    """
+    Parses OpenStack log lines, folding any line that does not start with a
+    timestamp into the entry before it
+
+    :param lines: iterable of str
+    :return: generator of (lineno, ts, pid, level, module, request_id,
+             instance, message)
+    """
+    current = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        m = LINE_PATTERN.match(line)
+        if m is None:
+            if current is not None:
+                current[-1] += "\n" + line
+            continue
+        if current is not None:
+            yield tuple(current)
+        ts, pid, level, module, req_id, msg = m.groups()
+        inst = INSTANCE_PATTERN.search(msg)
+        current = [lineno, ts, int(pid), level, module, req_id,
+                   inst.group(1) if inst else None, msg]
+    if current is not None:
+        yield tuple(current)
+
+
+class LogIndex(object):
+    """
+    A SQLite backed index of OpenStack log entries
+    """
+    def __init__(self, db=":memory:", batch_size=5000, logger=glob_logger):
+        """
+        :param db: (str) path of the SQLite database
+        :param batch_size: (int) rows inserted per executemany
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.logger = logger
+        self.conn = sqlite3.connect(db)
+        self.conn.executescript(SCHEMA)
+        self._indexed = None
+        self._exceptions = PatternSet(ExceptionHandler.base_patterns())
+
+    def close(self):
+        self.conn.close()
+
+    def _set_indexes(self, indexed):
+        if self._indexed == indexed:
+            return
+        for name, on in INDEXES.items():
+            if indexed:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS {} ON {}".format(
+                    name, on))
+            else:
+                self.conn.execute("DROP INDEX IF EXISTS {}".format(name))
+        self.conn.commit()
+        self._indexed = indexed
+
+    def _exception(self, message):
+        for _, m in self._exceptions.matches(message):
+            return m.group(1)
+        return None
+
+    def ingest(self, path, host=None):
+        """
+        Streams a log file into the index.  A file which was already ingested
+        is skipped if unchanged, or else re-indexed
+
+        :param path: (str) path of a plain or gzipped log
+        :param host: (str) the host the log came from
+        :return: number of entries added
+        """
+        st = os.stat(path)
+        cur = self.conn.cursor()
+        self._set_indexes(False)
+        row = cur.execute("SELECT id, size, mtime FROM files "
+                          "WHERE host IS ? AND path = ?",
+                          (host, path)).fetchone()
+        if row is not None:
+            if row[1] == st.st_size and row[2] == st.st_mtime:
+                return 0
+            cur.execute("DELETE FROM entries WHERE file_id = ?", (row[0],))
+            cur.execute("DELETE FROM files WHERE id = ?", (row[0],))
+        cur.execute("INSERT INTO files (host, path, size, mtime) "
+                    "VALUES (?, ?, ?, ?)",
+                    (host, path, st.st_size, st.st_mtime))
+        file_id = cur.lastrowid
+
+        insert = "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        count = 0
+        batch = []
+        with open_log(path) as log:
+            for parsed in parse_lines(log):
+                lineno, ts, pid, level, module, req, inst, msg = parsed
+                batch.append((file_id, lineno, ts, pid, level, module, req,
+                              inst, self._exception(msg), msg))
+                if len(batch) >= self.batch_size:
+                    cur.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+        cur.executemany(insert, batch)
+        count += len(batch)
+        self.conn.commit()
+        self.logger.debug("Indexed {} entries from {}".format(count, path))
+        return count
+
+    def ingest_dir(self, root, pattern=r"\.log(\.\d+)?(\.gz)?$"):
+        """
+        Ingests every log under root.  The first directory below root is
+        taken to be the host name (eg root/<host>/var/log/nova/nova-api.log)
+
+        :return: number of entries added
+        """
+        patt = re.compile(pattern)
+        count = 0
+        for dirpath, _, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            host = None if rel == "." else rel.split(os.sep)[0]
+            for fname in sorted(filenames):
+                if patt.search(fname):
+                    count += self.ingest(os.path.join(dirpath, fname),
+                                        host=host)
+        return count
+
+    def query(self, request_id=None, level=None, host=None, instance=None,
+              exception=None, module=None, since=None, until=None,
+              contains=None, limit=None):
+        """
+        Finds entries matching all of the given criteria, in timestamp order
+
+        :param level: (str|list) one or more levels, eg "ERROR"
+        :param since: (str) "YYYY-MM-DD HH:MM:SS" lower bound on the time
+        :param until: (str) upper bound on the time
+        :param contains: (str) substring of the message
+        :return: list of LogEntry
+        """
+        clauses = []
+        args = []
+
+        def add(clause, *vals):
+            clauses.append(clause)
+            args.extend(vals)
+
+        if request_id is not None:
+            add("e.request_id = ?", request_id)
+        if level is not None:
+            levels = [level] if isinstance(level, str) else list(level)
+            add("e.level IN ({})".format(",".join("?" * len(levels))),
+                *levels)
+        if host is not None:
+            add("f.host = ?", host)
+        if instance is not None:
+            add("e.instance = ?", instance)
+        if exception is not None:
+            add("e.exception = ?", exception)
+        if module is not None:
+            add("e.module = ?", module)
+        if since is not None:
+            add("e.ts >= ?", since)
+        if until is not None:
+            add("e.ts <= ?", until)
+        if contains is not None:
+            add("instr(e.message, ?) > 0", contains)
+
+        self._set_indexes(True)
+        sql = "SELECT f.host, f.path, e.lineno, e.ts, e.pid, e.level, " \
+              "e.module, e.request_id, e.instance, e.exception, e.message " \
+              "FROM entries e JOIN files f ON e.file_id = f.id"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY e.ts, f.host, e.lineno"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return [LogEntry(*row) for row in self.conn.execute(sql, args)]
+
+    def exception_summary(self, level=None):
+        """
+        :return: list of (exception, count, first ts, last ts), most common
+                 first
+        """
+        self._set_indexes(True)
+        sql = "SELECT exception, COUNT(*), MIN(ts), MAX(ts) FROM entries " \
+              "WHERE exception IS NOT NULL"
+        args = []
+        if level is not None:
+            sql += " AND level = ?"
+            args.append(level)
+        sql += " GROUP BY exception ORDER BY COUNT(*) DESC"
+        return self.conn.execute(sql, args).fetchall()
+
+    def request_ids(self, level="ERROR"):
+        """
+        :return: the distinct request ids which logged at level
+        """
+        self._set_indexes(True)
+        sql = "SELECT DISTINCT request_id FROM entries " \
+              "WHERE level = ? AND request_id IS NOT NULL"
+        return [r[0] for r in self.conn.execute(sql, (level,))]
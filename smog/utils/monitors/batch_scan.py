@@ -0,0 +1,188 @@
+"""
+Scans large archived logs with Handlers, using every core.
+
+A Watcher feeds a log to its Handler one line at a time from one thread,
+which is fine for a live log but slow for a multi-GB archive.  scan_file
+splits a file into byte ranges whose boundaries fall on newlines, and a
+ProcessPoolExecutor searches each range (through mmap) for lines matching the
+handlers' patterns.  Only those lines come back to this process, where they
+are replayed into the handlers, in file order, through a HandlerGroup.  So the
+handlers see the same lines, in the same order, as if they had tailed the
+file, and their results are read as usual.
+
+Every handler must list its regexes in self.patterns (ExceptionHandler and
+RegexHandler do).  Only plain (not gzipped) files can be mmap'ed.
+
+Usage::
+
+    from smog.core.watcher import ExceptionHandler
+    from smog.utils.monitors.batch_scan import scan_file
+
+    group = scan_file("nova-compute.log",
+                      [(ExceptionHandler, (), {"fail": False, "die": False})])
+    exceptions = group.handlers[0].result
+"""
+
+__author__ = 'stoner'
+
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from smog.core.exceptions import ArgumentError
+from smog.core.logger import glob_logger
+from smog.core.watcher import HandlerGroup, MonitoredException, PatternSet
+
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+
+# The PatternSet for each pattern list a worker process has seen, so that it
+# is only compiled once per process rather than once per chunk
+_worker_patterns = {}
+
+
+def chunk_ranges(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Splits a file into (start, end) byte ranges of roughly chunk_size, each of
+    which ends just after a newline (or at the end of the file)
+
+    :param path: (str) path of the file
+    :param chunk_size: (int) approximate size in bytes of each range
+    :return: list of (start, end)
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    ranges = []
+    with open(path, "rb") as fobj:
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < size:
+                end = start + chunk_size
+                if end >= size:
+                    end = size
+                else:
+                    nl = mm.find(b"\n", end - 1)
+                    end = size if nl == -1 else nl + 1
+                ranges.append((start, end))
+                start = end
+        finally:
+            mm.close()
+    return ranges
+
+
+def scan_chunk(path, start, end, patterns):
+    """
+    Finds the lines in path[start:end] that match any of patterns.  This is
+    what runs in the worker processes
+
+    :param patterns: list of regexes (str or compiled)
+    :return: tuple of (number of lines in the range, list of (lineno, line))
+             where lineno counts from 0 at the start of the range
+    """
+    key = tuple(patterns)
+    pset = _worker_patterns.get(key)
+    if pset is None:
+        pset = _worker_patterns[key] = PatternSet(patterns)
+
+    with open(path, "rb") as fobj:
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = mm[start:end].decode(errors="replace")
+        finally:
+            mm.close()
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    found = [(i, line + "\n") for i, line in enumerate(lines)
+             if pset.search(line)]
+    return len(lines), found
+
+
+class _BatchReader(object):
+    """
+    Stands in for the reader of a HandlerGroup driven by scan_file
+    """
+    def __init__(self):
+        self.done = False
+
+    def terminate(self):
+        self.done = True
+
+    def is_alive(self):
+        return not self.done
+
+
+def _submit(pool, path, patterns, chunk_size):
+    return [pool.submit(scan_chunk, path, start, end, patterns)
+            for start, end in chunk_ranges(path, chunk_size)]
+
+
+def _replay(group, futures, logger=glob_logger):
+    """
+    Feeds the matched lines of each chunk, in order, into the group until it
+    is done.  Chunks which are no longer needed are cancelled
+
+    :return: total number of lines scanned
+    """
+    scanned = 0
+    try:
+        for fut in futures:
+            if group.rdr.done:
+                break
+            nlines, found = fut.result()
+            for lineno, line in found:
+                if group(line) is False:
+                    scanned += lineno + 1
+                    break
+            else:
+                scanned += nlines
+    except MonitoredException as me:
+        logger.info(str(me))
+    finally:
+        for fut in futures:
+            fut.cancel()
+    return scanned
+
+
+def scan_files(paths, handlers, max_workers=None,
+               chunk_size=DEFAULT_CHUNK_SIZE, logger=glob_logger):
+    """
+    Scans many files with one process pool.  Each file gets its own set of
+    handlers
+
+    :param paths: sequence of paths of plain text logs
+    :param handlers: list of Handler classes, or of (hcls, args) or
+                     (hcls, args, kwargs) tuples, as for HandlerGroup
+    :param max_workers: (int) worker processes (default is the cpu count)
+    :param chunk_size: (int) approximate bytes scanned per task
+    :return: OrderedDict of path -> HandlerGroup
+    """
+    groups = OrderedDict()
+    for path in paths:
+        group = HandlerGroup(_BatchReader(), handlers)
+        if group.patterns is None:
+            raise ArgumentError("Every handler needs self.patterns to be "
+                                "used with scan_files")
+        groups[path] = group
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = OrderedDict((path, _submit(pool, path, group.patterns,
+                                             chunk_size))
+                              for path, group in groups.items())
+        for path, group in groups.items():
+            scanned = _replay(group, futures[path], logger=logger)
+            logger.debug("Scanned {} lines of {}".format(scanned, path))
+    return groups
+
+
+def scan_file(path, handlers, max_workers=None,
+              chunk_size=DEFAULT_CHUNK_SIZE, logger=glob_logger):
+    """
+    Scans one file in parallel with handlers
+
+    :return: the HandlerGroup, whose handlers hold the results
+    """
+    return scan_files([path], handlers, max_workers=max_workers,
+                      chunk_size=chunk_size, logger=logger)[path]
@@ -18,6 +18,7 @@ class RegexHandler(Handler):
         self.line = None
         self.res_q = multiprocessing.Queue()
         self.pattern = regexp
+        self.patterns = [regexp]
         self.fn = getattr(self.pattern, "search")
         self.counts = None
 
@@ -1,7 +1,7 @@
 __author__ = 'stoner'
 
 import smog
-from smog.core.commander import Command
+from smog.core.commander import Command, fan_out
 import smog.virt
 import yaml
 
@@ -58,22 +58,28 @@ def _setup_nested_support(computes, permissive=True):
     :return:
     """
 
-    bare_m = []
+    # set_nested_vm_support may reboot the bare metal machine, so the L1
+    # guests of one parent are done one at a time, but different parents are
+    # done in parallel
+    bare_m = {}
     for cmpt in computes:
         parent = cmpt.parent
-        bare_m.append([parent, (cmpt.host, cmpt.name), cmpt])
-
-    for bm, info_set, cmpt in bare_m:
-        fnc = None
-        if cmpt.passthrough == "passthrough":
-            fnc = smog.virt.set_host_passthrough
-        elif cmpt.passthrough == "host-model":
-            fnc = smog.virt.set_host_model
-        smog.virt.set_nested_vm_support(bm, info_set, fn=fnc)
-
-        if permissive:
-            host = info_set[0]
-            res = Command("setenforce 0", host=host)()
+        bare_m.setdefault(parent, []).append([(cmpt.host, cmpt.name), cmpt])
+
+    def setup_parent(bm):
+        for info_set, cmpt in bare_m[bm]:
+            fnc = None
+            if cmpt.passthrough == "passthrough":
+                fnc = smog.virt.set_host_passthrough
+            elif cmpt.passthrough == "host-model":
+                fnc = smog.virt.set_host_model
+            smog.virt.set_nested_vm_support(bm, info_set, fn=fnc)
+
+            if permissive:
+                host = info_set[0]
+                res = Command("setenforce 0", host=host)()
+
+    fan_out(setup_parent, list(bare_m.keys()), throws=True)
 
 
 def configure_nested(yfile):
@@ -24,7 +24,7 @@ import os
 import sys
 import re
 
-from smog.core.commander import Command, freader
+from smog.core.commander import Command, freader, fan_out, run_on_hosts
 from smog.core.logger import glob_logger
 from smog.tests.base import scp, get_cfg,  openstack_config, BaseStack
 from smog.utils.rc_helper import read_rc_file
@@ -79,6 +79,11 @@ class Upgrade(object):
 
     __metaclass__ = ABCMeta
 
+    # How many hosts are upgraded at once, and (if not None) how many hosts
+    # make up one batch of a rolling upgrade
+    max_workers = 10
+    batch_size = None
+
     def __init__(self, name, hosts, path_to_rhos_release):
         """
 
@@ -101,11 +106,12 @@ class Upgrade(object):
         pass
 
     def _upgrade(self, commands):
-        # Make sure to stop the service first
-        for host in self.hosts:
+        # Make sure to stop the service first.  The commands for one host are
+        # run in order, but all the hosts are done in parallel
+        def run_commands(host):
             cmds = [Command(x, host=host) for x in commands]
             for cmd in cmds:
-                glob_logger.info("Calling: {}".format(cmd.cmd))
+                glob_logger.info("Calling: {} on {}".format(cmd.cmd, host))
                 try:
                     res = cmd()
                     if res != 0:
@@ -114,22 +120,27 @@ class Upgrade(object):
                     cmdstr = cmd.cmd
                     glob_logger.error("Could not execute {}".format(cmdstr))
 
+        fan_out(run_commands, self.hosts, max_workers=self.max_workers,
+                batch_size=self.batch_size)
+
         state = self.get_service_state()
         if "active" not in state:
             raise Exception("Service {} did not come up".format(self.name))
 
-    def get_service_state(self):
+    def get_service_state(self, cache=False):
         """
         Gets the state of the service
 
         FIXME: Some services will return states for several sub-services.  Since
         this regex is greedy, it will find the first match which may not cover
         all the other services
+        :param cache: (bool|CommandCache) reuse a recent result.  Restarting
+                      the service through Command invalidates it
         :return:
         """
         for host in self.hosts:
             cmd = Command("openstack-service status {}".format(self.name),
-                          host=host)
+                          host=host, cache=cache)
             patt = re.compile(r"\s+is (\w+)")
             res = cmd()
             m = patt.search(res.output)
@@ -313,8 +324,9 @@ class NovaUpgrade(Upgrade):
             if s.status != "disabled":
                 raise Exception("{} nova-compute not disabled".format(hostname))
 
-            cmd = Command("openstack-service stop nova-compute", host=ip)
-            res = cmd()
+        ips = [ip for ip, _ in self.hyps]
+        run_on_hosts("openstack-service stop nova-compute", ips,
+                     max_workers=self.max_workers, throws=True)
 
     def reenable_computes(self):
         """
@@ -322,10 +334,11 @@ class NovaUpgrade(Upgrade):
 
         :return: None
         """
-        for ip, hostname in self.hyps:
-            cmd = Command("openstack-service restart nova", host=ip)
-            res = cmd()
+        ips = [ip for ip, _ in self.hyps]
+        run_on_hosts("openstack-service restart nova", ips,
+                     max_workers=self.max_workers, throws=True)
 
+        for ip, hostname in self.hyps:
             s = self.base.nova.services.enable(hostname, "nova-compute")
             if s.status != "enabled":
                 raise Exception("{} nova-compute not enabled".format(hostname))
@@ -339,12 +352,17 @@ class NovaUpgrade(Upgrade):
         """
         version = self.version
         self.disable_computes()
-        for ip, _ in self.hyps:
+
+        def update_compute(ip):
             # setup rhos-release 6
             configure_rhos_repos(ip, version=version)
 
             # Perform the update
-            Command(self.update, host=ip)()
+            return Command(self.update, host=ip)()
+
+        ips = [ip for ip, _ in self.hyps]
+        fan_out(update_compute, ips, max_workers=self.max_workers,
+                batch_size=self.batch_size, throws=True)
         self.reenable_computes()
 
 
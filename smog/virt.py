@@ -1,6 +1,9 @@
 """
 This module contains low-level functions surrounding libvirt, or directly
 getting system information from a host
+
+Connections to hypervisors come from smog.core.libvirt_pool.default_pool, so
+they are opened once and reused (closing them does nothing)
 """
 
 __author__ = 'stoner'
@@ -14,18 +17,22 @@ import untangle
 
 from smog.core.commander import Command, CommandException
 import smog.core.exceptions as sce
+import smog.facts
+from smog.core.libvirt_pool import default_pool
+from smog.core.xml.domain_cache import default_cache as domain_cache
 from smog.core.logger import glob_logger
 
 
 def get_connection(hv_ip, user="root", driver="qemu+ssh"):
     """
-    Returns a connection ref to the hypervisor
+    Returns a connection ref to the hypervisor, from the libvirt connection
+    pool
 
     :param hv_ip: (str) hypervisor's ip address
     :param user: (str) user to connect as
-    :return: libvirt Connection object
+    :return: PooledConnection, which behaves like a libvirt Connection object
     """
-    return libvirt.open("{}://{}@{}/system".format(driver, user, hv_ip))
+    return default_pool.get(hv_ip, user=user, driver=driver)
 
 
 def get_domain(master, vm_name, user="root", driver="qemu+ssh"):
@@ -122,28 +129,24 @@ def pinger(host, timeout=300):
             raise Exception(err)
 
 
-def verify_nested_kvm(host):
+def verify_nested_kvm(host, cache=True):
     """
-    Goes through loaded modules to see if kvm_intel or kvm_amd is loaded
+    Goes through loaded modules (the cpu_vendor of the HostFacts of host) to
+    see if kvm_intel or kvm_amd is loaded
 
     :param host: (str) IP Address of host
+    :param cache: (bool) use the cached facts of host.  They are gathered
+                  again anyway before saying that kvm is not loaded
     :return: The CPU type (str) intel or amd
     """
     glob_logger.info("Checking is kvm and kvm-intel or kvm-amd is running...")
-    lsmod = Command("lsmod", host=host)(showout=False)
-    patt = re.compile(r"kvm_(intel|amd)")
-
-    out = lsmod.output
-
-    for line in lsmod.output.split("\n")[1:]:
-        m = patt.search(line)
-        if m:
-            proc = m.groups()[0]
-            break
-    else:
+    fact = smog.facts.host_facts(host, refresh=not cache)
+    if fact.cpu_vendor is None and cache:
+        # the module may have been loaded since the facts were gathered
+        fact = smog.facts.host_facts(host, refresh=True)
+    if fact.cpu_vendor is None:
         raise sce.ConfigException("kvm module is not loaded")
-
-    return proc
+    return fact.cpu_vendor
 
 
 def verify_modprobe(host, proc_type="intel", set=False):
@@ -182,21 +185,27 @@ def verify_modprobe(host, proc_type="intel", set=False):
 
 def set_host_passthrough(hyper_ip, dom_name, user="root"):
     """
-    Sets a domain's <cpu> element to use mode host-passthrough
+    Sets a domain's <cpu> element to use mode host-passthrough (replacing
+    anything else in it, like virt-xml's clearxml=yes), by redefining the
+    domain over the pooled connection
 
     :param hyper_ip: (str) IP address of host with hypervisor
     :param dom_name: (str) the libvirt domain name
     :param user: (str) user to connect to libvirt hypervisor
-    :return: ProcessTresult
+    :return: the redefined libvirt Domain
     """
-    # FIXME: How do we do this just using libvirt?  This adds a dependency
-    # on virt-xml
-    # Edit the domain's xml to use host-passthrough mode
     glob_logger.info("Setting host-passthrough mode for {}".format(dom_name))
-    cmd = "virt-xml --connect=qemu+ssh://{}@{}/system {} --edit --cpu " \
-          "host-passthrough,clearxml=yes".format(user, hyper_ip, dom_name)
-    res = Command(cmd)()
-    return res
+    conn = get_connection(hyper_ip, user=user)
+    dom = conn.lookupByName(dom_name)
+    root = ET.fromstring(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    cpu = root.find("cpu")
+    if cpu is None:
+        cpu = ET.SubElement(root, "cpu")
+    cpu.clear()
+    cpu.set("mode", "host-passthrough")
+    dom = conn.defineXML(ET.tostring(root).decode())
+    domain_cache.invalidate(dom.UUIDString())
+    return dom
 
 
 def get_host_model(hyper_ip, dom_name, user="root", driver="qemu+ssh"):
@@ -240,7 +249,7 @@ def test_and_set_kvm_module(bare_m):
     if p is None:
         # kvm is not loaded
         Command("modprobe kvm", host=bare_m)()
-        p = verify_nested_kvm(bare_m)
+        p = verify_nested_kvm(bare_m, cache=False)
         if p is None:
             raise sce.ConfigException("Can not load kvm module")
     return p
@@ -287,15 +296,15 @@ def turn_on(hv_ip, domain_name, ip_addr, wait=5):
 
 def test_and_set_nested(host, timeout=600):
     """
-    Verifies that the host has nested virtualization set for kvm module
+    Verifies that the host has nested virtualization set for kvm module (the
+    nested field of its HostFacts)
 
     :param host:
     :param timeout:
-    :return: ProcessResult
+    :return: the HostFacts of host
     """
-    cmd = "cat /sys/module/kvm_intel/parameters/nested"
-    res = Command(cmd, host=host)(showout=False)
-    if res.output.strip() != "Y":
+    fact = smog.facts.host_facts(host)
+    if not fact.nested:
         # Reboot the masters machine
         glob_logger.info("rebooting {} to set nested param".format(host))
         rebooter(host, timeout=timeout)
@@ -303,27 +312,26 @@ def test_and_set_nested(host, timeout=600):
         pinger(host, timeout=timeout)
 
         # After reboot, make sure nested support is there
-        path = "/sys/module/kvm_intel/parameters/nested"
-        cmd = "cat {}".format(path)
         try:
-            res = Command(cmd, host=host)(showout=False)
-            if res.output.strip() != "Y":
-                glob_logger.error("{}={}".format(path, res.output.strip()))
-                raise sce.ConfigException("Nested support still not enabled")
-        except CommandException:
+            fact = smog.facts.host_facts(host, refresh=True)
+        except Exception as ex:
+            glob_logger.error("Could not gather facts: {}".format(ex))
             raise sce.ConfigException("Nested support still not enabled")
-    return res
+        if not fact.nested:
+            raise sce.ConfigException("Nested support still not enabled")
+    return fact
 
 
-def check_kvm_file(host):
+def check_kvm_file(host, cache=True):
     """
     Checks of the /dev/kvm special file exists on host
 
     :param host: (str) IP address of machine
+    :param cache: (bool|CommandCache) reuse a recent result for host
     :return: ProcessResult object (or throws ConfigException)
     """
     glob_logger.info("Checking /dev/kvm")
-    res = Command("file /dev/kvm", host=host)()
+    res = Command("file /dev/kvm", host=host, cache=cache)()
     if "cannot open" in res.output:
         raise sce.ConfigException("no /dev/kvm on {}".format(host))
     return res